@@ -0,0 +1,220 @@
+"""
+Recent posts and threads, for the "latest activity" template tags.
+
+The latest FORUM_ACTIVITY_SIZE posts and active threads, and the latest
+FORUM_ACTIVITY_USER_SIZE posts of each user, are kept as ring buffers of
+small tuples in the cache backend. Post.save() pushes new posts onto
+them. Deleting a post, or renaming, moving or deleting a thread, drops
+the buffers instead; they are read again from the database on next use.
+
+Every process keeps the buffers it read in memory, tagged with a version
+stamp that changes with any buffer. The stamp is looked up once per
+request, so the tags render from memory as long as nothing was posted.
+
+    >>> from forum import activity
+    >>> activity.latest_posts(5, forum_ids=Forum.objects.accessible_ids(user))
+"""
+
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+
+from forum.utils import CACHE_FOREVER, LRUCache
+
+FORUM_ACTIVITY_SIZE = getattr(settings, 'FORUM_ACTIVITY_SIZE', 50)
+FORUM_ACTIVITY_USER_SIZE = getattr(settings, 'FORUM_ACTIVITY_USER_SIZE', 20)
+FORUM_ACTIVITY_USER_TIMEOUT = getattr(settings, 'FORUM_ACTIVITY_USER_TIMEOUT', 24 * 60 * 60)
+
+VERSION_KEY = 'forum:activity:version'
+# Part of every buffer key; replaced to drop all of them at once.
+GENERATION_KEY = 'forum:activity:generation'
+LOCK_KEY = 'forum:activity:lock'
+POSTS_KEY = 'forum:activity:%s:posts'
+THREADS_KEY = 'forum:activity:%s:threads'
+USER_KEY = 'forum:activity:%s:user:%d'
+
+# Number of buffers each process keeps in memory.
+LOCAL_SIZE = 1000
+
+# A buffer entry is a post and its thread:
+# (post pk, thread pk, thread title, forum pk, author pk, author username, time)
+
+def _entry(post):
+    thread = post.thread
+    return (post.pk, thread.pk, thread.title, thread.forum_id, post.author_id, post.author.username, post.time)
+
+def _load_posts(size, **filters):
+    from forum.models import Post
+    return list(Post.objects.filter(**filters).order_by('-time', '-id').values_list(
+        'pk', 'thread', 'thread__title', 'thread__forum', 'author', 'author__username', 'time')[:size])
+
+def _load_threads(size):
+    from forum.models import Thread
+    return list(Thread.objects.filter(latest_post_time__isnull=False).order_by('-latest_post_time', '-id').values_list(
+        'last_post', 'pk', 'title', 'forum', 'last_poster', 'last_poster__username', 'latest_post_time')[:size])
+
+class RecentUser(object):
+    def __init__(self, pk, username):
+        self.pk = self.id = pk
+        self.username = username
+
+    def __unicode__(self):
+        return self.username
+
+class RecentThread(object):
+    """The thread of an entry, with the entry's post as its latest one."""
+    def __init__(self, entry):
+        self.last_post_id, self.pk, self.title, self.forum_id, author_id, username, self.latest_post_time = entry
+        self.id = self.pk
+        self.last_poster = RecentUser(author_id, username)
+
+    def get_absolute_url(self):
+        return reverse('forum_view_thread', args=[self.pk])
+
+    def __unicode__(self):
+        return self.title.replace('[[','').replace(']]','')
+
+class RecentPost(object):
+    """The post of an entry, standing in for a Post in templates."""
+    def __init__(self, entry):
+        self.pk, self.thread_id, title, self.forum_id, self.author_id, username, self.time = entry
+        self.id = self.pk
+        self.thread = RecentThread(entry)
+        self.author = self.thread.last_poster
+
+    def get_absolute_url(self):
+        return reverse('forum_view_post', args=[self.pk])
+
+    def __unicode__(self):
+        return u"%s" % self.pk
+
+class ActivityBuffers(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._generation = None
+        self._checked = False
+        self._local = LRUCache(LOCAL_SIZE)
+
+    def _check(self):
+        if self._checked:
+            return
+        stamps = cache.get_many([VERSION_KEY, GENERATION_KEY])
+        if GENERATION_KEY not in stamps:
+            cache.add(GENERATION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+            stamps[GENERATION_KEY] = cache.get(GENERATION_KEY)
+        version = (stamps.get(VERSION_KEY), stamps[GENERATION_KEY])
+        with self._lock:
+            if version != self._version:
+                self._local = LRUCache(LOCAL_SIZE)
+                self._version = version
+                self._generation = version[1]
+            self._checked = True
+
+    def _read(self, key, load, timeout):
+        entries = self._local.get(key)
+        if entries is None:
+            entries = cache.get(key)
+            if entries is None:
+                version = cache.get(VERSION_KEY)
+                entries = load()
+                cache.add(key, entries, timeout)
+                if cache.get(VERSION_KEY) != version:
+                    # A post came in while loading and found no buffer to
+                    # go onto; what was loaded may miss it.
+                    cache.delete(key)
+                    return entries
+            self._local.set(key, entries)
+        return entries
+
+    def _changed(self):
+        cache.set(VERSION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+        self._checked = False
+
+    def expire(self, **kwargs):
+        """Makes the next read compare against the shared version stamp."""
+        self._checked = False
+
+    def posts(self):
+        self._check()
+        return self._read(POSTS_KEY % self._generation, lambda: _load_posts(FORUM_ACTIVITY_SIZE), CACHE_FOREVER)
+
+    def threads(self):
+        self._check()
+        return self._read(THREADS_KEY % self._generation, lambda: _load_threads(FORUM_ACTIVITY_SIZE), CACHE_FOREVER)
+
+    def user_posts(self, user_id):
+        self._check()
+        return self._read(USER_KEY % (self._generation, user_id),
+                          lambda: _load_posts(FORUM_ACTIVITY_USER_SIZE, author=user_id),
+                          FORUM_ACTIVITY_USER_TIMEOUT)
+
+    def post_created(self, post):
+        """Pushes a new post onto the buffers that are loaded."""
+        self._check()
+        entry = _entry(post)
+        keys = [POSTS_KEY % self._generation, THREADS_KEY % self._generation,
+                USER_KEY % (self._generation, post.author_id)]
+        # Before looking at the buffers, so a reader loading one meanwhile
+        # does not keep what it loaded (see _read()).
+        self._changed()
+        if not cache.add(LOCK_KEY, 1, 5):
+            # Another push is under way and would write the buffers back
+            # without this post; start a new generation instead, loaded
+            # again by the next readers.
+            self.invalidate()
+            return
+        try:
+            buffers = cache.get_many(keys)
+            posts_key, threads_key, user_key = keys
+            changes = {}
+            if posts_key in buffers:
+                changes[posts_key] = [entry] + buffers[posts_key][:FORUM_ACTIVITY_SIZE - 1]
+            if threads_key in buffers:
+                others = [e for e in buffers[threads_key] if e[1] != entry[1]]
+                changes[threads_key] = [entry] + others[:FORUM_ACTIVITY_SIZE - 1]
+            if changes:
+                cache.set_many(changes, CACHE_FOREVER)
+            if user_key in buffers:
+                cache.set(user_key, [entry] + buffers[user_key][:FORUM_ACTIVITY_USER_SIZE - 1],
+                          FORUM_ACTIVITY_USER_TIMEOUT)
+        finally:
+            cache.delete(LOCK_KEY)
+        self._changed()
+
+    def post_deleted(self, post):
+        """Drops the buffers that may show the post."""
+        self._check()
+        cache.delete_many([POSTS_KEY % self._generation, THREADS_KEY % self._generation,
+                           USER_KEY % (self._generation, post.author_id)])
+        self._changed()
+
+    def invalidate(self, **kwargs):
+        """Drops every buffer, eg. when a thread was renamed, moved or deleted."""
+        cache.set(GENERATION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+        self._changed()
+
+buffers = ActivityBuffers()
+
+request_started.connect(buffers.expire, dispatch_uid='forum.activity.expire')
+
+def _pick(entries, number, forum_ids, cls):
+    if forum_ids is not None:
+        entries = [e for e in entries if e[3] in forum_ids]
+    return [cls(e) for e in entries[:number]]
+
+def latest_posts(number=5, forum_ids=None):
+    """The latest posts, only of the forums in ``forum_ids`` if given."""
+    return _pick(buffers.posts(), number, forum_ids, RecentPost)
+
+def latest_threads(number=5, forum_ids=None):
+    """The threads with the latest posts."""
+    return _pick(buffers.threads(), number, forum_ids, RecentThread)
+
+def latest_user_posts(user, number=5, forum_ids=None):
+    """The latest posts of a user (or user pk)."""
+    return _pick(buffers.user_posts(getattr(user, 'pk', user)), number, forum_ids, RecentPost)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.db import models
 from django.contrib.admin.widgets import FilteredSelectMultiple
-from forum.models import Forum, Thread, Post, Subscription
+from forum.models import Forum, Thread, Post, Subscription, Notification
 
 class ForumAdmin(admin.ModelAdmin):
     list_display = ('title', '_parents_repr')
@@ -15,7 +15,12 @@ class ForumAdmin(admin.ModelAdmin):
     #raw_id_fields = ['allowed_users']
 
 class SubscriptionAdmin(admin.ModelAdmin):
-    list_display = ['author','thread']
+    list_display = ['author','thread','delivery']
+
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('post', 'status', 'created', 'attempts', 'recipients', 'sent_at')
+    list_filter = ('status',)
+    raw_id_fields = ['post']
 
 class ThreadAdmin(admin.ModelAdmin):
     list_display = ('title', 'forum', 'latest_post_time')
@@ -25,3 +30,4 @@ admin.site.register(Forum, ForumAdmin)
 admin.site.register(Thread, ThreadAdmin)
 #admin.site.register(Post)
 admin.site.register(Subscription, SubscriptionAdmin)
+admin.site.register(Notification, NotificationAdmin)
@@ -0,0 +1,260 @@
+"""
+Bulk loading of threads and posts, eg. when migrating from another board.
+
+Every input row is one post. Rows name their thread with the key it has in
+the source data; the first row of a thread creates it and must also carry
+the forum slug and the thread title. Columns:
+
+    thread          key of the thread in the source data (required)
+    author          username of the poster (required)
+    body            Markdown body (required)
+    time            ISO 8601 time of the post, now when missing
+    forum           slug of the forum, for the first row of a thread
+    title           title of the thread, for the first row of a thread
+    sticky, closed  flags of the thread ("1", "true" or "yes")
+
+Posts are inserted with bulk_create() in batches while a process pool
+renders their Markdown. Counters, post pointers and activity statistics
+are not maintained row by row: they are recomputed with a few set-based
+queries once everything is in (see also forum.reconcile), and the search
+index is filled last. Every batch is committed on its own; when a load
+fails, the batches committed before are still recounted and indexed, so
+the board stays consistent with what was loaded.
+
+    >>> from forum.bulkload import BulkLoader, read_jsonl
+    >>> BulkLoader().load(read_jsonl(open('posts.jsonl')))
+"""
+
+import csv
+import json
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from forum import activity, hotness, render, search, stamps
+from forum.models import Forum, Thread, Post, ForumActivity
+from forum.reconcile import Reconciler
+from forum.utils import atomic, deferred_updates
+
+class BulkLoadError(Exception):
+    pass
+
+def read_jsonl(stream):
+    """Yields one row per non-empty line of JSON objects."""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def read_csv(stream):
+    """Yields one row per CSV record; the first line names the columns."""
+    for row in csv.DictReader(stream):
+        yield dict((key, value.decode('utf-8')) for key, value in row.items() if value is not None)
+
+def _parse_time(value):
+    if not value:
+        return timezone.now()
+    when = parse_datetime(value)
+    if when is None:
+        raise BulkLoadError("Invalid time: %r" % value)
+    if getattr(settings, 'USE_TZ', False) and timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.get_default_timezone())
+    return when
+
+def _flag(value):
+    return ('%s' % value).lower() in ('1', 'true', 'yes')
+
+def _count_activity(counts, forum_id, when, posts=0, threads=0):
+    hour = when.replace(minute=0, second=0, microsecond=0)
+    counts = counts.setdefault((forum_id, hour), [0, 0])
+    counts[0] += posts
+    counts[1] += threads
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class BulkLoader(object):
+    def __init__(self, batch_size=1000, processes=None, progress=None):
+        """
+        ``progress`` is called after every batch with the number of rows
+        loaded so far and the throughput in rows per second.
+        """
+        self.batch_size = batch_size
+        self.processes = processes or multiprocessing.cpu_count()
+        self.progress = progress
+        self.rows = 0
+        # Source thread key -> (thread pk, forum pk)
+        self.threads = {}
+        self._forums = {}
+        self._authors = {}
+        # (forum pk, hour) -> [posts, threads]
+        self._activity = {}
+
+    def load(self, rows):
+        """
+        Loads an iterable of row dicts and returns a summary dict with the
+        number of rows, new threads, seconds taken and rows per second.
+        """
+        started = time.time()
+        # Forked workers must not share the parent's database socket.
+        connection.close()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            with deferred_updates():
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        self._load_batch(batch, pool, started)
+                        batch = []
+                if batch:
+                    self._load_batch(batch, pool, started)
+        finally:
+            pool.close()
+            pool.join()
+            self.finish()
+
+        elapsed = time.time() - started
+        return {
+            'rows': self.rows,
+            'threads': len(self.threads),
+            'seconds': elapsed,
+            'rows_per_second': self.rows / max(elapsed, 0.001),
+        }
+
+    def finish(self):
+        """
+        Recounts, ranks and indexes everything loaded so far and drops the
+        caches showing the forums. load() calls it, also when it fails.
+        """
+        thread_ids = sorted(pk for pk, forum_id in self.threads.values())
+        with atomic():
+            self.recount()
+        hotness.rebuild(thread_ids)
+        search.index_threads(thread_ids)
+        lineage = set()
+        for forum in self._forums.values():
+            lineage.update(forum.get_lineage_ids())
+        stamps.touch(None, lineage)
+        activity.buffers.invalidate()
+
+    def _load_batch(self, batch, pool, started):
+        for n, row in enumerate(batch):
+            for column in ('thread', 'author', 'body'):
+                if not row.get(column):
+                    raise BulkLoadError("Row %d has no %s." % (self.rows + n + 1, column))
+
+        authors = self._resolve_authors(set(row['author'] for row in batch))
+        bodies_html = pool.map(render.render_uncached, [row['body'] for row in batch])
+
+        posts = []
+        # Only what the batch committed counts.
+        known, counts = dict(self.threads), {}
+        try:
+            with atomic():
+                for row, body_html in zip(batch, bodies_html):
+                    when = _parse_time(row.get('time'))
+                    thread_id, forum_id = self._get_thread(row, when, counts)
+                    posts.append(Post(thread_id=thread_id, author_id=authors[row['author']],
+                                      body=row['body'], body_html=body_html, time=when))
+                    _count_activity(counts, forum_id, when, posts=1)
+                Post.objects.bulk_create(posts)
+        except Exception:
+            self.threads = known
+            raise
+        for key, (posts, threads) in counts.items():
+            total = self._activity.setdefault(key, [0, 0])
+            total[0] += posts
+            total[1] += threads
+
+        self.rows += len(batch)
+        if self.progress:
+            self.progress(self.rows, self.rows / max(time.time() - started, 0.001))
+
+    def _resolve_authors(self, usernames):
+        missing = [name for name in usernames if name not in self._authors]
+        if missing:
+            self._authors.update(User.objects.filter(username__in=missing).values_list('username', 'pk'))
+        unknown = [name for name in usernames if name not in self._authors]
+        if unknown:
+            raise BulkLoadError("Unknown authors: %s" % ', '.join(sorted(unknown)))
+        return self._authors
+
+    def _get_thread(self, row, when, counts):
+        key = row['thread']
+        if key not in self.threads:
+            if not row.get('forum') or not row.get('title'):
+                raise BulkLoadError("The first row of thread %r needs a forum and a title." % key)
+            if row['forum'] not in self._forums:
+                try:
+                    self._forums[row['forum']] = Forum.objects.get(slug=row['forum'])
+                except Forum.DoesNotExist:
+                    raise BulkLoadError("Unknown forum: %r" % row['forum'])
+            thread = Thread(forum=self._forums[row['forum']], title=row['title'],
+                            sticky=_flag(row.get('sticky')), closed=_flag(row.get('closed')))
+            thread.save()
+            self.threads[key] = (thread.pk, thread.forum_id)
+            _count_activity(counts, thread.forum_id, when, threads=1)
+        return self.threads[key]
+
+    def recount(self):
+        """
+        Brings the counters, post pointers, creation times and activity
+        statistics of everything loaded so far up to date.
+        """
+        thread_ids = sorted(pk for pk, forum_id in self.threads.values())
+        for chunk in _chunks(thread_ids, 1000):
+            recount_threads(chunk, set_create_at=True)
+
+        Reconciler().reconcile_forums()
+
+        for (forum_id, hour), (posts, threads) in self._activity.items():
+            ForumActivity.objects.record(forum_id, hour, posts=posts, threads=threads)
+        self._activity = {}
+
+def recount_threads(thread_ids, set_create_at=False):
+    """
+    Recomputes the post counter, latest post time and post pointers of the
+    given threads with one correlated UPDATE. With ``set_create_at`` the
+    creation time is taken from the first post too.
+    """
+    qn = connection.ops.quote_name
+    thread_table = qn(Thread._meta.db_table)
+    post_table = qn(Post._meta.db_table)
+    post_time = qn(Post._meta.get_field('time').column)
+    post_thread = qn(Post._meta.get_field('thread').column)
+    post_author = qn(Post._meta.get_field('author').column)
+    post_pk = qn(Post._meta.pk.column)
+    thread_pk = qn(Thread._meta.pk.column)
+
+    def subquery(select, order=None):
+        sql = 'SELECT %s FROM %s WHERE %s.%s = %s.%s' % (
+            select, post_table, post_table, post_thread, thread_table, thread_pk)
+        if order:
+            sql += ' ORDER BY %s LIMIT 1' % order
+        return '(%s)' % sql
+
+    first = '%s, %s' % (post_time, post_pk)
+    last = '%s DESC, %s DESC' % (post_time, post_pk)
+    columns = [
+        ('posts', subquery('COUNT(*)')),
+        ('latest_post_time', subquery('MAX(%s)' % post_time)),
+        ('first_post', subquery(post_pk, first)),
+        ('last_post', subquery(post_pk, last)),
+        ('last_poster', subquery(post_author, last)),
+    ]
+    if set_create_at:
+        columns.append(('create_at', subquery('MIN(%s)' % post_time)))
+
+    sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+        thread_table,
+        ', '.join('%s = %s' % (qn(Thread._meta.get_field(name).column), value) for name, value in columns),
+        thread_pk,
+        ', '.join(['%s'] * len(thread_ids)))
+    connection.cursor().execute(sql, list(thread_ids))
@@ -1,14 +1,54 @@
+"""
+RSS and Atom feeds of the whole board, of a forum and of a thread.
+
+Feed readers poll a lot, so every feed carries an ETag and Last-Modified
+taken from the change stamp of what it shows (see forum.stamps). A
+conditional request that still matches is answered with 304 Not
+Modified from the cache alone, and the rendered XML is cached per host
+until the stamp changes. Feeds are shared by everybody and so only show
+forums open to anonymous users; anything else is a 404, also to
+conditional requests. The board feed is also keyed on the permissions
+of the forums, whose changes touch the board stamp as well.
+"""
+
+import hashlib
+
 from django.conf import settings
 from django.contrib.syndication.views import Feed
 from django.contrib.syndication.views import FeedDoesNotExist
 from django.utils.feedgenerator import Atom1Feed,Rss201rev2Feed
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext as _
 
+from forum import stamps
+from forum.forumtree import tree as forumtree
 from forum.models import Forum, Thread, Post
 
+FORUM_FEED_CACHE_TIMEOUT = getattr(settings, 'FORUM_FEED_CACHE_TIMEOUT', 60 * 60 * 24)
+FORUM_FEED_ITEMS = getattr(settings, 'FORUM_FEED_ITEMS', 15)
+
+FEED_KEY = 'forum:feed:%s:%s:%s'
+
+def _public_ids():
+    return Forum.objects.accessible_ids(None)
+
+def _latest_post_time(threads):
+    return threads.aggregate(latest=Max('latest_post_time'))['latest']
+
+def _not_modified(request, etag, modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return since is not None and modified <= since
+
 class ExtendedRSSFeed(Rss201rev2Feed):
     mime_type = 'application/xml'
     """
@@ -24,16 +64,47 @@ class RssForumFeed(Feed):
     title_template = 'forum/feeds/post_title.html'
     description_template = 'forum/feeds/post_description.html'
 
-    def get_object(self, request, forum):
-        if len(forum) == 0:
-            return None
+    def __call__(self, request, *args, **kwargs):
+        # Checks that the feed exists and is public before anything else.
+        name, (modified, token) = self.stamp(**kwargs)
+        # The items link to absolute URLs of the host asked for.
+        host = '%s://%s' % (request.is_secure() and 'https' or 'http', request.get_host())
+        etag = '"%s"' % hashlib.md5('%s:%s:%s:%s' % (self.__class__.__name__, host, name, token)).hexdigest()
+        if _not_modified(request, etag, modified):
+            response = HttpResponseNotModified()
         else:
-            try:
-                f = Forum.objects.get(slug__exact=forum)
-            except Forum.DoesNotExist:
-                return None
-            else:
-                return f
+            key = FEED_KEY % (self.__class__.__name__, hashlib.md5(host).hexdigest(), name)
+            cached = cache.get(key)
+            if cached is None or cached[0] != token:
+                response = super(RssForumFeed, self).__call__(request, *args, **kwargs)
+                cached = (token, response.content, response['Content-Type'])
+                cache.set(key, cached, FORUM_FEED_CACHE_TIMEOUT)
+            response = HttpResponse(cached[1], content_type=cached[2])
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(modified)
+        return response
+
+    def stamp(self, forum=''):
+        """
+        Returns the name of what the feed shows and its change stamp, or
+        raises Http404 when there is no such public feed.
+        """
+        if not forum:
+            # Which forums are public changes what the board feed shows.
+            return 'board:%s' % Forum.objects.acl_version(), stamps.get(
+                'board', 0, lambda: _latest_post_time(Thread.objects.all()))
+        pk = forumtree.lookup(forum)
+        if pk is None or pk not in _public_ids():
+            raise Http404
+        return 'forum:%d' % pk, stamps.get('forum', pk, lambda: _latest_post_time(Thread.objects.filter(forum=pk)))
+
+    def get_object(self, request, forum=''):
+        if not forum:
+            return None
+        pk = forumtree.lookup(forum)
+        if pk is None or pk not in _public_ids():
+            raise Forum.DoesNotExist
+        return Forum.objects.get(pk=pk)
 
     def title(self, obj):
         if not hasattr(self, '_site'):
@@ -59,13 +130,14 @@ class RssForumFeed(Feed):
             return reverse('forum_index')
 
     def get_query_set(self, obj):
+        posts = Post.objects.select_related('thread')
         if obj:
-            return Post.objects.filter(thread__forum__pk=obj.id).order_by('-time')
+            return posts.filter(thread__forum__pk=obj.id).order_by('-time')
         else:
-            return Post.objects.order_by('-time')
+            return posts.filter(thread__forum__in=_public_ids()).order_by('-time')
 
     def items(self, obj):
-        return self.get_query_set(obj)[:15]
+        return self.get_query_set(obj)[:FORUM_FEED_ITEMS]
 
     def item_pubdate(self, item):
         return item.time
@@ -76,3 +148,37 @@ class AtomForumFeed(RssForumFeed):
 
     def subtitle(self, obj):
         return RssForumFeed.description(self, obj)
+
+class RssThreadFeed(RssForumFeed):
+    def stamp(self, thread):
+        forum_ids = list(Thread.objects.filter(pk=thread).values_list('forum', flat=True))
+        if not forum_ids or forum_ids[0] not in _public_ids():
+            raise Http404
+        return 'thread:%s' % thread, stamps.get('thread', int(thread),
+                                                lambda: _latest_post_time(Thread.objects.filter(pk=thread)))
+
+    def get_object(self, request, thread):
+        obj = Thread.objects.get(pk=thread)
+        if obj.forum_id not in _public_ids():
+            raise Thread.DoesNotExist
+        return obj
+
+    def title(self, obj):
+        if not hasattr(self, '_site'):
+            self._site = Site.objects.get_current()
+        return _("%(title)s's Forum: %(thread)s") % {'title': self._site.name, 'thread': obj}
+
+    def description(self, obj):
+        return _('Latest posts of %(thread)s') % {'thread': obj}
+
+    def link(self, obj):
+        return obj.get_absolute_url()
+
+    def get_query_set(self, obj):
+        return obj.post_set.select_related('thread').order_by('-time', '-id')
+
+class AtomThreadFeed(RssThreadFeed):
+    feed_type = Atom1Feed
+
+    def subtitle(self, obj):
+        return RssThreadFeed.description(self, obj)
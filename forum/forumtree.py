@@ -0,0 +1,126 @@
+"""
+A per-process cache of the forum tree used for URLs and breadcrumbs.
+
+Every process keeps the slug, title and URL path of each forum in memory,
+tagged with the tree version stamp it was built from. The stamp lives in
+the cache backend and is replaced whenever a Forum is saved or deleted
+and the change committed, so all workers notice it. The stamp is looked up at most once per
+request; after that, get_absolute_url() and get_url_name() are plain
+dictionary lookups.
+"""
+
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+
+from forum.utils import CACHE_FOREVER, on_commit
+
+VERSION_KEY = 'forum:tree:version'
+
+class ForumTree(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = False
+        self._nodes = {}
+        self._slugs = {}
+
+    def _current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def _build(self, version):
+        from forum.models import Forum
+
+        index_url = reverse('forum_index')
+        rows = dict((pk, (parent_id, slug, title)) for pk, parent_id, slug, title in
+                    Forum.objects.values_list('pk', 'parent_id', 'slug', 'title'))
+        nodes = {}
+
+        def resolve(pk):
+            if pk not in nodes:
+                parent_id, slug, title = rows[pk]
+                if parent_id in rows:
+                    slugs, titles, urls = resolve(parent_id)
+                    parent_url = urls[-1]
+                else:
+                    slugs, titles, urls = (), (), ()
+                    parent_url = index_url
+                nodes[pk] = (slugs + (slug,), titles + (title,), urls + ('%s%s/' % (parent_url, slug),))
+            return nodes[pk]
+
+        for pk in rows:
+            resolve(pk)
+
+        slugs = dict((slug, pk) for pk, (parent_id, slug, title) in rows.items())
+        with self._lock:
+            self._nodes = nodes
+            self._slugs = slugs
+            self._version = version
+            self._checked = True
+
+    def expire(self, **kwargs):
+        """Makes the next lookup compare against the shared version stamp."""
+        self._checked = False
+
+    def invalidate(self, **kwargs):
+        """
+        Drops every process's copy of the tree. The other processes are
+        told once the change is committed: before, they would build the
+        tree from the old rows again and keep it under the new stamp.
+        """
+        self._drop()
+        on_commit(self._replace_version)
+
+    def _drop(self):
+        with self._lock:
+            self._version = None
+            self._checked = False
+
+    def _replace_version(self):
+        cache.set(VERSION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+        self._drop()
+
+    def _check(self):
+        if not self._checked:
+            version = self._current_version()
+            if version != self._version:
+                self._build(version)
+            self._checked = True
+
+    def lookup(self, slug):
+        """Returns the pk of the forum with the slug, or None."""
+        self._check()
+        return self._slugs.get(slug)
+
+    def get(self, forum):
+        """
+        Returns the (slugs, titles, urls) tuples from the root down to and
+        including the forum.
+        """
+        self._check()
+
+        node = self._nodes.get(forum.pk)
+        if node is None and forum.pk:
+            # Created by another process since our last check.
+            self._build(self._current_version())
+            node = self._nodes.get(forum.pk)
+        if node is None:
+            # Not saved yet, so not part of the tree.
+            ancestors = list(forum.get_ancestors()) + [forum]
+            urls, url = [], reverse('forum_index')
+            for f in ancestors:
+                url = '%s%s/' % (url, f.slug)
+                urls.append(url)
+            node = (tuple(f.slug for f in ancestors), tuple(f.title for f in ancestors), tuple(urls))
+        return node
+
+tree = ForumTree()
+
+request_started.connect(tree.expire, dispatch_uid='forum.forumtree.expire')
@@ -0,0 +1,94 @@
+"""
+Time-decayed "hot" ranking of threads.
+
+A thread's hotness is the sum of the weights of its posts and views, each
+decayed by half every FORUM_HOT_HALF_LIFE seconds since it happened. All
+scores decay at the same rate, so instead of shrinking every score as
+time passes, new events are weighted up: an event at time t adds
+weight * e^(t / tau). The Thread.hotness column stores the logarithm of
+that sum, which stays a small float and only ever grows:
+
+    hotness' = logaddexp(hotness, log(weight) + t / tau)
+
+Ordering threads by the column is ordering them by decayed activity, at
+any time, so a hot listing is a plain top-N read of the (forum, hotness)
+or hotness index. Post.save() adds replies, and the view counter adds
+views when it flushes.
+"""
+
+import math
+
+from django.conf import settings
+
+from forum.stamps import epoch
+
+FORUM_HOT_HALF_LIFE = getattr(settings, 'FORUM_HOT_HALF_LIFE', 12 * 60 * 60)
+FORUM_HOT_POST_WEIGHT = getattr(settings, 'FORUM_HOT_POST_WEIGHT', 1.0)
+FORUM_HOT_VIEW_WEIGHT = getattr(settings, 'FORUM_HOT_VIEW_WEIGHT', 0.05)
+
+TAU = FORUM_HOT_HALF_LIFE / math.log(2)
+
+# Thread ids per query when rebuilding.
+BATCH_SIZE = 500
+
+def logaddexp(a, b):
+    """log(e^a + e^b) without overflowing."""
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+def event(weight, when):
+    """The log-space score of an event of ``weight`` at ``when``."""
+    return math.log(weight) + epoch(when) / TAU
+
+def add(hotness, weight, when):
+    """The hotness after an event, from the hotness before it."""
+    if weight <= 0:
+        return hotness
+    if not hotness:
+        # Nothing happened yet.
+        return event(weight, when)
+    return logaddexp(hotness, event(weight, when))
+
+def record_post(thread, when):
+    """
+    Adds a reply to a thread's hotness. Must run in the transaction that
+    already updated the thread row, so the row is locked meanwhile.
+    """
+    from forum.models import Thread
+    current = Thread.objects.filter(pk=thread.pk).values_list('hotness', flat=True)[0]
+    thread.hotness = add(current, FORUM_HOT_POST_WEIGHT, when)
+    Thread.objects.filter(pk=thread.pk).update(hotness=thread.hotness)
+
+def record_views(counts, when):
+    """
+    Adds {thread_id: views} seen up to ``when``, within a transaction.
+    The rows are locked in pk order, so that concurrent flushes wait for
+    each other rather than deadlock, and written with one UPDATE per batch.
+    """
+    from forum.models import Thread
+    from forum.reconcile import batch_update
+    thread_ids = sorted(counts)
+    for i in range(0, len(thread_ids), BATCH_SIZE):
+        rows = (Thread.objects.select_for_update().filter(pk__in=thread_ids[i:i + BATCH_SIZE])
+                .order_by('pk').values_list('pk', 'hotness'))
+        batch_update(Thread, 'hotness', dict(
+            (pk, add(current, FORUM_HOT_VIEW_WEIGHT * counts[pk], when)) for pk, current in rows))
+
+def rebuild(thread_ids):
+    """
+    Computes the hotness of threads from their posts, eg. for threads
+    created before hotness existed or loaded in bulk. Views have no time
+    of their own; they are counted at the thread's latest post.
+    """
+    from forum.models import Thread, Post
+    from forum.reconcile import batch_update
+    thread_ids = list(thread_ids)
+    for i in range(0, len(thread_ids), BATCH_SIZE):
+        batch = thread_ids[i:i + BATCH_SIZE]
+        scores = dict((pk, 0) for pk in batch)
+        for thread_id, when in Post.objects.filter(thread__in=batch, time__isnull=False).values_list('thread', 'time'):
+            scores[thread_id] = add(scores[thread_id], FORUM_HOT_POST_WEIGHT, when)
+        for pk, views, latest in Thread.objects.filter(pk__in=batch).values_list('pk', 'views', 'latest_post_time'):
+            if views and latest:
+                scores[pk] = add(scores[pk], FORUM_HOT_VIEW_WEIGHT * views, latest)
+        batch_update(Thread, 'hotness', scores)
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from forum import viewcounter
+
+class Command(NoArgsCommand):
+    help = ("Writes the buffered thread view counts to the database. "
+            "Only useful with a shared buffer such as forum.viewcounter.CacheBuffer.")
+
+    def handle_noargs(self, **options):
+        counts = viewcounter.flush()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Flushed %d views over %d threads.\n" % (sum(counts.values()), len(counts)))
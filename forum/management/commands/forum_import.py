@@ -0,0 +1,59 @@
+import codecs
+import multiprocessing
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum.bulkload import BulkLoader, BulkLoadError, read_csv, read_jsonl
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Bulk loads posts (and the threads they belong to) from a JSON lines "
+            "or CSV file, or from standard input when the file is '-'. See "
+            "forum.bulkload for the columns.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=['jsonl', 'csv'],
+                    help='Input format; guessed from the file name when omitted.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of posts inserted at a time.'),
+        make_option('--processes', type='int', dest='processes', default=multiprocessing.cpu_count(),
+                    help='Number of worker processes rendering Markdown.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give exactly one input file.')
+        path = args[0]
+        verbosity = int(options.get('verbosity', 1))
+
+        input_format = options['format']
+        if not input_format:
+            input_format = path.endswith('.csv') and 'csv' or 'jsonl'
+
+        if path == '-':
+            stream = sys.stdin
+        elif input_format == 'csv':
+            stream = open(path, 'rb')
+        else:
+            stream = codecs.open(path, 'r', 'utf-8')
+        reader = input_format == 'csv' and read_csv or read_jsonl
+
+        def progress(rows, rate):
+            if verbosity > 0:
+                self.stdout.write("%d rows, %.0f rows/s\n" % (rows, rate))
+
+        loader = BulkLoader(batch_size=options['batch_size'], processes=options['processes'],
+                            progress=progress)
+        try:
+            summary = loader.load(reader(stream))
+        except BulkLoadError as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if verbosity > 0:
+            self.stdout.write("Loaded %(rows)d posts in %(threads)d new threads in %(seconds).1fs "
+                              "(%(rows_per_second).0f rows/s).\n" % summary)
@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum import hotness
+from forum.models import Thread
+
+class Command(BaseCommand):
+    help = ("Computes the hot ranking score of every thread from its posts, eg. for "
+            "threads created before the score existed.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=hotness.BATCH_SIZE,
+                    help='Number of threads scored at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        last_pk = 0
+        done = 0
+        started = time.time()
+        while True:
+            thread_ids = list(Thread.objects.filter(pk__gt=last_pk).order_by('pk')
+                              .values_list('pk', flat=True)[:batch_size])
+            if not thread_ids:
+                break
+            hotness.rebuild(thread_ids)
+            last_pk = thread_ids[-1]
+            done += len(thread_ids)
+            if verbosity > 1:
+                self.stdout.write("%d threads, last id %d\n" % (done, last_pk))
+
+        if verbosity > 0:
+            self.stdout.write("Scored %d threads in %.1fs.\n" % (done, time.time() - started))
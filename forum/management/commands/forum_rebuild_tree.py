@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from forum.models import Forum
+
+class Command(NoArgsCommand):
+    help = "Recomputes the materialized path of every forum from its parent links."
+
+    def handle_noargs(self, **options):
+        updated = Forum.objects.rebuild_paths()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Updated the path of %d forums.\n" % updated)
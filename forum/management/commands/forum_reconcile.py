@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum.models import Forum
+from forum.reconcile import Reconciler
+
+class Command(BaseCommand):
+    args = '[forum-slug ...]'
+    help = ("Recomputes the post/thread counters, post pointers and latest post "
+            "times of threads and forums, and writes the ones that drifted. "
+            "Only the threads of the given forums are checked when slugs are given.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report the differences without writing them.'),
+        make_option('--parallel', type='int', dest='parallel', default=1,
+                    help='Number of forums whose threads are checked at the same time.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        forums = None
+        if args:
+            forums = list(Forum.objects.filter(slug__in=args))
+            missing = set(args) - set(f.slug for f in forums)
+            if missing:
+                raise CommandError('Unknown forums: %s' % ', '.join(sorted(missing)))
+
+        reconciler = Reconciler(dry_run=options['dry_run'], verbose=verbosity > 1)
+        changed = reconciler.reconcile(forums=forums, parallel=max(1, options['parallel']))
+
+        for model_name, pk, name, old, new in reconciler.diffs:
+            self.stdout.write("%s %s %s: %r -> %r\n" % (model_name, pk, name, old, new))
+        if verbosity > 0:
+            if not changed:
+                self.stdout.write("All counters are up to date.\n")
+            for (model_name, name), count in sorted(changed.items()):
+                self.stdout.write("%s.%s: %d rows %s\n" % (
+                    model_name, name, count, options['dry_run'] and 'differ' or 'fixed'))
@@ -0,0 +1,87 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from forum import render, stamps
+from forum.models import Forum, Post
+from forum.utils import CACHE_FOREVER, atomic
+
+CHECKPOINT_KEY = 'forum:rerender:checkpoint:%s' % render.RENDERER_VERSION
+
+class Command(BaseCommand):
+    help = ("Renders the body of every post again with the current Markdown "
+            "settings and stores the HTML that changed.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Number of posts read, rendered and written at a time.'),
+        make_option('--processes', type='int', dest='processes', default=multiprocessing.cpu_count(),
+                    help='Number of worker processes rendering the bodies.'),
+        make_option('--start-after', type='int', dest='start_after', default=0,
+                    help='Only render the posts with a higher id.'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Continue after the last post an interrupted run finished.'),
+    )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        verbosity = int(options.get('verbosity', 1))
+        if chunk_size < 1 or options['processes'] < 1:
+            raise CommandError('--chunk-size and --processes must be positive.')
+
+        last_pk = options['start_after']
+        if options['resume']:
+            last_pk = max(last_pk, cache.get(CHECKPOINT_KEY, 0))
+
+        total = Post.objects.filter(pk__gt=last_pk).count()
+        done = changed = 0
+        started = time.time()
+        render_seconds = 0.0
+
+        # Forked workers must not share the parent's database socket.
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            while True:
+                rows = list(Post.objects.filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', 'body', 'body_html', 'thread', 'thread__forum')[:chunk_size])
+                if not rows:
+                    break
+
+                render_started = time.time()
+                html = pool.map(render.render_uncached, [row[1] for row in rows])
+                render_seconds += time.time() - render_started
+                # {thread pk: forum pk} of the posts rewritten
+                threads = {}
+                with atomic():
+                    for (pk, body, old, thread_id, forum_id), new in zip(rows, html):
+                        # A post edited meanwhile already has the HTML of
+                        # its new body.
+                        if new != old and Post.objects.filter(pk=pk, body=body).update(body_html=new):
+                            threads[thread_id] = forum_id
+                            changed += 1
+                # Cached pages and feeds show the old HTML.
+                lineages = dict((forum.pk, forum.get_lineage_ids()) for forum in
+                                Forum.objects.filter(pk__in=set(threads.values())))
+                for thread_id, forum_id in threads.items():
+                    stamps.touch(thread_id, lineages.get(forum_id, ()))
+
+                last_pk = rows[-1][0]
+                done += len(rows)
+                cache.set(CHECKPOINT_KEY, last_pk, CACHE_FOREVER)
+                if verbosity > 0:
+                    elapsed = time.time() - started
+                    self.stdout.write("%d/%d posts, %d changed, %.0f posts/s, last id %d\n" % (
+                        done, total, changed, done / max(elapsed, 0.001), last_pk))
+        finally:
+            pool.close()
+            pool.join()
+
+        cache.delete(CHECKPOINT_KEY)
+        if verbosity > 0:
+            self.stdout.write("Rendered %d posts in %.1fs (%.1fs rendering), %d changed.\n" % (
+                done, time.time() - started, render_seconds, changed))
@@ -0,0 +1,47 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum import search
+from forum.models import Thread
+
+class Command(BaseCommand):
+    help = ("Indexes the titles and posts of all threads with the configured "
+            "search backend (FORUM_SEARCH_BACKEND).")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help='Empty the index first, eg. to rebuild it from scratch.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of threads indexed at a time.'),
+        make_option('--start-after', type='int', dest='start_after', default=0,
+                    help='Only index the threads with a higher id.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        if options['clear']:
+            search.backend.clear()
+
+        last_pk = options['start_after']
+        done = 0
+        started = time.time()
+        while True:
+            thread_ids = list(Thread.objects.filter(pk__gt=last_pk).order_by('pk')
+                              .values_list('pk', flat=True)[:batch_size])
+            if not thread_ids:
+                break
+            search.index_threads(thread_ids)
+            last_pk = thread_ids[-1]
+            done += len(thread_ids)
+            if verbosity > 0:
+                self.stdout.write("%d threads, %.0f threads/s, last id %d\n" % (
+                    done, done / max(time.time() - started, 0.001), last_pk))
+
+        if verbosity > 0:
+            self.stdout.write("Indexed %d threads in %.1fs.\n" % (done, time.time() - started))
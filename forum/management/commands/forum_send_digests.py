@@ -0,0 +1,26 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum import notifications
+from forum.models import Subscription
+
+PERIODS = {
+    'daily': (Subscription.DAILY, datetime.timedelta(days=1)),
+    'weekly': (Subscription.WEEKLY, datetime.timedelta(days=7)),
+}
+
+class Command(BaseCommand):
+    args = 'daily|weekly'
+    help = ("Mails one digest of the new replies in their threads to every subscriber "
+            "in daily or weekly mode. Run it from cron once per period.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in PERIODS:
+            raise CommandError('Usage: forum_send_digests %s' % self.args)
+        delivery, period = PERIODS[args[0]]
+        started = time.time()
+        sent = notifications.send_digests(delivery, period)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Sent %d %s digests in %.1fs.\n" % (sent, args[0], time.time() - started))
@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from forum import notifications
+
+class Command(NoArgsCommand):
+    help = ("Mails queued reply notifications to thread subscribers. Run it from "
+            "cron, or keep it running with --loop.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=notifications.FORUM_NOTIFY_WORKERS,
+                    help='Number of threads sending mail, each over its own connection.'),
+        make_option('--limit', type='int', dest='limit', default=100,
+                    help='Number of notifications claimed at a time.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep polling the queue instead of exiting once it is empty.'),
+        make_option('--interval', type='float', dest='interval', default=5,
+                    help='Seconds to wait between polls of an empty queue with --loop.'),
+        make_option('--metrics', action='store_true', dest='metrics', default=False,
+                    help='Only print the delivery counters.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['metrics']:
+            for name, value in sorted(notifications.metrics().items()):
+                self.stdout.write("%s: %d\n" % (name, value))
+            return
+        if options['limit'] < 1 or options['workers'] < 1:
+            raise CommandError('--limit and --workers must be positive.')
+
+        mailer = notifications.Mailer(options['workers'])
+        try:
+            while True:
+                started = time.time()
+                stats = mailer.process(options['limit'])
+                handled = stats['notifications'] + stats['retries'] + stats['failures']
+                if verbosity > 0 and handled:
+                    self.stdout.write("%d sent (%d mails to %d recipients), %d to retry, %d failed in %.1fs\n" % (
+                        stats['notifications'], stats['messages'], stats['recipients'],
+                        stats['retries'], stats['failures'], time.time() - started))
+                if handled < options['limit']:
+                    if not options['loop']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            mailer.close()
@@ -0,0 +1,117 @@
+import glob
+import gzip
+import os
+import time
+from optparse import make_option
+from xml.sax.saxutils import escape
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from forum.sitemap import sitemaps
+
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+class SectionWriter(object):
+    """Writes the URLs of a section to gzipped files of ``limit`` URLs each."""
+    def __init__(self, directory, section, limit):
+        self.directory = directory
+        self.section = section
+        self.limit = limit
+        self.names = []
+        self._file = None
+        self._count = 0
+
+    def _open(self):
+        name = 'sitemap-%s-%d.xml.gz' % (self.section, len(self.names) + 1)
+        self.names.append(name)
+        self._path = os.path.join(self.directory, name)
+        self._file = gzip.open(self._path + '.tmp', 'wb')
+        self._file.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % XMLNS)
+        self._count = 0
+
+    def _close(self):
+        self._file.write('</urlset>\n')
+        self._file.close()
+        os.rename(self._path + '.tmp', self._path)
+        self._file = None
+
+    def write(self, location, lastmod=None, changefreq=None, priority=None):
+        if self._file is None:
+            self._open()
+        entry = ['<url><loc>%s</loc>' % escape(location)]
+        if lastmod:
+            entry.append('<lastmod>%s</lastmod>' % lastmod.strftime('%Y-%m-%d'))
+        if changefreq:
+            entry.append('<changefreq>%s</changefreq>' % changefreq)
+        if priority:
+            entry.append('<priority>%s</priority>' % priority)
+        entry.append('</url>\n')
+        self._file.write(''.join(entry).encode('utf-8'))
+        self._count += 1
+        if self._count >= self.limit:
+            self._close()
+
+    def close(self):
+        if self._file is not None:
+            self._close()
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ("Writes the forum sitemaps as static gzipped files plus a sitemap.xml "
+            "index into a directory, for the web server to serve.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--base-url', dest='base_url', default=None,
+                    help='Scheme and host of the URLs, eg. http://example.com (default: the current Site).'),
+        make_option('--files-url', dest='files_url', default=None,
+                    help='URL the directory is served under (default: the base URL).'),
+        make_option('--limit', type='int', dest='limit', default=50000,
+                    help='Number of URLs per file.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: forum_sitemaps %s' % self.args)
+        directory = args[0]
+        if not os.path.isdir(directory):
+            raise CommandError('%s is not a directory.' % directory)
+        if options['limit'] < 1:
+            raise CommandError('--limit must be positive.')
+        verbosity = int(options.get('verbosity', 1))
+
+        base_url = (options['base_url'] or 'http://%s' % Site.objects.get_current().domain).rstrip('/')
+        files_url = (options['files_url'] or base_url).rstrip('/')
+        started = time.time()
+
+        names = []
+        for section, sitemap_class in sorted(sitemaps.items()):
+            sitemap = sitemap_class()
+            writer = SectionWriter(directory, section, options['limit'])
+            count = 0
+            for item in sitemap.items():
+                writer.write(base_url + sitemap.location(item),
+                             lastmod=sitemap.lastmod(item),
+                             changefreq=getattr(sitemap, 'changefreq', None),
+                             priority=getattr(sitemap, 'priority', None))
+                count += 1
+            writer.close()
+            names.extend(writer.names)
+            if verbosity > 0:
+                self.stdout.write("%s: %d URLs in %d files\n" % (section, count, len(writer.names)))
+
+        index = os.path.join(directory, 'sitemap.xml')
+        with open(index + '.tmp', 'wb') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="%s">\n' % XMLNS)
+            for name in names:
+                f.write('<sitemap><loc>%s</loc></sitemap>\n' % escape('%s/%s' % (files_url, name)))
+            f.write('</sitemapindex>\n')
+        os.rename(index + '.tmp', index)
+
+        # Files of sections that shrank since the last run.
+        for path in glob.glob(os.path.join(directory, 'sitemap-*.xml.gz')):
+            if os.path.basename(path) not in names:
+                os.remove(path)
+
+        if verbosity > 0:
+            self.stdout.write("Wrote %d sitemap files in %.1fs.\n" % (len(names), time.time() - started))
@@ -1,23 +1,204 @@
-from django.db import models
-from django.db.models import Q
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, IntegrityError
+from django.db.models import F, Q
+
+from forum import stamps
+from forum.forumtree import tree as forumtree
+from forum.utils import CACHE_FOREVER, atomic, on_commit
+
+FORUM_ACL_CACHE_TIMEOUT = getattr(settings, 'FORUM_ACL_CACHE_TIMEOUT', 60 * 60)
+
+ACL_VERSION_KEY = 'forum:acl:version'
 
 class ForumManager(models.Manager):
-    def for_user(self, user):
+    def acl_version(self):
+        """A stamp replaced whenever forum permissions change."""
+        version = cache.get(ACL_VERSION_KEY)
+        if version is None:
+            cache.add(ACL_VERSION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+            version = cache.get(ACL_VERSION_KEY)
+        return version
+
+    def invalidate_access(self, **kwargs):
+        """
+        Forgets every cached set of accessible forums. Connected to the
+        Forum save/delete and allowed_users/groups m2m_changed signals.
+
+        The stamp is replaced once more after the change commits: until
+        then, other requests still read the old permissions and would
+        cache them under the new stamp.
+        """
+        self._replace_acl_version()
+        on_commit(self._replace_acl_version)
+
+    def _replace_acl_version(self):
+        cache.set(ACL_VERSION_KEY, uuid.uuid4().hex, CACHE_FOREVER)
+        # The board feed shows the posts of the public forums: readers
+        # that only send If-Modified-Since must not get a 304 now.
+        stamps.touch()
+
+    def _cached_ids(self, key, compute):
+        key = 'forum:acl:%s:%s' % (self.acl_version(), key)
+        ids = cache.get(key)
+        if ids is None:
+            ids = frozenset(compute())
+            cache.set(key, ids, FORUM_ACL_CACHE_TIMEOUT)
+        return ids
+
+    def accessible_ids(self, user):
+        """
+        The set of pks of the forums a user may see: the unrestricted ones
+        plus those listing the user in allowed_users. Cached per user, and
+        on the user object for the rest of the request.
+        """
+        if getattr(user, '_forum_accessible_ids', None) is not None:
+            return user._forum_accessible_ids
+
+        # Always query through the plain manager, also when called on a
+        # related manager such as forum.child.
+        forums = self.model._default_manager
         if user and user.is_authenticated():
-            public_query = Q(allowed_users__isnull=True)
-            user_query   = Q(allowed_users=user)
-            return self.filter(public_query|user_query).distinct()
-        return self.filter(allowed_users__isnull=True)
+            ids = self._cached_ids('user:%d' % user.pk, lambda: forums.filter(
+                Q(allowed_users__isnull=True) | Q(allowed_users=user)).values_list('pk', flat=True))
+        else:
+            ids = self._cached_ids('public', lambda: forums.filter(
+                allowed_users__isnull=True).values_list('pk', flat=True))
+
+        if user is not None:
+            user._forum_accessible_ids = ids
+        return ids
+
+    def group_accessible_ids(self, groups):
+        """
+        The set of pks of the forums open to any of the groups (Group
+        objects or pks) or to no group in particular. Cached per set of
+        groups.
+        """
+        forums = self.model._default_manager
+        group_ids = sorted(set(getattr(g, 'pk', g) for g in groups or []))
+        if group_ids:
+            return self._cached_ids('groups:%s' % ','.join(map(str, group_ids)), lambda: forums.filter(
+                Q(groups__isnull=True) | Q(groups__in=group_ids)).values_list('pk', flat=True))
+        return self._cached_ids('nogroups', lambda: forums.filter(
+            groups__isnull=True).values_list('pk', flat=True))
+
+    def for_user(self, user):
+        return self.filter(pk__in=self.accessible_ids(user))
 
     def for_groups(self, groups):
-        if groups:
-            public_query      = Q(groups__isnull=True)
-            user_groups_query = Q(groups__in=groups)
-            return self.filter(public_query|user_groups_query).distinct()
-        return self.filter(groups__isnull=True)
-    
+        return self.filter(pk__in=self.group_accessible_ids(groups))
+
     def has_access(self, forum, user):
-        return forum in self.for_user(user)
+        return forum.pk in self.accessible_ids(user)
 
     def has_access2(self, forum, groups):
-        return forum in self.for_groups(groups)
+        return forum.pk in self.group_accessible_ids(groups)
+
+    def with_latest_post(self, queryset=None):
+        """
+        Joins the denormalized last post/poster, for forum listings.
+        """
+        if queryset is None:
+            queryset = self.all()
+        return queryset.select_related('last_post', 'last_poster')
+
+    def update_counters(self, forum, threads=0, posts=0, **fields):
+        """
+        Shifts the thread/post counters of a forum and of all its parents,
+        and sets any other given fields, with a single UPDATE so that
+        concurrent writers never lose an update.
+        """
+        changes = dict(fields)
+        if threads:
+            changes['threads'] = F('threads') + threads
+        if posts:
+            changes['posts'] = F('posts') + posts
+        if changes:
+            self.filter(pk__in=forum.get_lineage_ids()).update(**changes)
+
+    def rebuild_paths(self):
+        """
+        Recomputes the materialized path and depth of every forum from the
+        parent links, eg. for forums created before paths existed. Returns
+        the number of forums that were updated.
+        """
+        rows = list(self.values_list('pk', 'parent_id', 'path'))
+        children_of = {}
+        for pk, parent_id, path in rows:
+            children_of.setdefault(parent_id, []).append(pk)
+        old_paths = dict((pk, path) for pk, parent_id, path in rows)
+
+        updated = 0
+        stack = [(pk, '') for pk in children_of.get(None, [])]
+        while stack:
+            pk, parent_path = stack.pop()
+            path = '%s%d/' % (parent_path, pk)
+            if path != old_paths[pk]:
+                self.filter(pk=pk).update(path=path, depth=path.count('/') - 1)
+                updated += 1
+            stack.extend((child, path) for child in children_of.get(pk, []))
+        if updated:
+            forumtree.invalidate()
+        return updated
+
+class ThreadManager(models.Manager):
+    def with_posts(self, queryset=None):
+        """
+        Joins the denormalized first/last post and last poster, for
+        thread listings.
+        """
+        if queryset is None:
+            queryset = self.all()
+        return queryset.select_related('first_post', 'last_post', 'last_poster')
+
+    def hot(self, forum=None, forum_ids=None):
+        """
+        Threads by decayed activity, hottest first: of one forum, or of
+        the forums in ``forum_ids``, or of all. Slice it for a top-N read
+        of the hotness index.
+        """
+        queryset = self.all()
+        if forum is not None:
+            queryset = queryset.filter(forum=forum)
+        elif forum_ids is not None:
+            queryset = queryset.filter(forum__in=forum_ids)
+        return queryset.order_by('-hotness')
+
+    def update_counters(self, thread, posts=0, **fields):
+        """
+        Shifts the post counter of a thread and sets any other given
+        fields (eg. latest_post_time) with a single UPDATE.
+        """
+        changes = dict(fields)
+        if posts:
+            changes['posts'] = F('posts') + posts
+        if changes:
+            self.filter(pk=thread.pk).update(**changes)
+
+class ForumActivityManager(models.Manager):
+    def record(self, forum_id, when, posts=0, threads=0, views=0):
+        """
+        Adds to the activity counters of a forum for the hour of ``when``,
+        creating the hourly bucket on first use.
+        """
+        hour = when.replace(minute=0, second=0, microsecond=0)
+        amounts = {'posts': posts, 'threads': threads, 'views': views}
+        changes = dict((name, F(name) + n) for name, n in amounts.items() if n)
+        if not changes:
+            return
+        if self.filter(forum=forum_id, hour=hour).update(**changes):
+            return
+        if not any(n > 0 for n in amounts.values()):
+            # Removing something older than the buckets; nothing to take
+            # it from.
+            return
+        amounts = dict((name, max(n, 0)) for name, n in amounts.items())
+        try:
+            with atomic():
+                self.create(forum_id=forum_id, hour=hour, **amounts)
+        except IntegrityError:
+            # Another request created the bucket in the meantime.
+            self.filter(forum=forum_id, hour=hour).update(**changes)
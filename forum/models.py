@@ -6,23 +6,17 @@ methods. A little extra logic is in views.py.
 """
 
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import pre_delete, post_save, post_delete, m2m_changed
+from django.core.exceptions import ValidationError
 import datetime
 from django.contrib.auth.models import User, Group
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-from django.utils.html import escape
 from django.utils.text import slugify
 from django.utils import timezone
 from django.core.urlresolvers import reverse
 
-try:
-    from markdown import markdown
-except ImportError:
-    class MarkdownNotFound(Exception):
-        def __str__(self):
-            return "Markdown is not installed!"
-    raise MarkdownNotFound
-
 # attempt to load the django-tagging TagField from default location,
 # otherwise we substitude a dummy TagField.
 try:
@@ -38,7 +32,12 @@ except ImportError:
             return 'CharField'
     tagfield_help_text = _('Django-tagging was not found, tags will be treated as plain text.')
 
-from forum.managers import ForumManager
+from forum.managers import ForumManager, ThreadManager, ForumActivityManager
+from forum.utils import atomic, updates_deferred
+from forum import activity, hotness, render, search, stamps
+from forum.forumtree import tree as forumtree
+
+FORUM_PAGINATION = getattr(settings, 'FORUM_PAGINATION', 10)
 
 class Forum(models.Model):
     """
@@ -46,8 +45,9 @@ class Forum(models.Model):
     and posts fielsd are updated by the save() methods of their
     respective models and are used for display purposes.
 
-    All of the parent/child recursion code here is borrowed directly from
-    the Satchmo project: http://www.satchmoproject.com/
+    The parent/child helpers were borrowed from the Satchmo project
+    (http://www.satchmoproject.com/) and are now backed by a materialized
+    path, see the path field.
     """
 
     title = models.CharField(_("Title"), max_length=100)
@@ -59,59 +59,97 @@ class Forum(models.Model):
     ordering = models.IntegerField(_("Ordering"), blank=True, null=True)
     groups = models.ManyToManyField(Group, blank=True)
     allowed_users = models.ManyToManyField('auth.User',blank=True,related_name="allowed_forums",help_text="Ignore if non-restricted")
+    # Materialized path of pks from the root, eg. "1/4/9/", kept up to date
+    # by save(). Lets ancestors and subtrees be fetched in one query.
+    path = models.CharField(max_length=255, db_index=True, editable=False, blank=True, default='')
+    depth = models.IntegerField(default=0, editable=False)
+    # Newest post anywhere in this forum or below, maintained by Post.
+    last_post = models.ForeignKey('Post', blank=True, null=True, editable=False,
+                                  related_name='+', on_delete=models.SET_NULL)
+    last_poster = models.ForeignKey(User, blank=True, null=True, editable=False,
+                                    related_name='+', on_delete=models.SET_NULL)
 
     objects = ForumManager()
 
+    # Kept up to date with single UPDATEs by threads and posts, and the
+    # path by _move_to(). Saving an existing forum leaves them alone
+    # rather than writing back the in-memory values, which may be stale.
+    COUNTER_FIELDS = ('threads', 'posts', 'last_post', 'last_poster', 'path', 'depth')
+
     def _get_forum_latest_post(self):
         """This gets the latest post for the forum"""
-        if not hasattr(self, '__forum_latest_post'):
-            try:
-                self.__forum_latest_post = Post.objects.filter(thread__forum__pk=self.id).latest("time")
-            except Post.DoesNotExist:
-                self.__forum_latest_post = None
-
-        return self.__forum_latest_post
+        return self.last_post
     forum_latest_post = property(_get_forum_latest_post)
 
+    def refresh_last_post(self):
+        """
+        Points last_post/last_poster at the newest post in this forum or
+        below. Only needed when that post may have gone away.
+        """
+        try:
+            post = Post.objects.filter(thread__forum__path__startswith=self.get_path()).latest('time')
+        except Post.DoesNotExist:
+            post = None
+        self.last_post = post
+        self.last_poster_id = post and post.author_id
+        Forum.objects.filter(pk=self.pk).update(last_post=post, last_poster=self.last_poster_id)
+
     def _get_forum_today_posts(self):
         """This gets the  post count of today for the forum"""
-        if not hasattr(self, '__forum_today_posts'):
-            try:
-                self.__forum_today_posts = Post.objects.filter(thread__forum__pk=self.id).count()
-            except Post.DoesNotExist:
-                self.__forum_today_posts = 0
-
-        return self.__forum_today_posts
+        if not hasattr(self, '_today_posts'):
+            from forum import stats
+            self._today_posts = stats.today(self)['posts']
+        return self._today_posts
     forum_today_posts = property(_get_forum_today_posts)
 
+    def get_path(self):
+        """
+        The materialized path. Forums saved before paths existed have an
+        empty one; the first time one of them is used, the paths of all
+        forums are computed from the parent links.
+        """
+        if self.pk and not self.path:
+            Forum.objects.rebuild_paths()
+            rows = list(Forum.objects.filter(pk=self.pk).values_list('path', 'depth'))
+            if rows:
+                self.path, self.depth = rows[0]
+        return self.path
+
+    def _get_path_ids(self):
+        """The pks along the materialized path, root first."""
+        return [int(pk) for pk in self.get_path().split('/') if pk]
+
+    def get_lineage_ids(self):
+        """
+        Returns the pk of this forum followed by the pks of all its
+        parents, nearest first. Used to keep parent counters in sync.
+        """
+        ids = self._get_path_ids()
+        ids.reverse()
+        return ids
+
+    def get_ancestors(self):
+        """
+        Gets all parents of this forum, root first, in a single query.
+        """
+        return Forum.objects.filter(pk__in=self._get_path_ids()[:-1]).order_by('depth')
+
+    def get_descendants(self):
+        """
+        Gets all forums below this one, at any depth, in a single query.
+        """
+        return Forum.objects.filter(path__startswith=self.get_path()).exclude(pk=self.pk)
+
     def _recurse_for_parents_slug(self, forum_obj):
         #This is used for the urls
-        p_list = []
-        if forum_obj.parent_id:
-            p = forum_obj.parent
-            p_list.append(p.slug)
-            more = self._recurse_for_parents_slug(p)
-            p_list.extend(more)
-        if forum_obj == self and p_list:
-            p_list.reverse()
-        return p_list
+        return list(forumtree.get(forum_obj)[0][:-1])
 
     def get_absolute_url(self):
-        p_list = self._recurse_for_parents_slug(self)
-        p_list.append(self.slug)
-        return '%s%s/' % (reverse('forum_index'), '/'.join (p_list))
+        return forumtree.get(self)[2][-1]
 
     def _recurse_for_parents_name(self, forum_obj):
-        #This is used for the visual display & save validation
-        p_list = []
-        if forum_obj.parent_id:
-            p = forum_obj.parent
-            p_list.append(p.title)
-            more = self._recurse_for_parents_name(p)
-            p_list.extend(more)
-        if forum_obj == self and p_list:
-            p_list.reverse()
-        return p_list
+        #This is used for the visual display
+        return list(forumtree.get(forum_obj)[1][:-1])
 
     def get_separator(self):
         return ' &raquo; '
@@ -123,26 +161,13 @@ class Forum(models.Model):
 
     def _recurse_for_parents_name_url(self, forum__obj):
         #Get all the absolute urls and names (for use in site navigation)
-        p_list = []
-        url_list = []
-        if forum__obj.parent_id:
-            p = forum__obj.parent
-            p_list.append(p.title)
-            url_list.append(p.get_absolute_url())
-            more, url = self._recurse_for_parents_name_url(p)
-            p_list.extend(more)
-            url_list.extend(url)
-        if forum__obj == self and p_list:
-            p_list.reverse()
-            url_list.reverse()
-        return p_list, url_list
+        slugs, titles, urls = forumtree.get(forum__obj)
+        return list(titles[:-1]), list(urls[:-1])
 
     def get_url_name(self):
         #Get a list of the url to display and the actual urls
-        p_list, url_list = self._recurse_for_parents_name_url(self)
-        p_list.append(self.title)
-        url_list.append(self.get_absolute_url())
-        return zip(p_list, url_list)
+        slugs, titles, urls = forumtree.get(self)
+        return zip(titles, urls)
 
     def __unicode__(self):
         return u'%s' % self.title
@@ -152,15 +177,48 @@ class Forum(models.Model):
         verbose_name = _('Forum')
         verbose_name_plural = _('Forums')
 
-    def save(self, force_insert=False, force_update=False):
-        p_list = self._recurse_for_parents_name(self)
-        if (self.title) in p_list:
-            raise validators.ValidationError(_("You must not save a forum in itself!"))
+    def save(self, *args, **kwargs):
+        if self.parent_id and self.pk and (self.parent_id == self.pk or
+                (self.get_path() and self.parent.get_path().startswith(self.path))):
+            raise ValidationError(_("You must not save a forum in itself!"))
 
         if not self.slug:
             self.slug = slugify(self.title)
 
-        super(Forum, self).save(force_insert, force_update)
+        old_path = self.get_path()
+        parent_path = self.parent_id and self.parent.get_path() or ''
+        if self.pk and not args and not kwargs.get('force_insert') and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [f.name for f in self._meta.local_fields
+                                       if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+        with atomic():
+            super(Forum, self).save(*args, **kwargs)
+            path = '%s%d/' % (parent_path, self.pk)
+            if path != old_path:
+                self._move_to(old_path, path)
+
+    def _move_to(self, old_path, path):
+        """
+        Rewrites the materialized path of this forum and of all forums
+        below it, and moves the counters over to the new parents.
+        """
+        self.path, self.depth = path, path.count('/') - 1
+        Forum.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+        if not old_path:
+            return
+
+        # The row is locked by the save; move the stored counters rather
+        # than possibly stale in-memory ones.
+        self.threads, self.posts = Forum.objects.filter(pk=self.pk).values_list('threads', 'posts')[0]
+        for pk, child_path in Forum.objects.filter(path__startswith=old_path).exclude(pk=self.pk).values_list('pk', 'path'):
+            child_path = path + child_path[len(old_path):]
+            Forum.objects.filter(pk=pk).update(path=child_path, depth=child_path.count('/') - 1)
+
+        old_parents = [int(pk) for pk in old_path.split('/') if pk][:-1]
+        new_parents = self._get_path_ids()[:-1]
+        Forum.objects.filter(pk__in=old_parents).update(threads=F('threads') - self.threads,
+                                                        posts=F('posts') - self.posts)
+        Forum.objects.filter(pk__in=new_parents).update(threads=F('threads') + self.threads,
+                                                        posts=F('posts') + self.posts)
 
     def _flatten(self, L):
         """
@@ -171,12 +229,16 @@ class Forum(models.Model):
         return self._flatten(L[0]) + self._flatten(L[1:])
 
     def _recurse_for_children(self, node):
-        children = []
-        children.append(node)
-        for child in node.child.all():
-            children_list = self._recurse_for_children(child)
-            children.append(children_list)
-        return children
+        children_of = {}
+        for forum in node.get_descendants():
+            children_of.setdefault(forum.parent_id, []).append(forum)
+
+        def build(forum_obj):
+            children = [forum_obj]
+            for child in children_of.get(forum_obj.pk, []):
+                children.append(build(child))
+            return children
+        return build(node)
 
     def get_all_children(self):
         """
@@ -204,32 +266,61 @@ class Thread(models.Model):
     tags = TagField(help_text=tagfield_help_text, verbose_name=_('tags'))
     create_at  = models.DateTimeField(_("Thread Create Time"), blank=True, null=True, auto_now_add=True)
     latest_post_time = models.DateTimeField(_("Latest Post Time"), blank=True, null=True)
+    # Log of the time-decayed post and view activity, see forum.hotness.
+    hotness = models.FloatField(_("Hotness"), default=0, db_index=True, editable=False)
+    # Maintained by Post.save()/delete() so listings need no extra queries.
+    first_post = models.ForeignKey('Post', blank=True, null=True, editable=False,
+                                   related_name='+', on_delete=models.SET_NULL)
+    last_post = models.ForeignKey('Post', blank=True, null=True, editable=False,
+                                  related_name='+', on_delete=models.SET_NULL)
+    last_poster = models.ForeignKey(User, blank=True, null=True, editable=False,
+                                    related_name='+', on_delete=models.SET_NULL)
+
+    objects = ThreadManager()
+
+    # Kept up to date with single UPDATEs by posts and the view counter.
+    # Saving an existing thread leaves them alone rather than writing back
+    # the in-memory values, which may be stale.
+    COUNTER_FIELDS = ('posts', 'views', 'latest_post_time', 'hotness', 'first_post', 'last_post', 'last_poster')
+
+    def __init__(self, *args, **kwargs):
+        super(Thread, self).__init__(*args, **kwargs)
+        # Remember where the thread lived so save() can move the counters,
+        # and its title to know when to index it again.
+        self._original_forum_id = self.forum_id
+        self._original_title = self.title
 
     def _get_thread_first_post(self):
-        """This gets the latest post for the thread"""
-        if not hasattr(self, '__thread_first_post'):
-            qs = Post.objects.filter(thread__pk=self.id).order_by("time")
-            if qs.exists():
-                self.__thread_first_post = qs[0]
-            else:
-                self.__thread_first_post = None
-
-        return self.__thread_first_post
+        """This gets the first post for the thread"""
+        return self.first_post
     thread_first_post = property(_get_thread_first_post)
 
     def _get_thread_latest_post(self):
         """This gets the latest post for the thread"""
-        if not hasattr(self, '__thread_latest_post'):
-            try:
-                self.__thread_latest_post = Post.objects.filter(thread__pk=self.id).latest("time")
-            except Post.DoesNotExist:
-                self.__thread_latest_post = None
-
-        return self.__thread_latest_post
+        return self.last_post
     thread_latest_post = property(_get_thread_latest_post)
 
+    def _post_pointer_fields(self, first=False, last=False):
+        """
+        Looks up the first and/or last remaining post of the thread and
+        returns the field values to store for them.
+        """
+        fields = {}
+        if first:
+            posts = list(self.post_set.order_by('time', 'id')[:1])
+            fields['first_post'] = posts and posts[0] or None
+        if last:
+            posts = list(self.post_set.order_by('-time', '-id')[:1])
+            post = posts and posts[0] or None
+            fields['last_post'] = post
+            fields['last_poster'] = post and post.author_id
+            fields['latest_post_time'] = post and post.time
+        return fields
+
     class Meta:
         ordering = ('-sticky', '-latest_post_time')
+        # Serves the keyset pagination of forum.pagination.
+        index_together = [('forum', 'sticky', 'latest_post_time', 'id'), ('forum', 'hotness')]
         verbose_name = _('Thread')
         verbose_name_plural = _('Threads')
 
@@ -237,19 +328,71 @@ class Thread(models.Model):
         if not self.slug:
             self.slug = slugify(self.title)
 
-        f = self.forum
-        f.threads = f.thread_set.count()
-        f.save()
         if not self.sticky:
             self.sticky = False
-        super(Thread, self).save(*args,**kwargs)
+
+        created = not self.pk
+        moved = not created and self.forum_id != self._original_forum_id
+        retitled = created or self.title != self._original_title
+        deferred = updates_deferred()
+        if deferred:
+            created = moved = retitled = False
+        if self.pk and not args and not kwargs.get('force_insert') and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [f.name for f in self._meta.local_fields
+                                       if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+        lineage = self.forum.get_lineage_ids()
+        with atomic():
+            super(Thread, self).save(*args,**kwargs)
+            if created:
+                Forum.objects.update_counters(self.forum, threads=1)
+                ForumActivity.objects.record(self.forum_id, self.create_at, threads=1)
+            elif moved:
+                # The row is locked by the save above; move the stored
+                # counter rather than a possibly stale in-memory one.
+                self.posts = Thread.objects.filter(pk=self.pk).values_list('posts', flat=True)[0]
+                old_forum = Forum.objects.get(pk=self._original_forum_id)
+                Forum.objects.update_counters(old_forum, threads=-1, posts=-self.posts)
+                Forum.objects.update_counters(self.forum, threads=1, posts=self.posts)
+                lineage = set(old_forum.get_lineage_ids() + lineage)
+                for f in Forum.objects.filter(pk__in=lineage):
+                    f.refresh_last_post()
+                search.move_thread(self)
+            if retitled:
+                search.index_thread(self)
+        if not deferred:
+            stamps.touch(self.pk, lineage)
+            if moved or retitled:
+                search.thread_changed(self.pk, self.title, self.forum_id)
+            if moved or (retitled and not created):
+                activity.buffers.invalidate()
+        self._original_forum_id = self.forum_id
+        self._original_title = self.title
 
     def delete(self):
-        super(Thread, self).delete()
-        f = self.forum
-        f.threads = f.thread_set.count()
-        f.posts = Post.objects.filter(thread__forum__pk=f.id).count()
-        f.save()
+        pk = self.pk
+        with atomic():
+            # The posts go away with the thread, so take the stored counter
+            # rather than a possibly stale in-memory one.
+            posts = Thread.objects.filter(pk=pk).values_list('posts', flat=True)[0]
+            # The hourly activity buckets of the posts, to take them out.
+            post_hours = {}
+            for when in Post.objects.filter(thread=pk, time__isnull=False).values_list('time', flat=True):
+                hour = when.replace(minute=0, second=0, microsecond=0)
+                post_hours[hour] = post_hours.get(hour, 0) + 1
+            search.unindex_thread(self)
+            super(Thread, self).delete()
+            Forum.objects.update_counters(self.forum, threads=-1, posts=-posts)
+            if self.create_at:
+                ForumActivity.objects.record(self.forum_id, self.create_at, threads=-1)
+            for hour, count in post_hours.items():
+                ForumActivity.objects.record(self.forum_id, hour, posts=-count)
+            # Deleting the posts cleared any forum pointer to them.
+            for f in Forum.objects.filter(pk__in=self.forum.get_lineage_ids(), last_post__isnull=True):
+                f.refresh_last_post()
+        # Also makes the cached pages of the thread stale.
+        stamps.touch(pk, self.forum.get_lineage_ids())
+        search.thread_changed(pk)
+        activity.buffers.invalidate()
 
     @models.permalink
     def get_absolute_url(self):
@@ -275,48 +418,86 @@ class Post(models.Model):
     tags = TagField(help_text=tagfield_help_text, verbose_name=_('tags'))
     time = models.DateTimeField(_("Time"), blank=True, null=True)
 
-    def save(self, force_insert=False, force_update=False):
-        if not self.id:
-            self.time = timezone.now()
-
-        self.body_html = markdown(escape(self.body))
-        super(Post, self).save(force_insert, force_update)
+    def __init__(self, *args, **kwargs):
+        super(Post, self).__init__(*args, **kwargs)
+        # Only a changed body needs to be indexed again.
+        self._original_body = self.body
 
-        t = self.thread
-        t.latest_post_time = t.post_set.latest('time').time
-        t.posts = t.post_set.count()
-        t.save()
+    def save(self, *args, **kwargs):
+        created = not self.id
+        if created:
+            self.time = timezone.now()
 
-        f = self.thread.forum
-        f.threads = f.thread_set.count()
-        f.posts = Post.objects.filter(thread__forum__pk=f.id).count()
-        f.save()
+        self.body_html = render.render_body(self.body)
+        with atomic():
+            super(Post, self).save(*args, **kwargs)
+            if (created or self.body != self._original_body) and not updates_deferred():
+                search.index_post(self)
+            if created and not updates_deferred():
+                t = self.thread
+                fields = {'latest_post_time': self.time, 'last_post': self, 'last_poster': self.author_id}
+                if not t.first_post_id:
+                    fields['first_post'] = self
+                Thread.objects.update_counters(t, posts=1, **fields)
+                Forum.objects.update_counters(t.forum, posts=1, last_post=self, last_poster=self.author_id)
+                ForumActivity.objects.record(t.forum_id, self.time, posts=1)
+                hotness.record_post(t, self.time)
+                # Keep the in-memory thread in line with the row we just updated.
+                t.posts += 1
+                t.latest_post_time = self.time
+                t.last_post, t.last_poster_id = self, self.author_id
+                if 'first_post' in fields:
+                    t.first_post = self
+        if not updates_deferred():
+            stamps.touch(self.thread_id, self.thread.forum.get_lineage_ids(), created and self.time or None)
+            if created:
+                activity.buffers.post_created(self)
+        self._original_body = self.body
 
     def delete(self):
-        try:
-            latest_post = Post.objects.exclude(pk=self.id).latest('time')
-            latest_post_time = latest_post.time
-        except Post.DoesNotExist:
-            latest_post_time = None
-
         t = self.thread
-        t.posts = t.post_set.exclude(pk=self.id).count()
-        t.latest_post_time = latest_post_time
-        t.save()
-
-        f = self.thread.forum
-        f.posts = Post.objects.filter(thread__forum__pk=f.id).exclude(pk=self.id).count()
-        f.save()
-
-        super(Post, self).delete()
+        pk = self.pk
+        with atomic():
+            stale_forums = list(Forum.objects.filter(pk__in=t.forum.get_lineage_ids(), last_post=pk))
+            search.unindex_post(self)
+            super(Post, self).delete()
+            fields = t._post_pointer_fields(first=t.first_post_id == pk,
+                                            last=t.last_post_id == pk or t.latest_post_time == self.time)
+            Thread.objects.update_counters(t, posts=-1, **fields)
+            Forum.objects.update_counters(t.forum, posts=-1)
+            if self.time:
+                ForumActivity.objects.record(t.forum_id, self.time, posts=-1)
+            for f in stale_forums:
+                f.refresh_last_post()
+        stamps.touch(t.pk, t.forum.get_lineage_ids())
+        activity.buffers.post_deleted(self)
+        t.posts -= 1
+        if 'last_poster' in fields:
+            fields['last_poster_id'] = fields.pop('last_poster')
+        for name, value in fields.items():
+            setattr(t, name, value)
 
     class Meta:
         ordering = ('-time',)
+        index_together = [('thread', 'time', 'id')]
         verbose_name = _('Post')
         verbose_name_plural = _('Posts')
 
     def get_absolute_url(self):
-        return '%s?page=last#post%s' % (self.thread.get_absolute_url(), self.id)
+        return reverse('forum_view_post', args=[self.id])
+
+    def get_position(self):
+        """
+        Returns how many posts come before this one in its thread, counted
+        on the (thread, time, id) index without reading the posts.
+        """
+        return Post.objects.filter(thread=self.thread_id).filter(
+            models.Q(time__lt=self.time) | models.Q(time=self.time, id__lt=self.id)).count()
+
+    def get_thread_url(self, per_page=FORUM_PAGINATION):
+        """The URL of the thread page showing this post, with its anchor."""
+        page = self.get_position() // per_page + 1
+        return '%s?page=%d#post%s' % (reverse('forum_view_thread', args=[self.thread_id]), page, self.id)
 
     def __unicode__(self):
         return u"%s" % self.id
@@ -325,8 +506,18 @@ class Subscription(models.Model):
     """
     Allow users to subscribe to threads.
     """
+    IMMEDIATE, DAILY, WEEKLY = 0, 1, 2
+    DELIVERY_CHOICES = (
+        (IMMEDIATE, _('Every reply')),
+        (DAILY, _('Daily digest')),
+        (WEEKLY, _('Weekly digest')),
+    )
+
     author = models.ForeignKey(User)
     thread = models.ForeignKey(Thread)
+    delivery = models.SmallIntegerField(_("Delivery"), choices=DELIVERY_CHOICES, default=IMMEDIATE, db_index=True)
+    # Replies after this time go into the next digest.
+    last_digest_at = models.DateTimeField(_("Last digest"), blank=True, null=True, editable=False)
 
     class Meta:
         unique_together = (("author", "thread"),)
@@ -335,3 +526,153 @@ class Subscription(models.Model):
 
     def __unicode__(self):
         return u"%s to %s" % (self.author, self.thread)
+
+    @classmethod
+    def preferred_delivery(cls, user):
+        """The delivery mode of the user's latest subscription, for new ones."""
+        modes = list(cls.objects.filter(author=user).order_by('-pk').values_list('delivery', flat=True)[:1])
+        return modes and modes[0] or cls.IMMEDIATE
+
+class ThreadReadMark(models.Model):
+    """
+    The time of the newest post a user has read in a thread. Anything
+    older counts as read, so a thread needs one row however many posts
+    it has. See forum.readmarks.
+    """
+    user = models.ForeignKey(User, related_name='+')
+    thread = models.ForeignKey(Thread, related_name='+')
+    last_read_at = models.DateTimeField(_("Read up to"))
+
+    class Meta:
+        unique_together = (("user", "thread"),)
+        verbose_name = _('Thread read mark')
+        verbose_name_plural = _('Thread read marks')
+
+    def __unicode__(self):
+        return u"%s read %s up to %s" % (self.user_id, self.thread_id, self.last_read_at)
+
+class ForumReadMark(models.Model):
+    """
+    When a user marked a forum and its sub-forums as read, or the whole
+    board when forum is empty.
+    """
+    user = models.ForeignKey(User, related_name='+')
+    forum = models.ForeignKey(Forum, blank=True, null=True, related_name='+')
+    marked_at = models.DateTimeField(_("Marked read at"))
+
+    class Meta:
+        unique_together = (("user", "forum"),)
+        verbose_name = _('Forum read mark')
+        verbose_name_plural = _('Forum read marks')
+
+    def __unicode__(self):
+        return u"%s read %s at %s" % (self.user_id, self.forum_id, self.marked_at)
+
+class Notification(models.Model):
+    """
+    A reply to announce to the subscribers of its thread. Replies only
+    insert a row here; `./manage.py forum_send_notifications` does the
+    mailing (see forum.notifications).
+    """
+    PENDING, SENDING, SENT, FAILED = 0, 1, 2, 3
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    post = models.ForeignKey(Post)
+    status = models.SmallIntegerField(_("Status"), choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField(_("Created"), default=timezone.now)
+    # When a pending row is due, or when the claim of a sending one lapses.
+    next_attempt = models.DateTimeField(_("Next attempt"), default=timezone.now)
+    attempts = models.IntegerField(_("Attempts"), default=0)
+    # Subscriptions are mailed in pk order; retries resume after this one.
+    last_subscription_id = models.IntegerField(default=0, editable=False)
+    recipients = models.IntegerField(_("Recipients"), default=0)
+    sent_at = models.DateTimeField(_("Sent at"), blank=True, null=True)
+    last_error = models.TextField(_("Last error"), blank=True, default='')
+
+    class Meta:
+        index_together = [('status', 'next_attempt')]
+        verbose_name = _('Notification')
+        verbose_name_plural = _('Notifications')
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.post_id, self.get_status_display())
+
+class ForumActivity(models.Model):
+    """
+    Posts, new threads and views of one forum during one hour. The rows
+    are bumped as things happen, so activity statistics (see forum.stats)
+    never have to count the Post table.
+    """
+    forum = models.ForeignKey(Forum)
+    hour = models.DateTimeField(_("Hour"), db_index=True)
+    posts = models.IntegerField(_("Posts"), default=0)
+    threads = models.IntegerField(_("Threads"), default=0)
+    views = models.IntegerField(_("Views"), default=0)
+
+    objects = ForumActivityManager()
+
+    class Meta:
+        unique_together = (("forum", "hour"),)
+        verbose_name = _('Forum activity')
+        verbose_name_plural = _('Forum activity')
+
+    def __unicode__(self):
+        return u"%s at %s" % (self.forum, self.hour)
+
+class SearchTerm(models.Model):
+    """
+    A word of the full-text index (see forum.search), with the number of
+    documents it appears in.
+    """
+    term = models.CharField(_("Term"), max_length=64, unique=True)
+    documents = models.IntegerField(_("Documents"), default=0)
+
+    def __unicode__(self):
+        return self.term
+
+class SearchDocument(models.Model):
+    """
+    One indexed text: the title of a thread (post is empty) or the body
+    of a post. The forum is copied from the thread for scoped searches.
+    """
+    thread = models.ForeignKey(Thread)
+    post = models.ForeignKey(Post, blank=True, null=True)
+    forum = models.ForeignKey(Forum)
+    length = models.IntegerField(_("Length"), default=0)
+
+    def __unicode__(self):
+        return u"%s/%s" % (self.thread_id, self.post_id or '-')
+
+class SearchPosting(models.Model):
+    """
+    The occurrences of a term in a document, as space separated word
+    offsets for phrase queries.
+    """
+    term = models.ForeignKey(SearchTerm)
+    document = models.ForeignKey(SearchDocument)
+    positions = models.TextField()
+
+    class Meta:
+        unique_together = (("term", "document"),)
+
+def _unindex_forum(sender, instance, **kwargs):
+    # The cascade would delete the documents of the forum without taking
+    # them out of the document counts of their terms.
+    search.unindex_forum(instance)
+
+pre_delete.connect(_unindex_forum, sender=Forum, dispatch_uid='forum.search.unindex_forum')
+
+# Keep the per-process forum tree (URLs, breadcrumbs) in line with the table.
+post_save.connect(forumtree.invalidate, sender=Forum, dispatch_uid='forum.forumtree.save')
+post_delete.connect(forumtree.invalidate, sender=Forum, dispatch_uid='forum.forumtree.delete')
+
+# Cached sets of accessible forums (see ForumManager.accessible_ids).
+post_save.connect(Forum.objects.invalidate_access, sender=Forum, dispatch_uid='forum.acl.save')
+post_delete.connect(Forum.objects.invalidate_access, sender=Forum, dispatch_uid='forum.acl.delete')
+m2m_changed.connect(Forum.objects.invalidate_access, sender=Forum.allowed_users.through, dispatch_uid='forum.acl.users')
+m2m_changed.connect(Forum.objects.invalidate_access, sender=Forum.groups.through, dispatch_uid='forum.acl.groups')
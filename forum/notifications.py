@@ -0,0 +1,339 @@
+"""
+Mailing of new replies to the subscribers of their thread.
+
+Posting a reply only inserts a Notification row (see enqueue()), so the
+time it takes does not depend on the number of subscribers. The queue is
+drained by `./manage.py forum_send_notifications`, which hands the mails
+to a pool of FORUM_NOTIFY_WORKERS threads, each keeping one SMTP
+connection open for as long as it runs. Subscribers are mailed in BCC
+batches of FORUM_NOTIFY_BCC_SIZE addresses.
+
+A notification that fails is retried after FORUM_NOTIFY_RETRY_DELAY
+seconds, doubling with every attempt, up to FORUM_NOTIFY_MAX_ATTEMPTS
+attempts; retries resume after the last batch that went out. Claimed
+rows whose worker died are picked up again once their lease ran out.
+Delivery counters are kept in the cache backend, see metrics().
+
+Subscriptions in daily or weekly mode get no mail per reply. Instead
+`./manage.py forum_send_digests daily|weekly`, run from cron, mails each
+such subscriber one digest of the new replies in all their threads.
+"""
+
+import datetime
+import random
+import threading
+from Queue import Queue
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.core.urlresolvers import reverse
+from django.db.models import F, Q
+from django.template import Context, loader
+from django.template.defaultfilters import striptags, truncatewords, wordwrap
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+from forum.utils import CACHE_FOREVER
+
+FORUM_MAIL_PREFIX = getattr(settings, 'FORUM_MAIL_PREFIX', '[Forum]')
+FORUM_MAIL_FROM = getattr(settings, 'FORUM_MAIL_FROM', settings.DEFAULT_FROM_EMAIL)
+FORUM_NOTIFY_WORKERS = getattr(settings, 'FORUM_NOTIFY_WORKERS', 4)
+FORUM_NOTIFY_BCC_SIZE = getattr(settings, 'FORUM_NOTIFY_BCC_SIZE', 50)
+FORUM_NOTIFY_MAX_ATTEMPTS = getattr(settings, 'FORUM_NOTIFY_MAX_ATTEMPTS', 6)
+FORUM_NOTIFY_RETRY_DELAY = getattr(settings, 'FORUM_NOTIFY_RETRY_DELAY', 60)
+# Seconds a worker may hold a claimed notification.
+FORUM_NOTIFY_LEASE = getattr(settings, 'FORUM_NOTIFY_LEASE', 15 * 60)
+
+METRICS_KEY = 'forum:notify:%s'
+# 'latency' is the total of seconds from posting to delivery.
+METRICS = ('notifications', 'messages', 'recipients', 'retries', 'failures', 'latency', 'digests')
+
+# Subscribers handled per round of digest queries.
+DIGEST_CHUNK_SIZE = 200
+# Thread ids per IN (...) clause.
+IN_CHUNK_SIZE = 500
+
+def enqueue(post):
+    """Queues the mailing of a new reply, if anybody else follows its thread."""
+    from forum.models import Notification, Subscription
+    subscriptions = Subscription.objects.filter(thread=post.thread_id, delivery=Subscription.IMMEDIATE)
+    if subscriptions.exclude(author=post.author_id).exists():
+        return Notification.objects.create(post=post)
+
+def metrics():
+    """The delivery counters since they were last reset."""
+    values = cache.get_many([METRICS_KEY % name for name in METRICS])
+    return dict((name, values.get(METRICS_KEY % name, 0)) for name in METRICS)
+
+def reset_metrics():
+    cache.delete_many([METRICS_KEY % name for name in METRICS])
+
+def _count(name, delta):
+    if delta:
+        key = METRICS_KEY % name
+        cache.add(key, 0, CACHE_FOREVER)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass
+
+def render(post, site=None):
+    """Returns the (subject, body) of the mail announcing a post."""
+    site = site or Site.objects.get_current()
+    thread = post.thread
+    body = loader.get_template('forum/notify.txt').render(Context({
+        'body': wordwrap(striptags(post.body), 72),
+        'post': post,
+        'site': site,
+        'thread': thread,
+    }))
+    return u'%s %s' % (FORUM_MAIL_PREFIX, striptags(thread.title)), body
+
+def claim(limit):
+    """
+    Marks up to ``limit`` due notifications as being sent by this process
+    and returns them. Rows another worker claimed first are skipped.
+    """
+    from forum.models import Notification
+    now = timezone.now()
+    due = (Notification.objects.filter(status__in=(Notification.PENDING, Notification.SENDING),
+                                       next_attempt__lte=now))
+    lease = now + datetime.timedelta(seconds=FORUM_NOTIFY_LEASE)
+    claimed = []
+    for pk in due.order_by('next_attempt').values_list('pk', flat=True)[:limit]:
+        if due.filter(pk=pk).update(status=Notification.SENDING, next_attempt=lease,
+                                    attempts=F('attempts') + 1):
+            claimed.append(pk)
+    return list(Notification.objects.filter(pk__in=claimed).select_related('post', 'post__thread'))
+
+def batches(notification, site=None):
+    """
+    Returns the mails of a notification as (last subscription pk, number
+    of recipients, EmailMessage) tuples, skipping those already sent.
+    """
+    from forum.models import Subscription
+    post = notification.post
+    rows = list(Subscription.objects.filter(thread=post.thread_id, delivery=Subscription.IMMEDIATE,
+                                            pk__gt=notification.last_subscription_id)
+                .exclude(author=post.author_id).exclude(author__email='')
+                .order_by('pk').values_list('pk', 'author__email'))
+    if not rows:
+        return []
+    subject, body = render(post, site)
+    result = []
+    for i in range(0, len(rows), FORUM_NOTIFY_BCC_SIZE):
+        chunk = rows[i:i + FORUM_NOTIFY_BCC_SIZE]
+        message = EmailMessage(subject=subject, body=body, from_email=FORUM_MAIL_FROM,
+                               bcc=[email for pk, email in chunk])
+        result.append((chunk[-1][0], len(chunk), message))
+    return result
+
+def _send(connection, message):
+    """Sends a message, reconnecting once if the server dropped a reused connection."""
+    reused = False
+    try:
+        # open() returns a false value when the connection is already up.
+        reused = not connection.open()
+        connection.send_messages([message])
+    except Exception:
+        connection.close()
+        if not reused:
+            raise
+        connection.open()
+        connection.send_messages([message])
+
+class Sender(threading.Thread):
+    """A worker thread mailing notifications over its own connection."""
+    def __init__(self, jobs, results):
+        super(Sender, self).__init__()
+        self.daemon = True
+        self.jobs = jobs
+        self.results = results
+
+    def run(self):
+        connection = get_connection(fail_silently=False)
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                notification, mails = job
+                self.results.put((notification, self.deliver(connection, mails)))
+        finally:
+            connection.close()
+
+    def deliver(self, connection, mails):
+        """Returns (last subscription pk, recipients, messages, error)."""
+        last_pk, recipients, messages = None, 0, 0
+        for pk, count, message in mails:
+            try:
+                _send(connection, message)
+            except Exception as e:
+                return last_pk, recipients, messages, e
+            last_pk, recipients, messages = pk, recipients + count, messages + 1
+        return last_pk, recipients, messages, None
+
+class Mailer(object):
+    """
+    Drains the queue with a pool of Sender threads. Only the calling
+    thread uses the database; the workers just talk to the mail server.
+
+        >>> mailer = Mailer()
+        >>> mailer.process()
+        >>> mailer.close()
+    """
+    def __init__(self, workers=FORUM_NOTIFY_WORKERS):
+        self.jobs, self.results = Queue(), Queue()
+        self.workers = [Sender(self.jobs, self.results) for i in range(max(workers, 1))]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def process(self, limit=100):
+        """
+        Sends up to ``limit`` due notifications. Returns the counters of
+        this run, as metrics() does.
+        """
+        stats = dict.fromkeys(METRICS, 0)
+        site = Site.objects.get_current()
+        pending = 0
+        for notification in claim(limit):
+            mails = batches(notification, site)
+            if mails:
+                self.jobs.put((notification, mails))
+                pending += 1
+            else:
+                # Everybody unsubscribed meanwhile.
+                self._finish(notification, None, 0, None, stats)
+        while pending:
+            notification, (last_pk, recipients, messages, error) = self.results.get()
+            stats['messages'] += messages
+            self._finish(notification, last_pk, recipients, error, stats)
+            pending -= 1
+        for name in METRICS:
+            _count(name, stats[name])
+        return stats
+
+    def _finish(self, notification, last_pk, recipients, error, stats):
+        from forum.models import Notification
+        now = timezone.now()
+        changes = {'recipients': F('recipients') + recipients}
+        if last_pk is not None:
+            changes['last_subscription_id'] = last_pk
+        stats['recipients'] += recipients
+        if error is None:
+            changes.update(status=Notification.SENT, sent_at=now, last_error='')
+            stats['notifications'] += 1
+            stats['latency'] += int((now - notification.created).total_seconds())
+        elif notification.attempts >= FORUM_NOTIFY_MAX_ATTEMPTS:
+            changes.update(status=Notification.FAILED, last_error=force_text(error))
+            stats['failures'] += 1
+        else:
+            # claim() counted this attempt already.
+            delay = FORUM_NOTIFY_RETRY_DELAY * 2 ** (notification.attempts - 1) * random.uniform(1, 1.5)
+            changes.update(status=Notification.PENDING, last_error=force_text(error),
+                           next_attempt=now + datetime.timedelta(seconds=delay))
+            stats['retries'] += 1
+        Notification.objects.filter(pk=notification.pk).update(**changes)
+
+def process(limit=100, workers=FORUM_NOTIFY_WORKERS):
+    """Sends up to ``limit`` due notifications with a short-lived Mailer."""
+    mailer = Mailer(workers)
+    try:
+        return mailer.process(limit)
+    finally:
+        mailer.close()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def send_digests(delivery, period, now=None, connection=None):
+    """
+    Mails one digest to every subscriber in ``delivery`` mode with new
+    replies in their threads: those since the subscription's previous
+    digest, or of the last ``period`` (a timedelta) for new subscriptions.
+    The replies of a few hundred subscribers are read with a handful of
+    queries at a time. Returns the number of digests sent.
+    """
+    from forum.models import Subscription, Thread, Post
+    now = now or timezone.now()
+    site = Site.objects.get_current()
+    connection = connection or get_connection(fail_silently=False)
+
+    # Subscriptions whose thread got a reply since their last digest.
+    rows = (Subscription.objects.filter(delivery=delivery)
+            .filter(Q(last_digest_at__isnull=True) | Q(thread__latest_post_time__gt=F('last_digest_at')))
+            .exclude(author__email='').order_by('author')
+            .values_list('pk', 'author', 'author__username', 'author__email', 'thread', 'last_digest_at'))
+    subscribers = {}
+    for pk, author_id, username, email, thread_id, since in rows.iterator():
+        subscriber = subscribers.setdefault(author_id, (username, email, []))
+        subscriber[2].append((pk, thread_id, since or now - period))
+
+    sent = 0
+    try:
+        for author_ids in _chunks(sorted(subscribers), DIGEST_CHUNK_SIZE):
+            subscriptions = [sub for author_id in author_ids for sub in subscribers[author_id][2]]
+            thread_ids = sorted(set(thread_id for pk, thread_id, since in subscriptions))
+            oldest = min(since for pk, thread_id, since in subscriptions)
+
+            titles, replies = {}, {}
+            for ids in _chunks(thread_ids, IN_CHUNK_SIZE):
+                titles.update(Thread.objects.filter(pk__in=ids).values_list('pk', 'title'))
+                for post in (Post.objects.filter(thread__in=ids, time__gt=oldest, time__lte=now)
+                             .order_by('time').values('pk', 'thread', 'author', 'author__username', 'time', 'body')):
+                    post['body'] = wordwrap(truncatewords(striptags(post['body']), 100), 72)
+                    replies.setdefault(post['thread'], []).append(post)
+
+            done = []
+            for author_id in author_ids:
+                username, email, subs = subscribers[author_id]
+                threads = []
+                for pk, thread_id, since in subs:
+                    posts = [post for post in replies.get(thread_id, ())
+                             if post['time'] > since and post['author'] != author_id]
+                    if posts:
+                        threads.append(_digest_thread(thread_id, titles.get(thread_id, u''), posts))
+                if threads:
+                    threads.sort(key=lambda thread: thread['posts'][-1]['time'], reverse=True)
+                    try:
+                        _send(connection, _digest_message(username, email, threads, delivery, site))
+                    except Exception:
+                        # Try again with the next digest.
+                        continue
+                    sent += 1
+                done.extend(pk for pk, thread_id, since in subs)
+
+            for ids in _chunks(done, IN_CHUNK_SIZE):
+                Subscription.objects.filter(pk__in=ids).update(last_digest_at=now)
+    finally:
+        connection.close()
+    _count('digests', sent)
+    return sent
+
+def _digest_thread(thread_id, title, posts):
+    return {
+        'title': title,
+        'url': reverse('forum_view_post', args=[posts[0]['pk']]),
+        'posts': posts,
+    }
+
+def _digest_message(username, email, threads, delivery, site):
+    from forum.models import Subscription
+    body = loader.get_template('forum/digest.txt').render(Context({
+        'username': username,
+        'threads': threads,
+        'site': site,
+        'daily': delivery == Subscription.DAILY,
+    }))
+    subject = u'%s %s' % (FORUM_MAIL_PREFIX, delivery == Subscription.DAILY and _('Daily digest') or _('Weekly digest'))
+    return EmailMessage(subject=subject, body=body, from_email=FORUM_MAIL_FROM, to=[email])
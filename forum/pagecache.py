@@ -0,0 +1,91 @@
+"""
+Cached thread pages for anonymous readers.
+
+Anonymous readers of a thread page all get the same HTML until the
+thread changes, so ThreadView keeps the rendered page in the cache
+backend per thread and page, tagged with the thread's change stamp (see
+forum.stamps). Posting, editing or deleting a post and saving the thread
+(closing it, making it sticky...) replace the stamp, which makes the
+stored pages stale.
+
+When a stale page is requested, one process renders it again while the
+others keep serving the stale copy, so a busy thread that just got a
+reply does not have every worker render it at once. Without any copy to
+serve, the others wait up to FORUM_PAGE_CACHE_WAIT seconds for the one
+rendering it. A stale copy is never served once who may see the page
+changed, and a render that does not succeed (the thread is gone, or no
+longer public) drops the stored copy.
+
+Pages are kept FORUM_PAGE_CACHE_TIMEOUT seconds at most, which also
+bounds how stale relative times ("5 minutes ago") may get.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+FORUM_PAGE_CACHE_TIMEOUT = getattr(settings, 'FORUM_PAGE_CACHE_TIMEOUT', 5 * 60)
+FORUM_PAGE_CACHE_WAIT = getattr(settings, 'FORUM_PAGE_CACHE_WAIT', 2.0)
+
+PAGE_KEY = 'forum:page:%s:%s:%s'
+LOCK_KEY = 'forum:page:lock:%s:%s:%s'
+# Seconds a renderer may hold the lock.
+LOCK_TIMEOUT = 30
+POLL_INTERVAL = 0.05
+
+def _response(entry):
+    token, access, content, content_type = entry
+    return HttpResponse(content, content_type=content_type)
+
+def cached_page(kind, pk, variant, token, render, access=None):
+    """
+    Returns the response cached for page ``variant`` of object ``pk`` if
+    it was rendered at ``token`` and ``access``, a stamp of the
+    permissions deciding who may see it. Otherwise render() is called
+    for a fresh response, by at most one process at a time; only
+    successful responses are kept, and a failing render() drops the
+    stored one.
+    """
+    key = PAGE_KEY % (kind, pk, variant)
+    entry = cache.get(key)
+    if entry is not None and entry[1] != access:
+        entry = None
+    if entry is not None and entry[0] == token:
+        return _response(entry)
+
+    lock = LOCK_KEY % (kind, pk, variant)
+    if not cache.add(lock, 1, LOCK_TIMEOUT):
+        if entry is not None:
+            # Somebody is rendering the new version; serve the old one.
+            return _response(entry)
+        waited = 0
+        while waited < FORUM_PAGE_CACHE_WAIT:
+            time.sleep(POLL_INTERVAL)
+            waited += POLL_INTERVAL
+            entry = cache.get(key)
+            if entry is not None and entry[:2] == (token, access):
+                return _response(entry)
+        # Still nothing: render it ourselves, without the lock.
+        return render()
+
+    try:
+        try:
+            response = render()
+        except:
+            # Eg. Http404 for a thread that is gone: nobody must get the
+            # old copy any more.
+            cache.delete(key)
+            raise
+        if hasattr(response, 'render'):
+            response = response.render()
+        if response.status_code == 200:
+            cache.set(key, (token, access, response.content, response['Content-Type']),
+                      FORUM_PAGE_CACHE_TIMEOUT)
+        else:
+            # Nobody must get the old copy any more.
+            cache.delete(key)
+        return response
+    finally:
+        cache.delete(lock)
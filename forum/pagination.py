@@ -0,0 +1,171 @@
+"""
+Keyset ("seek") pagination for long thread and post listings.
+
+Instead of OFFSET, a page is addressed by the sort key of the row next to
+it: ?after=<cursor> and ?before=<cursor> fetch the rows following or
+preceding that key with an indexed range scan, so the cost of a page does
+not depend on how deep it is. ?page=last is served the same way from the
+other end of the index.
+
+Numbered ?page=N links keep working through the regular Paginator; views
+that know their row count from a denormalized counter hand it over so no
+COUNT(*) is run. Whichever way a page was reached, its previous/next
+links are cursors.
+"""
+
+import base64
+import datetime
+
+from django.core.paginator import Paginator, InvalidPage
+from django.db.models import Q
+from django.http import Http404
+from django.utils.http import urlencode
+
+class InvalidCursor(Exception):
+    pass
+
+class CountedPaginator(Paginator):
+    """A Paginator that is told the number of objects rather than counting them."""
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._known_count = count
+
+    count = property(lambda self: self._known_count)
+
+class KeysetPage(object):
+    def __init__(self, paginator, object_list, has_previous, has_next, number=None):
+        self.paginator = paginator
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = has_next
+        # Only set when the page was reached by its number.
+        self.number = number
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _query(self, name, obj):
+        return urlencode({name: self.paginator.encode_cursor(obj)})
+
+    def _get_previous_query(self):
+        if self.has_previous and self.object_list:
+            return self._query('before', self.object_list[0])
+        return ''
+    previous_query = property(_get_previous_query)
+
+    def _get_next_query(self):
+        if self.has_next and self.object_list:
+            return self._query('after', self.object_list[-1])
+        return ''
+    next_query = property(_get_next_query)
+
+class KeysetPaginator(object):
+    def __init__(self, queryset, keys, per_page):
+        """
+        ``keys`` lists the (field name, descending) pairs the listing is
+        ordered by; the last one must be unique, eg. the pk.
+        """
+        self.queryset = queryset
+        self.keys = keys
+        self.per_page = per_page
+        self._fields = [queryset.model._meta.get_field(name) for name, descending in keys]
+
+    def _ordering(self, reverse=False):
+        return ['%s%s' % ((descending != reverse) and '-' or '', name) for name, descending in self.keys]
+
+    def encode_cursor(self, obj):
+        values = []
+        for field in self._fields:
+            value = getattr(obj, field.attname)
+            if isinstance(value, bool):
+                value = value and '1' or '0'
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            elif isinstance(value, float):
+                # str() would round it, and the seek miss the row.
+                value = repr(value)
+            values.append(u'%s' % value)
+        return base64.urlsafe_b64encode(u'~'.join(values).encode('utf-8'))
+
+    def decode_cursor(self, cursor):
+        try:
+            values = base64.urlsafe_b64decode(str(cursor)).decode('utf-8').split(u'~')
+            if len(values) != len(self._fields):
+                raise ValueError
+            return [field.to_python(value) for field, value in zip(self._fields, values)]
+        except Exception:
+            raise InvalidCursor(cursor)
+
+    def _seek(self, cursor, forward):
+        """
+        Builds the filter for the rows after (or before) the cursor in
+        listing order: (a > x) OR (a = x AND b > y) OR ...
+        """
+        values = self.decode_cursor(cursor)
+        query = Q()
+        for i, ((name, descending), value) in enumerate(zip(self.keys, values)):
+            lookup = (descending == forward) and 'lt' or 'gt'
+            condition = Q(**{'%s__%s' % (name, lookup): value})
+            for (previous, d), previous_value in zip(self.keys[:i], values[:i]):
+                condition &= Q(**{previous: previous_value})
+            query |= condition
+        return query
+
+    def page(self, after=None, before=None, last=False):
+        size = self.per_page
+        if after:
+            rows = list(self.queryset.filter(self._seek(after, True)).order_by(*self._ordering())[:size + 1])
+            return KeysetPage(self, rows[:size], True, len(rows) > size)
+        if before or last:
+            qs = self.queryset
+            if before:
+                qs = qs.filter(self._seek(before, False))
+            rows = list(qs.order_by(*self._ordering(reverse=True))[:size + 1])
+            has_previous = len(rows) > size
+            rows = rows[:size]
+            rows.reverse()
+            return KeysetPage(self, rows, has_previous, bool(before))
+        rows = list(self.queryset.order_by(*self._ordering())[:size + 1])
+        return KeysetPage(self, rows[:size], False, len(rows) > size)
+
+class KeysetPaginationMixin(object):
+    """
+    Makes a ListView paginate by ``keyset``, see the module docstring.
+    The context gets page_obj (a KeysetPage), is_paginated, and paginator
+    when the view can tell its row count through get_object_count().
+    """
+    keyset = (('id', False),)
+    # Whether ?page=N is served with COUNT(*) and OFFSET when
+    # get_object_count() cannot tell the row count.
+    offset_pages = True
+
+    def get_object_count(self):
+        """Returns the number of rows when it is cheap to know, else None."""
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        params = self.request.GET
+        keyset = KeysetPaginator(queryset, self.keyset, page_size)
+        count = self.get_object_count()
+        numbered = None
+        if count is not None:
+            numbered = CountedPaginator(queryset.order_by(*keyset._ordering()), page_size, count)
+
+        page_kwarg = getattr(self, 'page_kwarg', 'page')
+        number = self.kwargs.get(page_kwarg) or params.get(page_kwarg)
+        try:
+            if (number and number != 'last' and not ('after' in params or 'before' in params)
+                    and (numbered or self.offset_pages)):
+                offset_paginator = numbered or Paginator(queryset.order_by(*keyset._ordering()), page_size)
+                page = offset_paginator.page(number)
+                page = KeysetPage(keyset, list(page.object_list), page.has_previous(), page.has_next(), page.number)
+            else:
+                page = keyset.page(after=params.get('after'), before=params.get('before'),
+                                   last=number == 'last')
+        except (InvalidCursor, InvalidPage):
+            raise Http404
+
+        return (numbered, page, page.object_list, page.has_previous or page.has_next)
@@ -0,0 +1,223 @@
+"""
+Per-user read tracking for "unread" markers.
+
+Nothing is stored per post. A ThreadReadMark keeps, per user and thread,
+the time of the newest post the user has seen; a ForumReadMark keeps when
+the user marked a forum (with its sub-forums) or the whole board as read,
+and replaces the thread marks it covers. A thread is unread when its
+latest post is newer than its own mark and than the marks of its forum,
+the forum's parents and the board.
+
+Reading a thread does not write to the database right away: the new mark
+goes into a process-local buffer, written in batches every
+FORUM_READ_MARKS_INTERVAL seconds or FORUM_READ_MARKS_THRESHOLD marks
+(and at exit), the way forum.viewcounter batches views. Until then it
+is kept in the cache backend too, so every worker sees it at once. Forum
+marks are few per user and cached, so which threads of a listing are
+unread takes one query on the (user, thread) index and one cache lookup:
+
+    >>> from forum import readmarks
+    >>> readmarks.annotate(request.user, threads)    # sets thread.unread
+"""
+
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.utils import timezone
+
+from forum.snapshot import snapshot
+from forum.utils import atomic
+
+FORUM_READ_MARKS_INTERVAL = getattr(settings, 'FORUM_READ_MARKS_INTERVAL', 30)
+FORUM_READ_MARKS_THRESHOLD = getattr(settings, 'FORUM_READ_MARKS_THRESHOLD', 200)
+FORUM_READ_MARKS_CACHE_TIMEOUT = getattr(settings, 'FORUM_READ_MARKS_CACHE_TIMEOUT', 24 * 60 * 60)
+
+FORUM_MARKS_KEY = 'forum:read:forums:%d'
+# A thread mark not written yet.
+PENDING_KEY = 'forum:read:pending:%d:%d'
+
+class MarkBuffer(object):
+    """The newest read time per (user pk, thread pk) not written yet."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._marks = {}
+
+    def add(self, user_id, thread_id, when):
+        with self._lock:
+            key = (user_id, thread_id)
+            if key not in self._marks or when > self._marks[key]:
+                self._marks[key] = when
+
+    def __len__(self):
+        return len(self._marks)
+
+    def discard(self, user_id, until):
+        """Forgets the marks of a user up to ``until``, eg. when all was read."""
+        with self._lock:
+            for key, when in self._marks.items():
+                if key[0] == user_id and when <= until:
+                    del self._marks[key]
+
+    def drain(self):
+        with self._lock:
+            marks, self._marks = self._marks, {}
+        return marks
+
+buffer = MarkBuffer()
+
+_state_lock = threading.Lock()
+_last_flush = time.time()
+
+def _later(*times):
+    times = [t for t in times if t is not None]
+    return times and max(times) or None
+
+def forum_marks(user_id):
+    """{forum pk (None for the board): time marked read} of a user."""
+    from forum.models import ForumReadMark
+    key = FORUM_MARKS_KEY % user_id
+    marks = cache.get(key)
+    if marks is None:
+        marks = dict(ForumReadMark.objects.filter(user=user_id).values_list('forum', 'marked_at'))
+        cache.set(key, marks, FORUM_READ_MARKS_CACHE_TIMEOUT)
+    return marks
+
+def _forum_mark(marks, forum_id):
+    """The latest mark covering a forum: its own, its parents' or the board's."""
+    mark = marks.get(None)
+    forum = snapshot.get(forum_id)
+    while forum is not None:
+        mark = _later(mark, marks.get(forum.pk))
+        forum = snapshot.get(forum.parent_id)
+    return mark
+
+def read_up_to(user, thread):
+    """The time up to which a user has read a thread, or None."""
+    from forum.models import ThreadReadMark
+    if not user.is_authenticated():
+        return None
+    marks = list(ThreadReadMark.objects.filter(user=user, thread=thread).values_list('last_read_at', flat=True))
+    return _later(marks and marks[0], cache.get(PENDING_KEY % (user.pk, thread.pk)),
+                  _forum_mark(forum_marks(user.pk), thread.forum_id))
+
+def annotate(user, threads):
+    """
+    Sets ``unread`` on each of the threads for the user, with one query,
+    and returns them.
+    """
+    from forum.models import ThreadReadMark
+    threads = list(threads)
+    if not user.is_authenticated() or not threads:
+        for thread in threads:
+            thread.unread = False
+        return threads
+
+    read = dict(ThreadReadMark.objects.filter(user=user, thread__in=[t.pk for t in threads])
+                .values_list('thread', 'last_read_at'))
+    pending = cache.get_many([PENDING_KEY % (user.pk, t.pk) for t in threads])
+    marks = forum_marks(user.pk)
+    covered = {}
+    for thread in threads:
+        if thread.forum_id not in covered:
+            covered[thread.forum_id] = _forum_mark(marks, thread.forum_id)
+        mark = _later(read.get(thread.pk), pending.get(PENDING_KEY % (user.pk, thread.pk)),
+                      covered[thread.forum_id])
+        thread.unread = thread.latest_post_time is not None and (mark is None or thread.latest_post_time > mark)
+    return threads
+
+def record(user, thread, when):
+    """Remembers that a user has read a thread up to ``when``."""
+    if not user.is_authenticated() or when is None:
+        return
+    buffer.add(user.pk, thread.pk, when)
+    key = PENDING_KEY % (user.pk, thread.pk)
+    pending = cache.get(key)
+    if pending is None or when > pending:
+        cache.set(key, when, FORUM_READ_MARKS_CACHE_TIMEOUT)
+    with _state_lock:
+        due = (len(buffer) >= FORUM_READ_MARKS_THRESHOLD or
+               time.time() - _last_flush >= FORUM_READ_MARKS_INTERVAL)
+    if due:
+        flush()
+
+def write_marks(marks):
+    """Writes {(user pk, thread pk): time}, moving existing marks forward only."""
+    from forum.models import ThreadReadMark
+    by_user = {}
+    for (user_id, thread_id), when in marks.items():
+        by_user.setdefault(user_id, {})[thread_id] = when
+
+    for user_id, threads in by_user.items():
+        existing = dict(ThreadReadMark.objects.filter(user=user_id, thread__in=list(threads))
+                        .values_list('thread', 'last_read_at'))
+        for thread_id, when in threads.items():
+            if thread_id in existing and existing[thread_id] < when:
+                ThreadReadMark.objects.filter(user=user_id, thread=thread_id).update(last_read_at=when)
+        new = [ThreadReadMark(user_id=user_id, thread_id=thread_id, last_read_at=when)
+               for thread_id, when in threads.items() if thread_id not in existing]
+        try:
+            with atomic():
+                ThreadReadMark.objects.bulk_create(new)
+        except IntegrityError:
+            # Written by another process meanwhile, or the thread is gone.
+            for mark in new:
+                try:
+                    with atomic():
+                        if not ThreadReadMark.objects.filter(user=user_id, thread=mark.thread_id).update(
+                                last_read_at=mark.last_read_at):
+                            mark.save()
+                except IntegrityError:
+                    pass
+
+def flush():
+    """Writes the buffered marks and returns how many there were."""
+    global _last_flush
+    with _state_lock:
+        _last_flush = time.time()
+    marks = buffer.drain()
+    if marks:
+        try:
+            write_marks(marks)
+        except Exception:
+            for (user_id, thread_id), when in marks.items():
+                buffer.add(user_id, thread_id, when)
+            raise
+    return len(marks)
+
+def mark_read(user, forum=None):
+    """
+    Marks a forum and its sub-forums, or the whole board, as read now,
+    dropping the thread marks this makes redundant.
+    """
+    from forum.models import ForumReadMark, ThreadReadMark
+    now = timezone.now()
+    if forum is None:
+        buffer.discard(user.pk, now)
+    forum_id = forum and forum.pk or None
+    with atomic():
+        # A unique constraint does not hold for the board mark, whose
+        # forum is NULL; lock the user so that marks are made one at a
+        # time and a second board mark is never inserted.
+        list(User.objects.select_for_update().filter(pk=user.pk).values_list('pk', flat=True))
+        if not ForumReadMark.objects.filter(user=user, forum=forum_id).update(marked_at=now):
+            ForumReadMark.objects.create(user=user, forum_id=forum_id, marked_at=now)
+        covered = ThreadReadMark.objects.filter(user=user, last_read_at__lte=now)
+        if forum is not None:
+            covered = covered.filter(thread__forum__path__startswith=forum.get_path())
+        else:
+            # The board mark covers every forum mark too.
+            ForumReadMark.objects.filter(user=user, forum__isnull=False).delete()
+        covered.delete()
+    cache.delete(FORUM_MARKS_KEY % user.pk)
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        pass
@@ -0,0 +1,235 @@
+"""
+Recomputes the denormalized counters, post pointers and timestamps of
+threads and forums from the posts, with GROUP BY queries, and writes back
+only the rows that drifted.
+
+    >>> from forum.reconcile import Reconciler
+    >>> r = Reconciler(dry_run=True)
+    >>> r.reconcile()
+    >>> r.changed      # {('thread', 'posts'): 12, ...}
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+from django.db.models import Count
+
+from forum import stamps
+from forum.models import Forum, Thread, Post
+from forum.utils import atomic
+
+THREAD_FIELDS = ('posts', 'latest_post_time', 'first_post', 'last_post', 'last_poster')
+FORUM_FIELDS = ('threads', 'posts', 'last_post', 'last_poster')
+
+# Keeps "IN (...)" and "CASE ... END" statements below SQLite's limit of
+# 999 query parameters.
+BATCH_SIZE = 300
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _current_value(obj, name):
+    field = obj._meta.get_field(name)
+    return getattr(obj, field.attname)
+
+def batch_update(model, name, values):
+    """
+    Sets field ``name`` of many rows at once from {pk: value}, with one
+    UPDATE ... CASE statement per batch.
+    """
+    field = model._meta.get_field(name)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    nulls = [pk for pk, value in values.items() if value is None]
+    for chunk in _chunks(nulls, BATCH_SIZE):
+        model.objects.filter(pk__in=chunk).update(**{name: None})
+
+    rows = [(pk, value) for pk, value in values.items() if value is not None]
+    for chunk in _chunks(rows, BATCH_SIZE):
+        params = []
+        for pk, value in chunk:
+            params.extend([pk, field.get_db_prep_save(value, connection=connection)])
+        params.extend(pk for pk, value in chunk)
+        cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), qn(field.column), qn(model._meta.pk.column),
+            ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+            qn(model._meta.pk.column), ', '.join(['%s'] * len(chunk))), params)
+
+def _latest_post_ids(group_column, join_thread, ids_column, ids, newest=True):
+    """
+    Returns {group: post pk} of the newest (or oldest) post per group,
+    breaking ties in time by pk, the way the models order posts.
+    """
+    qn = connection.ops.quote_name
+    post_table = qn(Post._meta.db_table)
+    thread_table = qn(Thread._meta.db_table)
+    post_pk = qn(Post._meta.pk.column)
+    post_time = qn(Post._meta.get_field('time').column)
+    post_thread = qn(Post._meta.get_field('thread').column)
+    thread_pk = qn(Thread._meta.pk.column)
+    pick = newest and 'MAX' or 'MIN'
+
+    if join_thread:
+        source = '%s p JOIN %s t ON p.%s = t.%s' % (post_table, thread_table, post_thread, thread_pk)
+        group = 't.%s' % qn(group_column)
+    else:
+        source = '%s p' % post_table
+        group = 'p.%s' % qn(group_column)
+    where, params = '', []
+    if ids is not None:
+        where = 'WHERE %s IN (%s)' % (ids_column, ', '.join(['%s'] * len(ids)))
+        params = list(ids)
+
+    inner = 'SELECT %s AS grp, %s(p.%s) AS edge FROM %s %s GROUP BY %s' % (
+        group, pick, post_time, source, where, group)
+    sql = 'SELECT %s, %s(p.%s) FROM %s JOIN (%s) m ON %s = m.grp AND p.%s = m.edge %s GROUP BY %s' % (
+        group, pick, post_pk, source, inner, group, post_time, where, group)
+    cursor = connection.cursor()
+    cursor.execute(sql, params * 2)
+    return dict(cursor.fetchall())
+
+class Reconciler(object):
+    def __init__(self, dry_run=False, verbose=False):
+        """
+        With ``dry_run`` nothing is written. With ``verbose`` every
+        difference is kept in ``diffs`` as (model, pk, field, old, new);
+        ``changed`` always counts them per (model, field).
+        """
+        self.dry_run = dry_run
+        self.verbose = verbose
+        self.changed = {}
+        self.diffs = []
+        self._lock = threading.Lock()
+
+    def _record(self, model_name, pk, name, old, new):
+        with self._lock:
+            key = (model_name, name)
+            self.changed[key] = self.changed.get(key, 0) + 1
+            if self.verbose:
+                self.diffs.append((model_name, pk, name, old, new))
+
+    def _apply(self, model, model_name, current, expected, fields):
+        """
+        Compares {pk: obj} with {pk: {field: value}} and writes the fields
+        that differ, grouped per field. Returns the pks that differed.
+        """
+        updates = dict((name, {}) for name in fields)
+        for pk, obj in current.items():
+            for name in fields:
+                old = _current_value(obj, name)
+                new = expected[pk][name]
+                if old != new:
+                    self._record(model_name, pk, name, old, new)
+                    updates[name][pk] = new
+        if not self.dry_run:
+            with atomic():
+                for name, values in updates.items():
+                    if values:
+                        batch_update(model, name, values)
+        return set(pk for values in updates.values() for pk in values)
+
+    def reconcile_threads(self, thread_ids):
+        """Reconciles the given threads, BATCH_SIZE at a time."""
+        qn = connection.ops.quote_name
+        post_thread = 'p.%s' % qn(Post._meta.get_field('thread').column)
+        thread_column = Post._meta.get_field('thread').column
+
+        for chunk in _chunks(list(thread_ids), BATCH_SIZE):
+            current = Thread.objects.in_bulk(chunk)
+            counts = dict(Post.objects.filter(thread__in=chunk).order_by()
+                          .values_list('thread').annotate(n=Count('id')))
+            first_ids = _latest_post_ids(thread_column, False, post_thread, chunk, newest=False)
+            last_ids = _latest_post_ids(thread_column, False, post_thread, chunk, newest=True)
+            last_posts = dict((pk, (author_id, time)) for pk, author_id, time in
+                              Post.objects.filter(pk__in=last_ids.values()).values_list('pk', 'author_id', 'time'))
+
+            expected = {}
+            for pk in current:
+                last_id = last_ids.get(pk)
+                author_id, time = last_posts.get(last_id, (None, None))
+                expected[pk] = {
+                    'posts': counts.get(pk, 0),
+                    'latest_post_time': time,
+                    'first_post': first_ids.get(pk),
+                    'last_post': last_id,
+                    'last_poster': author_id,
+                }
+            changed = self._apply(Thread, 'thread', current, expected, THREAD_FIELDS)
+            if not self.dry_run:
+                # Cached pages and feeds of the threads are stale now.
+                for pk in changed:
+                    stamps.touch(pk)
+
+    def _reconcile_forum_threads(self, forum_id):
+        try:
+            self.reconcile_threads(Thread.objects.filter(forum=forum_id).order_by('pk').values_list('pk', flat=True))
+        finally:
+            # Every worker thread opened its own connection.
+            connection.close()
+
+    def reconcile_forums(self):
+        """
+        Reconciles the counters and last post of every forum, sub-forums
+        included, from three GROUP BY queries rolled up over the tree.
+        """
+        threads = dict(Thread.objects.order_by().values_list('forum').annotate(n=Count('id')))
+        posts = dict(Post.objects.order_by().values_list('thread__forum').annotate(n=Count('id')))
+        last_ids = _latest_post_ids(Thread._meta.get_field('forum').column, True, None, None)
+        last_posts = dict((pk, (time, pk, author_id)) for pk, author_id, time in
+                          Post.objects.filter(pk__in=last_ids.values()).values_list('pk', 'author_id', 'time'))
+
+        current = Forum.objects.in_bulk(Forum.objects.values_list('pk', flat=True))
+        totals = dict((pk, {'threads': 0, 'posts': 0, 'newest': None}) for pk in current)
+        for pk in current:
+            newest = last_posts.get(last_ids.get(pk))
+            # Follow the parent links rather than the paths, which might
+            # be the very thing that is out of date.
+            ancestor = pk
+            while ancestor in current:
+                total = totals[ancestor]
+                total['threads'] += threads.get(pk, 0)
+                total['posts'] += posts.get(pk, 0)
+                if newest and (total['newest'] is None or newest > total['newest']):
+                    total['newest'] = newest
+                ancestor = current[ancestor].parent_id
+
+        expected = {}
+        for pk, total in totals.items():
+            time, last_id, author_id = total['newest'] or (None, None, None)
+            expected[pk] = {
+                'threads': total['threads'],
+                'posts': total['posts'],
+                'last_post': last_id,
+                'last_poster': author_id,
+            }
+        changed = self._apply(Forum, 'forum', current, expected, FORUM_FIELDS)
+        if changed and not self.dry_run:
+            # Lets every forum snapshot (see forum.snapshot) read them again.
+            stamps.touch(None, changed)
+
+    def reconcile(self, forums=None, parallel=1):
+        """
+        Reconciles the threads of the given forums (all when None), with
+        ``parallel`` forums at a time, and then every forum.
+        """
+        if forums is None:
+            forum_ids = list(Forum.objects.values_list('pk', flat=True))
+        else:
+            forum_ids = [f.pk for f in forums]
+
+        if parallel > 1:
+            pool = ThreadPool(parallel)
+            try:
+                pool.map(self._reconcile_forum_threads, forum_ids)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for forum_id in forum_ids:
+                self.reconcile_threads(Thread.objects.filter(forum=forum_id).order_by('pk').values_list('pk', flat=True))
+
+        self.reconcile_forums()
+        return self.changed
@@ -0,0 +1,95 @@
+"""
+Markdown rendering of post bodies.
+
+Rendered HTML is cached under a hash of the body and of the renderer
+version, first in a small per-process LRU and then in the cache backend,
+so saving an unchanged (or a duplicated) body never renders it again.
+The renderer version changes with FORUM_MARKDOWN_EXTENSIONS, the
+installed Markdown release and RENDERER_REVISION; after such a change
+`./manage.py forum_rerender` regenerates every stored body_html.
+"""
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape
+
+from forum.utils import LRUCache
+
+try:
+    import markdown as markdown_module
+    from markdown import markdown
+except ImportError:
+    class MarkdownNotFound(Exception):
+        def __str__(self):
+            return "Markdown is not installed!"
+    raise MarkdownNotFound
+
+FORUM_MARKDOWN_EXTENSIONS = list(getattr(settings, 'FORUM_MARKDOWN_EXTENSIONS', []))
+FORUM_RENDER_CACHE_SIZE = getattr(settings, 'FORUM_RENDER_CACHE_SIZE', 1000)
+FORUM_RENDER_CACHE_TIMEOUT = getattr(settings, 'FORUM_RENDER_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Bump whenever render_uncached() changes its output for the same settings.
+RENDERER_REVISION = 1
+
+RENDERER_VERSION = hashlib.sha1(repr((
+    RENDERER_REVISION,
+    getattr(markdown_module, 'version', ''),
+    FORUM_MARKDOWN_EXTENSIONS,
+))).hexdigest()[:12]
+
+_local = LRUCache(FORUM_RENDER_CACHE_SIZE)
+
+_counters_lock = threading.Lock()
+counters = {
+    'local_hits': 0,
+    'shared_hits': 0,
+    'renders': 0,
+    'render_seconds': 0.0,
+}
+
+def _count(**amounts):
+    with _counters_lock:
+        for name, amount in amounts.items():
+            counters[name] += amount
+
+def render_stats():
+    """
+    Returns a copy of the cache hit and render timing counters of this
+    process.
+    """
+    with _counters_lock:
+        return dict(counters)
+
+def render_uncached(body):
+    """Turns a post body into HTML, escaping any HTML the user typed."""
+    return markdown(escape(body), extensions=FORUM_MARKDOWN_EXTENSIONS)
+
+def cache_key(body):
+    digest = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return 'forum:render:%s:%s' % (RENDERER_VERSION, digest)
+
+def render_body(body):
+    """
+    Returns the HTML for a post body, rendering it only when neither
+    cache has it yet.
+    """
+    key = cache_key(body)
+    html = _local.get(key)
+    if html is not None:
+        _count(local_hits=1)
+        return html
+
+    html = cache.get(key)
+    if html is not None:
+        _count(shared_hits=1)
+    else:
+        started = time.time()
+        html = render_uncached(body)
+        _count(renders=1, render_seconds=time.time() - started)
+        cache.set(key, html, FORUM_RENDER_CACHE_TIMEOUT)
+    _local.set(key, html)
+    return html
@@ -0,0 +1,92 @@
+"""
+Full-text search over thread titles and post bodies, maintained by
+Thread and Post save()/delete().
+
+The index lives in the backend named by FORUM_SEARCH_BACKEND:
+
+ * forum.search.index.DatabaseBackend (default) keeps an inverted index
+   in the forum's own database tables.
+ * forum.search.fts.SQLiteFTSBackend keeps an SQLite FTS5 table in the
+   file named by FORUM_SEARCH_SQLITE_PATH.
+
+Fill or rebuild the index with `./manage.py forum_search_index`.
+
+    >>> from forum import search
+    >>> results = search.search(u'"reverse proxy" nginx OR apache', user=request.user)
+    >>> [(hit.score, hit.thread, hit.post) for hit in results[:10]]
+"""
+
+from django.conf import settings
+
+from forum.search.base import SearchHit, SearchResults, HitList
+from forum.search.suggest import titles
+from forum.utils import load_class, on_commit
+
+FORUM_SEARCH_BACKEND = getattr(settings, 'FORUM_SEARCH_BACKEND', 'forum.search.index.DatabaseBackend')
+
+backend = load_class(FORUM_SEARCH_BACKEND)()
+
+def index_thread(thread):
+    backend.index_thread(thread)
+
+def index_post(post):
+    backend.index_post(post)
+
+def index_threads(thread_ids):
+    backend.index_threads(thread_ids)
+    titles.invalidate()
+
+def unindex_thread(thread):
+    backend.unindex_thread(thread)
+
+def unindex_post(post):
+    backend.unindex_post(post)
+
+def unindex_forum(forum):
+    backend.unindex_forum(forum)
+
+def move_thread(thread):
+    backend.move_thread(thread)
+
+def thread_changed(thread_id, title=None, forum_id=None):
+    """
+    Announces a new, renamed, moved (with its title and forum) or deleted
+    thread to the title suggestions, see forum.search.suggest. Within a
+    transaction, the announcement waits until the outermost one commits,
+    so other processes replaying it read the change.
+    """
+    on_commit(lambda: titles.changed(thread_id, title, forum_id))
+
+def allowed_forum_ids(user=None, forum=None):
+    """
+    The pks of the forums to search: those the user may see, within the
+    forum and its sub-forums. None when nothing limits the search.
+    """
+    from forum.models import Forum
+    ids = None
+    if user is not None:
+        ids = set(Forum.objects.accessible_ids(user))
+    if forum is not None:
+        subtree = set(Forum.objects.filter(path__startswith=forum.get_path()).values_list('pk', flat=True))
+        if ids is None:
+            ids = subtree
+        else:
+            ids &= subtree
+    return ids
+
+def suggest(text, user=None, limit=10):
+    """(thread pk, title) pairs for a title being typed, see TitleIndex.suggest()."""
+    forum_ids = None
+    if user is not None:
+        from forum.models import Forum
+        forum_ids = Forum.objects.accessible_ids(user)
+    return titles.suggest(text, forum_ids, limit)
+
+def search(query, user=None, forum=None):
+    """
+    Runs a query (see forum.search.query.parse_query) and returns the
+    lazy SearchResults, best first. With ``user`` only the forums the
+    user may see are searched, with ``forum`` only that forum and its
+    sub-forums.
+    """
+    return backend.search(query, allowed_forum_ids(user, forum))
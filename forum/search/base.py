@@ -0,0 +1,141 @@
+"""
+What a search backend looks like, and the lazy results they return.
+"""
+
+import abc
+
+# Keeps "IN (...)" lists below SQLite's limit of 999 query parameters.
+BATCH_SIZE = 300
+
+class SearchHit(object):
+    def __init__(self, score, thread_id, post_id):
+        self.score = score
+        self.thread_id = thread_id
+        # None when the title of the thread matched.
+        self.post_id = post_id
+        self.thread = self.post = None
+
+def load_hits(hits):
+    """Fetches the threads and posts of the hits, two queries in all."""
+    from forum.models import Thread, Post
+    threads = Thread.objects.select_related('forum').in_bulk(
+        set(h.thread_id for h in hits if h.thread is None))
+    posts = Post.objects.select_related('author').in_bulk(
+        set(h.post_id for h in hits if h.post_id and h.post is None))
+    for hit in hits:
+        hit.thread = hit.thread or threads.get(hit.thread_id)
+        if hit.post_id:
+            hit.post = hit.post or posts.get(hit.post_id)
+
+class SearchResults(object):
+    """
+    The hits of a query, best first. Counting and slicing only ask the
+    backend for what is needed, and only the threads and posts of the
+    sliced hits are loaded, so the results can go to a Paginator.
+
+    Backends implement _count() and _fetch(offset, limit).
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self._total = None
+
+    @abc.abstractmethod
+    def _count(self):
+        """Returns the number of hits."""
+
+    @abc.abstractmethod
+    def _fetch(self, offset, limit):
+        """Returns ``limit`` SearchHits from ``offset`` on, best first."""
+
+    def count(self):
+        if self._total is None:
+            self._total = self._count()
+        return self._total
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(self.count())
+            hits = stop > start and self._fetch(start, stop - start) or []
+            load_hits(hits)
+            return hits[::step]
+        if k < 0:
+            k += self.count()
+        hits = k >= 0 and self._fetch(k, 1) or []
+        if not hits:
+            raise IndexError(k)
+        load_hits(hits)
+        return hits[0]
+
+class HitList(SearchResults):
+    """Results that are already ranked in memory."""
+    def __init__(self, hits):
+        super(HitList, self).__init__()
+        self.hits = hits
+
+    def _count(self):
+        return len(self.hits)
+
+    def _fetch(self, offset, limit):
+        return self.hits[offset:offset + limit]
+
+class BaseSearchBackend(object):
+    """
+    A search backend indexes thread titles and post bodies and answers
+    queries (see forum.search.query.parse_query) with SearchResults.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def index_thread(self, thread):
+        """Indexes the title of a thread, again if it was indexed before."""
+
+    @abc.abstractmethod
+    def index_post(self, post):
+        """Indexes the body of a post, again if it was indexed before."""
+
+    @abc.abstractmethod
+    def unindex_thread(self, thread):
+        """Drops the title and all posts of a thread."""
+
+    @abc.abstractmethod
+    def unindex_post(self, post):
+        """Drops the body of a post."""
+
+    def unindex_forum(self, forum):
+        """Drops the threads of a forum, before it is deleted."""
+        from forum.models import Thread
+        for thread in Thread.objects.filter(forum=forum):
+            self.unindex_thread(thread)
+
+    @abc.abstractmethod
+    def move_thread(self, thread):
+        """Follows a thread that moved to another forum."""
+
+    @abc.abstractmethod
+    def search(self, query, forum_ids=None):
+        """
+        Returns the SearchResults of a query, limited to the given forums
+        unless ``forum_ids`` is None.
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        """Empties the index."""
+
+    def index_threads(self, thread_ids):
+        """Indexes the titles and posts of many threads."""
+        from forum.models import Thread, Post
+        thread_ids = list(thread_ids)
+        for i in range(0, len(thread_ids), BATCH_SIZE):
+            chunk = thread_ids[i:i + BATCH_SIZE]
+            for thread in Thread.objects.filter(pk__in=chunk):
+                self.index_thread(thread)
+            for post in Post.objects.select_related('thread').filter(thread__in=chunk):
+                self.index_post(post)
@@ -0,0 +1,134 @@
+"""
+A search backend on an SQLite FTS5 table, kept in a file of its own next
+to whatever database the forum runs on. Needs no server, only an SQLite
+library built with FTS5, which most Python builds have.
+
+    FORUM_SEARCH_BACKEND = 'forum.search.fts.SQLiteFTSBackend'
+    FORUM_SEARCH_SQLITE_PATH = '/var/lib/forum/search.sqlite3'
+
+Posts are stored under their own pk as rowid and thread titles under the
+negated thread pk, so every document can be replaced or dropped by rowid.
+"""
+
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from forum.search.base import BaseSearchBackend, SearchResults, HitList, SearchHit, BATCH_SIZE
+from forum.search.query import parse_query
+
+FORUM_SEARCH_SQLITE_PATH = getattr(settings, 'FORUM_SEARCH_SQLITE_PATH', None)
+
+CREATE_TABLE = ("CREATE VIRTUAL TABLE IF NOT EXISTS forum_search USING fts5("
+                "body, thread_id UNINDEXED, post_id UNINDEXED, forum_id UNINDEXED, "
+                "tokenize='unicode61')")
+INSERT = ("INSERT OR REPLACE INTO forum_search (rowid, body, thread_id, post_id, forum_id) "
+          "VALUES (?, ?, ?, ?, ?)")
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def match_expression(alternatives):
+    """Writes a parsed query in the FTS5 query syntax."""
+    return u' OR '.join(u'(%s)' % u' AND '.join(u'"%s"' % u' '.join(part) for part in parts)
+                        for parts in alternatives)
+
+class FTSResults(SearchResults):
+    def __init__(self, backend, match, forum_ids):
+        super(FTSResults, self).__init__()
+        self.backend = backend
+        self.match = match
+        self.forum_ids = forum_ids
+
+    def _where(self):
+        sql, params = 'forum_search MATCH ?', [self.match]
+        if self.forum_ids is not None:
+            sql += ' AND forum_id IN (%s)' % ', '.join(['?'] * len(self.forum_ids))
+            params.extend(sorted(self.forum_ids))
+        return sql, params
+
+    def _count(self):
+        where, params = self._where()
+        return self.backend.connection().execute(
+            'SELECT COUNT(*) FROM forum_search WHERE %s' % where, params).fetchone()[0]
+
+    def _fetch(self, offset, limit):
+        where, params = self._where()
+        rows = self.backend.connection().execute(
+            'SELECT thread_id, post_id, rank FROM forum_search WHERE %s ORDER BY rank LIMIT ? OFFSET ?' % where,
+            params + [limit, offset])
+        # FTS5 ranks with BM25 too, the better matches more negative.
+        return [SearchHit(-rank, thread_id, post_id) for thread_id, post_id, rank in rows]
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    def __init__(self, path=None):
+        self.path = path or FORUM_SEARCH_SQLITE_PATH
+        if not self.path:
+            raise ImproperlyConfigured("FORUM_SEARCH_SQLITE_PATH must name the file of the search index.")
+        # sqlite3 connections must stay in the thread that opened them.
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute(CREATE_TABLE)
+            except sqlite3.OperationalError as e:
+                raise ImproperlyConfigured("Cannot set up the search index in %s: %s" % (self.path, e))
+            self._local.connection = connection
+        return connection
+
+    def _post_rowids(self, thread):
+        from forum.models import Post
+        return list(Post.objects.filter(thread=thread).values_list('pk', flat=True))
+
+    def index_thread(self, thread):
+        with self.connection() as connection:
+            connection.execute(INSERT, (-thread.pk, thread.title, thread.pk, None, thread.forum_id))
+
+    def index_post(self, post):
+        with self.connection() as connection:
+            connection.execute(INSERT, (post.pk, post.body, post.thread_id, post.pk, post.thread.forum_id))
+
+    def unindex_thread(self, thread):
+        with self.connection() as connection:
+            for chunk in _chunks([-thread.pk] + self._post_rowids(thread)):
+                connection.execute('DELETE FROM forum_search WHERE rowid IN (%s)' % ', '.join(['?'] * len(chunk)),
+                                   chunk)
+
+    def unindex_post(self, post):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM forum_search WHERE rowid = ?', (post.pk,))
+
+    def move_thread(self, thread):
+        with self.connection() as connection:
+            for chunk in _chunks([-thread.pk] + self._post_rowids(thread)):
+                connection.execute('UPDATE forum_search SET forum_id = ? WHERE rowid IN (%s)' % (
+                                   ', '.join(['?'] * len(chunk))), [thread.forum_id] + chunk)
+
+    def search(self, query, forum_ids=None):
+        alternatives = parse_query(query)
+        if not alternatives or (forum_ids is not None and not forum_ids):
+            return HitList([])
+        return FTSResults(self, match_expression(alternatives), forum_ids)
+
+    def clear(self):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM forum_search')
+
+    def index_threads(self, thread_ids):
+        """Writes many threads with one executemany() per batch."""
+        from forum.models import Thread, Post
+        for chunk in _chunks(thread_ids):
+            rows = [(-pk, title, pk, None, forum_id) for pk, title, forum_id in
+                    Thread.objects.filter(pk__in=chunk).values_list('pk', 'title', 'forum')]
+            rows.extend((pk, body, thread_id, pk, forum_id) for pk, body, thread_id, forum_id in
+                        Post.objects.filter(thread__in=chunk).values_list('pk', 'body', 'thread', 'thread__forum'))
+            with self.connection() as connection:
+                connection.executemany(INSERT, rows)
@@ -0,0 +1,131 @@
+"""
+Snippets and highlighting of search results.
+
+A Highlighter compiles the words of a query into one regex, once per
+query (the last FORUM_HIGHLIGHT_CACHE_SIZE queries are kept), and then
+finds every occurrence of every word in a single pass over a text.
+Everything but the highlight markup is escaped, so the output can go
+into a page as is.
+
+    >>> h = get_highlighter(u'"reverse proxy" nginx')
+    >>> h.snippet(post.body)
+    u'... put <span class="highlight">nginx</span> in front as a <span ...'
+"""
+
+import re
+
+from django.conf import settings
+from django.utils.html import escape, strip_tags
+from django.utils.safestring import mark_safe
+
+from forum.search.query import parse_query, query_words
+from forum.utils import LRUCache
+
+FORUM_HIGHLIGHT_CACHE_SIZE = getattr(settings, 'FORUM_HIGHLIGHT_CACHE_SIZE', 200)
+FORUM_SNIPPET_LENGTH = getattr(settings, 'FORUM_SNIPPET_LENGTH', 200)
+
+HIGHLIGHT_START = u'<span class="highlight">'
+HIGHLIGHT_END = u'</span>'
+ELLIPSIS = u'\u2026'
+
+_ENTITIES = ((u'&lt;', u'<'), (u'&gt;', u'>'), (u'&quot;', u'"'), (u'&#39;', u"'"), (u'&amp;', u'&'))
+
+def html_to_text(html):
+    """The text of rendered HTML such as Post.body_html."""
+    text = strip_tags(html)
+    for entity, char in _ENTITIES:
+        text = text.replace(entity, char)
+    return text
+
+class Highlighter(object):
+    def __init__(self, query):
+        words = sorted(query_words(parse_query(query)), key=len, reverse=True)
+        self.words = words
+        self.pattern = None
+        if words:
+            self.pattern = re.compile(u'(?<!\\w)(?:%s)(?!\\w)' % u'|'.join(re.escape(w) for w in words),
+                                      re.IGNORECASE | re.UNICODE)
+
+    def _matches(self, text):
+        if self.pattern is None:
+            return []
+        return [(m.start(), m.end(), m.group().lower()) for m in self.pattern.finditer(text)]
+
+    def _mark(self, text, matches, offset=0):
+        out, position = [], offset
+        for start, end, word in matches:
+            out.append(escape(text[position:start]))
+            out.append(HIGHLIGHT_START + escape(text[start:end]) + HIGHLIGHT_END)
+            position = end
+        out.append(escape(text[position:]))
+        return u''.join(out)
+
+    def highlight(self, text):
+        """Escapes a text and marks up every word of the query in it."""
+        return mark_safe(self._mark(text, self._matches(text)))
+
+    def _best_window(self, matches, length):
+        """
+        Slides a window of ``length`` characters over the matches and
+        returns the first and last match of the window holding the most
+        distinct words, then the most matches. A match longer than the
+        window makes a window of its own.
+        """
+        best, best_score = (0, 0), (0, 0)
+        seen = {}
+        last = 0
+        for first in range(len(matches)):
+            while last < len(matches) and (last == first or matches[last][1] - matches[first][0] <= length):
+                seen[matches[last][2]] = seen.get(matches[last][2], 0) + 1
+                last += 1
+            score = (len(seen), last - first)
+            if score > best_score:
+                best, best_score = (first, last - 1), score
+            word = matches[first][2]
+            seen[word] -= 1
+            if not seen[word]:
+                del seen[word]
+        return best
+
+    def snippet(self, text, length=FORUM_SNIPPET_LENGTH, html=False):
+        """
+        Returns the passage of about ``length`` characters of a text that
+        holds most of the query, escaped and highlighted. With ``html``
+        the text is rendered HTML, eg. Post.body_html.
+        """
+        if html:
+            text = html_to_text(text)
+        matches = self._matches(text)
+        if not matches:
+            start, end = 0, min(len(text), length)
+        else:
+            first, last = self._best_window(matches, length)
+            # Center the matched span in the window, which grows to hold
+            # a match longer than itself.
+            span_start, span_end = matches[first][0], matches[last][1]
+            start = max(0, span_start - max(0, length - (span_end - span_start)) // 2)
+            end = min(len(text), max(start + length, span_end))
+            start = max(0, min(start, end - length))
+            matches = matches[first:last + 1]
+        # Do not cut words in half.
+        if start > 0:
+            space = text.find(u' ', start, matches and matches[0][0] or end)
+            if space != -1:
+                start = space + 1
+        if end < len(text):
+            space = text.rfind(u' ', matches and matches[-1][1] or start, end)
+            if space != -1:
+                end = space
+        matches = [m for m in matches if m[0] >= start and m[1] <= end]
+        out = self._mark(text[:end], matches, start)
+        return mark_safe(u'%s%s%s' % (start > 0 and ELLIPSIS or u'', out, end < len(text) and ELLIPSIS or u''))
+
+_highlighters = LRUCache(FORUM_HIGHLIGHT_CACHE_SIZE)
+
+def get_highlighter(query):
+    """Returns the Highlighter of a query, compiled once and then cached."""
+    highlighter = _highlighters.get(query)
+    if highlighter is None:
+        highlighter = Highlighter(query)
+        _highlighters.set(query, highlighter)
+    return highlighter
@@ -0,0 +1,247 @@
+"""
+The default search backend: an inverted index over thread titles and
+post bodies, kept in the SearchTerm, SearchDocument and SearchPosting
+tables, and BM25 ranked queries against it.
+"""
+
+import heapq
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection
+from django.db.models import Count, Sum
+
+from forum.search.base import BaseSearchBackend, HitList, SearchHit
+from forum.search.query import tokenize, parse_query, query_words
+from forum.utils import atomic, on_commit
+
+# A query only ranks the newest documents matching it, and only returns
+# the best of those.
+FORUM_SEARCH_MAX_CANDIDATES = getattr(settings, 'FORUM_SEARCH_MAX_CANDIDATES', 5000)
+FORUM_SEARCH_MAX_RESULTS = getattr(settings, 'FORUM_SEARCH_MAX_RESULTS', 1000)
+
+# BM25 parameters: term frequency saturation and length normalization.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# The document count and average length only drift slowly.
+STATS_KEY = 'forum:search:stats'
+STATS_TIMEOUT = 300
+
+# Keeps "IN (...)" lists below SQLite's limit of 999 query parameters.
+BATCH_SIZE = 300
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _term_ids(words):
+    """Returns {word: SearchTerm pk}, creating the missing terms."""
+    from forum.models import SearchTerm
+    ids = {}
+    for chunk in _chunks(words):
+        ids.update(SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk'))
+    missing = [word for word in words if word not in ids]
+    if missing:
+        try:
+            with atomic():
+                SearchTerm.objects.bulk_create([SearchTerm(term=word) for word in missing])
+        except IntegrityError:
+            # Somebody else added some of them meanwhile.
+            for word in missing:
+                SearchTerm.objects.get_or_create(term=word)
+        for chunk in _chunks(missing):
+            ids.update(SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk'))
+    return ids
+
+def _write_counts(deltas):
+    """
+    Adds {term pk: delta} to the document counts of the terms, with one
+    UPDATE ... CASE statement per batch, in a transaction of its own. The
+    rows are locked in pk order so concurrent writers queue up rather
+    than deadlock.
+    """
+    from forum.models import SearchTerm
+    qn = connection.ops.quote_name
+    table = qn(SearchTerm._meta.db_table)
+    pk_column = qn(SearchTerm._meta.pk.column)
+    column = qn(SearchTerm._meta.get_field('documents').column)
+    with atomic():
+        cursor = connection.cursor()
+        for chunk in _chunks(sorted(pk for pk, delta in deltas.items() if delta)):
+            list(SearchTerm.objects.select_for_update().filter(pk__in=chunk).order_by('pk').values_list('pk', flat=True))
+            params = []
+            for pk in chunk:
+                params.extend([pk, deltas[pk]])
+            params.extend(chunk)
+            cursor.execute('UPDATE %s SET %s = %s + CASE %s %s END WHERE %s IN (%s)' % (
+                table, column, column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                pk_column, ', '.join(['%s'] * len(chunk))), params)
+
+def _count_documents(deltas):
+    """
+    Adds {term pk: delta} to the document counts once the current
+    transaction commits: the rows of common words are wanted by every
+    post, and must not stay locked until then.
+    """
+    if deltas:
+        on_commit(lambda: _write_counts(deltas))
+
+def _add_document(thread, post, text):
+    from forum.models import SearchDocument, SearchPosting
+    words = tokenize(text)
+    document = SearchDocument.objects.create(thread=thread, post=post, forum_id=thread.forum_id,
+                                             length=len(words))
+    positions = {}
+    for i, word in enumerate(words):
+        positions.setdefault(word, []).append(str(i))
+    ids = _term_ids(positions.keys())
+    SearchPosting.objects.bulk_create([
+        SearchPosting(term_id=ids[word], document=document, positions=' '.join(offsets))
+        for word, offsets in positions.items()])
+    _count_documents(dict((pk, 1) for pk in ids.values()))
+
+def _remove_documents(documents):
+    from forum.models import SearchDocument, SearchPosting
+    deltas = {}
+    for chunk in _chunks(documents.values_list('pk', flat=True)):
+        postings = SearchPosting.objects.filter(document__in=chunk)
+        for term_id, n in postings.order_by().values_list('term').annotate(n=Count('id')):
+            deltas[term_id] = deltas.get(term_id, 0) - n
+        postings.delete()
+        SearchDocument.objects.filter(pk__in=chunk).delete()
+    _count_documents(deltas)
+
+def _collection_stats():
+    """Returns the number of documents and their average length."""
+    from forum.models import SearchDocument
+    stats = cache.get(STATS_KEY)
+    if stats is None:
+        totals = SearchDocument.objects.aggregate(n=Count('id'), words=Sum('length'))
+        n = totals['n'] or 0
+        stats = (n, n and float(totals['words'] or 0) / n or 0.0)
+        cache.set(STATS_KEY, stats, STATS_TIMEOUT)
+    return stats
+
+def _has_phrase(offsets):
+    """Whether the lists of word offsets follow each other somewhere."""
+    following = [set(o) for o in offsets[1:]]
+    for start in offsets[0]:
+        if all(start + i + 1 in s for i, s in enumerate(following)):
+            return True
+    return False
+
+def _candidates(term_ids, forum_ids):
+    """
+    The pks of the documents holding all the terms, newest first and at
+    most FORUM_SEARCH_MAX_CANDIDATES of them. The posting lists are
+    intersected in SQL, driven by the first (rarest) term.
+    """
+    from forum.models import SearchPosting
+    qs = SearchPosting.objects.filter(term=term_ids[0])
+    for pk in term_ids[1:]:
+        qs = qs.filter(document__in=SearchPosting.objects.filter(term=pk).values('document'))
+    if forum_ids is not None:
+        qs = qs.filter(document__forum__in=forum_ids)
+    return list(qs.order_by('-document').values_list('document', flat=True)[:FORUM_SEARCH_MAX_CANDIDATES])
+
+def _search(query, forum_ids):
+    from forum.models import SearchTerm, SearchDocument, SearchPosting
+    alternatives = parse_query(query)
+    words = query_words(alternatives)
+    if not words:
+        return []
+
+    terms = {}
+    for chunk in _chunks(words):
+        for pk, word, documents in SearchTerm.objects.filter(term__in=chunk).values_list('pk', 'term', 'documents'):
+            terms[word] = (pk, documents)
+
+    if forum_ids is not None and not forum_ids:
+        return []
+
+    words_of = dict((pk, word) for word, (pk, documents) in terms.items())
+    # {(word, document pk): "offsets"}, of the candidates only
+    positions = {}
+    loaded = set()
+    matched = set()
+    for parts in alternatives:
+        needed = set(word for part in parts for word in part)
+        if not needed.issubset(terms):
+            continue
+        rarest_first = sorted(needed, key=lambda w: terms[w][1])
+        candidates = _candidates([terms[w][0] for w in rarest_first], forum_ids)
+        for chunk in _chunks([doc for doc in candidates if doc not in loaded]):
+            for term_id, doc, offsets in SearchPosting.objects.filter(
+                    term__in=list(words_of), document__in=chunk).values_list('term', 'document', 'positions'):
+                positions[(words_of[term_id], doc)] = offsets
+            loaded.update(chunk)
+        for doc in candidates:
+            if all(_has_phrase([[int(o) for o in positions[(w, doc)].split()] for w in part])
+                   for part in parts if len(part) > 1):
+                matched.add(doc)
+    if not matched:
+        return []
+
+    n, average_length = _collection_stats()
+    idf = dict((word, math.log(1 + (n - documents + 0.5) / (documents + 0.5)))
+               for word, (pk, documents) in terms.items())
+    hits = []
+    for chunk in _chunks(matched):
+        for doc, length, thread_id, post_id in SearchDocument.objects.filter(pk__in=chunk).values_list(
+                'pk', 'length', 'thread', 'post'):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+            score = 0.0
+            for word in terms:
+                if (word, doc) in positions:
+                    tf = positions[(word, doc)].count(' ') + 1
+                    score += idf[word] * tf * (BM25_K1 + 1) / (tf + norm)
+            hits.append((score, doc, SearchHit(score, thread_id, post_id)))
+    hits = heapq.nlargest(FORUM_SEARCH_MAX_RESULTS, hits, key=lambda h: (h[0], h[1]))
+    return [hit for score, doc, hit in hits]
+
+class DatabaseBackend(BaseSearchBackend):
+    def index_thread(self, thread):
+        from forum.models import SearchDocument
+        with atomic():
+            _remove_documents(SearchDocument.objects.filter(thread=thread, post__isnull=True))
+            _add_document(thread, None, thread.title)
+
+    def index_post(self, post):
+        from forum.models import SearchDocument
+        with atomic():
+            _remove_documents(SearchDocument.objects.filter(post=post))
+            _add_document(post.thread, post, post.body)
+
+    def unindex_thread(self, thread):
+        from forum.models import SearchDocument
+        with atomic():
+            _remove_documents(SearchDocument.objects.filter(thread=thread))
+
+    def unindex_post(self, post):
+        from forum.models import SearchDocument
+        with atomic():
+            _remove_documents(SearchDocument.objects.filter(post=post))
+
+    def unindex_forum(self, forum):
+        from forum.models import SearchDocument
+        with atomic():
+            _remove_documents(SearchDocument.objects.filter(forum=forum))
+
+    def move_thread(self, thread):
+        from forum.models import SearchDocument
+        SearchDocument.objects.filter(thread=thread).update(forum=thread.forum_id)
+
+    def search(self, query, forum_ids=None):
+        # The candidates are all scored to rank them, so the hits are kept.
+        return HitList(_search(query, forum_ids))
+
+    def clear(self):
+        from forum.models import SearchTerm, SearchDocument, SearchPosting
+        with atomic():
+            SearchPosting.objects.all().delete()
+            SearchDocument.objects.all().delete()
+            SearchTerm.objects.all().delete()
+        cache.delete(STATS_KEY)
@@ -0,0 +1,46 @@
+"""
+Turns text into index terms and search queries into what to look for.
+"""
+
+import re
+
+from django.utils.encoding import force_text
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+# Longer words are left out of the index (see SearchTerm.term).
+MAX_TERM_LENGTH = 64
+
+def tokenize(text):
+    """Returns the lower-cased words of a text, in order."""
+    return [word for word in WORD_RE.findall(force_text(text).lower())
+            if len(word) <= MAX_TERM_LENGTH]
+
+def parse_query(query):
+    """
+    Parses a query into a list of alternatives, separated by OR. Each
+    alternative is a list of parts which must all match, and each part a
+    tuple of words: one for a plain word, several for a "quoted phrase"
+    or a word such as e-mail that tokenizes into several.
+
+        >>> parse_query(u'django "full text" OR whoosh')
+        [[(u'django',), (u'full', u'text')], [(u'whoosh',)]]
+    """
+    alternatives, current = [], []
+    for phrase, word in QUERY_RE.findall(force_text(query)):
+        if word == 'OR':
+            if current:
+                alternatives.append(current)
+            current = []
+            continue
+        words = tuple(tokenize(phrase or word))
+        if words:
+            current.append(words)
+    if current:
+        alternatives.append(current)
+    return alternatives
+
+def query_words(alternatives):
+    """The set of distinct words of a parsed query."""
+    return set(word for parts in alternatives for part in parts for word in part)
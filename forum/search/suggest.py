@@ -0,0 +1,211 @@
+"""
+Search-as-you-type suggestions of thread titles.
+
+Every process keeps a sorted list of (word, thread pk) pairs of all the
+titles, so the threads with a word starting with a prefix are found with
+bisect, and the best ones are picked by weight: posts count for
+FORUM_SUGGEST_POST_WEIGHT views each. The top threads of recent prefixes
+are remembered too.
+
+Changed threads are announced, with their new title and forum, through a
+numbered log in the cache backend, once the change is committed. Once per
+request, a process compares the log's sequence number with its own and
+applies just the changes since. It builds everything again when it fell
+too far behind, and every FORUM_SUGGEST_REBUILD_INTERVAL seconds so the
+weights stay current. Building reads the whole Thread table, so it runs
+in a background thread while requests keep using the current index (and
+get no suggestions before the first one is built).
+"""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection
+
+from forum.search.query import tokenize
+from forum.utils import CACHE_FOREVER, LRUCache
+
+FORUM_SUGGEST_POST_WEIGHT = getattr(settings, 'FORUM_SUGGEST_POST_WEIGHT', 10)
+FORUM_SUGGEST_MIN_LENGTH = getattr(settings, 'FORUM_SUGGEST_MIN_LENGTH', 2)
+FORUM_SUGGEST_REBUILD_INTERVAL = getattr(settings, 'FORUM_SUGGEST_REBUILD_INTERVAL', 60 * 60)
+
+SEQUENCE_KEY = 'forum:suggest:sequence'
+CHANGE_KEY = 'forum:suggest:change:%d'
+CHANGE_TIMEOUT = 60 * 60
+# Further behind than this, a process rebuilds instead of replaying.
+MAX_REPLAY = 1000
+
+# Number of prefixes, and of threads per prefix, remembered.
+PREFIX_CACHE_SIZE = 1000
+PREFIX_CACHE_DEPTH = 50
+
+def _row(title, forum_id, posts, views):
+    return (title, forum_id, (posts or 0) * FORUM_SUGGEST_POST_WEIGHT + (views or 0), frozenset(tokenize(title)))
+
+def _current_sequence():
+    cache.add(SEQUENCE_KEY, 0, CACHE_FOREVER)
+    return cache.get(SEQUENCE_KEY) or 0
+
+class TitleIndex(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = []
+        # thread pk -> (title, forum pk, weight, words)
+        self._threads = {}
+        self._sequence = None
+        self._built = 0
+        self._building = False
+        self._checked = False
+        self._prefixes = LRUCache(PREFIX_CACHE_SIZE)
+
+    def _build(self, sequence):
+        from forum.models import Thread
+        threads, entries = {}, []
+        for pk, title, forum_id, posts, views in Thread.objects.values_list(
+                'pk', 'title', 'forum', 'posts', 'views').iterator():
+            row = _row(title, forum_id, posts, views)
+            threads[pk] = row
+            entries.extend((word, pk) for word in row[3])
+        entries.sort()
+        with self._lock:
+            self._threads, self._entries = threads, entries
+            self._prefixes = LRUCache(PREFIX_CACHE_SIZE)
+            self._sequence = sequence
+            self._built = time.time()
+
+    def _build_in_background(self, sequence):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def build():
+            try:
+                self._build(sequence)
+            finally:
+                self._building = False
+                connection.close()
+        worker = threading.Thread(target=build, name='forum-suggest-build')
+        worker.daemon = True
+        worker.start()
+
+    def _apply(self, changes, sequence):
+        """Applies {thread pk: (title, forum pk), or None when deleted}."""
+        from forum.models import Thread
+        # The title and forum come from the log; the weights may lag.
+        weights = dict((pk, (posts, views)) for pk, posts, views in Thread.objects.filter(
+            pk__in=[pk for pk, change in changes.items() if change]).values_list('pk', 'posts', 'views'))
+        with self._lock:
+            entries = self._entries
+            for pk, change in changes.items():
+                old = self._threads.pop(pk, None)
+                for word in old and old[3] or ():
+                    i = bisect_left(entries, (word, pk))
+                    if i < len(entries) and entries[i] == (word, pk):
+                        del entries[i]
+                if change:
+                    row = _row(change[0], change[1], *weights.get(pk, (0, 0)))
+                    self._threads[pk] = row
+                    for word in row[3]:
+                        insort(entries, (word, pk))
+            self._prefixes = LRUCache(PREFIX_CACHE_SIZE)
+            self._sequence = sequence
+
+    def _refresh(self):
+        sequence = _current_sequence()
+        behind = self._sequence is None or sequence < self._sequence or sequence - self._sequence > MAX_REPLAY
+        if behind or time.time() - self._built > FORUM_SUGGEST_REBUILD_INTERVAL:
+            self._build_in_background(sequence)
+        if not behind and sequence > self._sequence:
+            first = self._sequence + 1
+            keys = [CHANGE_KEY % n for n in range(first, sequence + 1)]
+            found = cache.get_many(keys)
+            if len(found) < len(keys):
+                # Part of the log expired or is still being written.
+                self._build_in_background(sequence)
+            else:
+                # In log order, so the latest change of a thread wins.
+                changes = dict(found[CHANGE_KEY % n] for n in range(first, sequence + 1))
+                self._apply(changes, sequence)
+
+    def expire(self, **kwargs):
+        """Makes the next lookup check the log for changes."""
+        self._checked = False
+
+    def changed(self, thread_id, title=None, forum_id=None):
+        """
+        Announces that a thread was created or changed (give its title
+        and forum), or deleted. Call it once the change is committed.
+        """
+        cache.add(SEQUENCE_KEY, 0, CACHE_FOREVER)
+        try:
+            sequence = cache.incr(SEQUENCE_KEY)
+        except ValueError:
+            # Evicted meanwhile: everybody rebuilds anyway.
+            return
+        change = title is not None and (title, forum_id) or None
+        cache.set(CHANGE_KEY % sequence, (thread_id, change), CHANGE_TIMEOUT)
+        self._checked = False
+
+    def invalidate(self):
+        """Makes every process build its index again, eg. after a bulk load."""
+        cache.add(SEQUENCE_KEY, 0, CACHE_FOREVER)
+        try:
+            cache.incr(SEQUENCE_KEY, MAX_REPLAY + 1)
+        except ValueError:
+            pass
+        self._checked = False
+
+    def _scan(self, prefix, limit, accept=None):
+        """The ``limit`` heaviest threads with a word starting with ``prefix``."""
+        entries = self._entries
+        candidates = set()
+        i = bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            pk = entries[i][1]
+            if accept is None or accept(pk):
+                candidates.add(pk)
+            i += 1
+        return heapq.nlargest(limit, candidates, key=lambda pk: (self._threads[pk][2], pk))
+
+    def suggest(self, text, forum_ids=None, limit=10):
+        """
+        Returns up to ``limit`` (thread pk, title) pairs, heaviest first,
+        for the text typed so far: its last word is taken as a prefix and
+        the words before it must all be in the title. With ``forum_ids``
+        only threads of those forums are returned.
+        """
+        words = tokenize(text)
+        if not words or (len(words) == 1 and len(words[0]) < FORUM_SUGGEST_MIN_LENGTH):
+            return []
+        if not self._checked:
+            self._refresh()
+            self._checked = True
+        complete, prefix = words[:-1], words[-1]
+
+        with self._lock:
+            threads = self._threads
+
+            def accept(pk):
+                title, forum_id, weight, title_words = threads[pk]
+                return ((forum_ids is None or forum_id in forum_ids) and
+                        all(word in title_words for word in complete))
+
+            top = self._prefixes.get(prefix)
+            if top is None:
+                top = self._scan(prefix, PREFIX_CACHE_DEPTH)
+                self._prefixes.set(prefix, top)
+            hits = [pk for pk in top if accept(pk)][:limit]
+            if len(hits) < limit and len(top) == PREFIX_CACHE_DEPTH:
+                # The remembered top threads were not enough after filtering.
+                hits = self._scan(prefix, limit, accept)
+            return [(pk, threads[pk][0]) for pk in hits]
+
+titles = TitleIndex()
+
+request_started.connect(titles.expire, dispatch_uid='forum.search.suggest.expire')
@@ -1,33 +1,128 @@
+"""
+Sitemaps of the forums, threads and posts open to anonymous users.
+
+Threads and posts are read in primary key order, CHUNK_SIZE rows at a
+time by pk range, and only as (pk, lastmod) pairs from the denormalized
+columns, so no section ever loads its rows at once. Each page of a
+section covers a range of Sitemap.limit (50,000) pks, so serving any page
+seeks straight to it.
+
+For large boards `./manage.py forum_sitemaps <directory>` writes the
+whole set as static gzipped files for the web server to serve.
+"""
+
+import abc
+
 from django.contrib.sitemaps import Sitemap
 from django.core.urlresolvers import reverse
+from django.db.models import Max
 
 from forum.models import Forum, Thread, Post
 
+# Rows read per query.
+CHUNK_SIZE = 5000
+
+def _public_ids():
+    return Forum.objects.accessible_ids(None)
+
+class IdRangeList(object):
+    """
+    The (pk, lastmod) pairs of a queryset in pk order, addressed by pk
+    rather than by position: slice [start:stop] holds the rows with
+    start < pk <= stop, and the length is the highest pk. So Django's
+    sitemap paginator cuts a section into pk ranges of Sitemap.limit, and
+    every page is read by seeking the pk index, without any OFFSET. Pages
+    hold fewer URLs where there are gaps in the pks.
+    """
+    def __init__(self, queryset, lastmod_field):
+        self.queryset = queryset.order_by('pk')
+        self.lastmod_field = lastmod_field
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.queryset.aggregate(top=Max('pk'))['top'] or 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.iterate()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step:
+            raise TypeError("IdRangeList only supports plain slices.")
+        start, stop = k.start or 0, k.stop
+        if stop is not None and stop <= start:
+            return []
+        return list(self.iterate(start, stop))
+
+    def iterate(self, after=0, until=None):
+        """Yields the pairs with after < pk <= until, CHUNK_SIZE rows per query."""
+        rows = self.queryset.values_list('pk', self.lastmod_field)
+        if until is not None:
+            rows = rows.filter(pk__lte=until)
+        while True:
+            pairs = list(rows.filter(pk__gt=after)[:CHUNK_SIZE])
+            for pair in pairs:
+                yield pair
+            if len(pairs) < CHUNK_SIZE:
+                return
+            after = pairs[-1][0]
+
+class ChunkedSitemap(Sitemap):
+    """A sitemap of (pk, lastmod) pairs linking to the named URL of each pk."""
+    __metaclass__ = abc.ABCMeta
+
+    url_name = None
+    lastmod_field = None
+
+    @abc.abstractmethod
+    def get_queryset(self):
+        """Returns the rows of the section, in any order."""
+
+    def items(self):
+        return IdRangeList(self.get_queryset(), self.lastmod_field)
+
+    def location(self, item):
+        if not hasattr(self, '_url'):
+            # One reverse() per section rather than per URL.
+            self._url = reverse(self.url_name, args=[987654321]).replace('%', '%%').replace('987654321', '%d')
+        return self._url % item[0]
+
+    def lastmod(self, item):
+        return item[1]
+
 class ForumSitemap(Sitemap):
     changefreq = 'weekly'
 
     def items(self):
-        return Forum.objects.all()
+        return Forum.objects.filter(pk__in=_public_ids()).select_related('last_post')
 
-    def last_mod(self, obj):
-        return obj._get_forum_latest_post.time
+    def lastmod(self, obj):
+        return obj.last_post_id and obj.last_post.time or None
 
 
-class ThreadSitemap(Sitemap):
+class ThreadSitemap(ChunkedSitemap):
     changefreq = 'daily'
+    url_name = 'forum_view_thread'
+    lastmod_field = 'latest_post_time'
 
-    def items(self):
-        return Thread.objects.all()
+    def get_queryset(self):
+        return Thread.objects.filter(forum__in=_public_ids())
 
-    def last_mod(self, obj):
-        return obj.latest_post_time
 
-
-class PostSitemap(Sitemap):
+class PostSitemap(ChunkedSitemap):
     changefreq = 'weekly'
+    url_name = 'forum_view_post'
+    lastmod_field = 'time'
 
-    def items(self):
-        return Post.objects.all()
+    def get_queryset(self):
+        return Post.objects.filter(thread__forum__in=_public_ids())
 
-    def last_mod(self, obj):
-        return obj.time
+sitemaps = {
+    'forums': ForumSitemap,
+    'threads': ThreadSitemap,
+    'posts': PostSitemap,
+}
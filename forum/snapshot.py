@@ -0,0 +1,179 @@
+"""
+A per-process snapshot of all forums for the forum index.
+
+The snapshot holds every forum with its counters and latest post,
+arranged as a tree, and is filtered per user by the forums they may see
+(Forum.objects.accessible_ids()). It is built with a couple of queries
+and then kept up to date without reading everything again:
+
+ * once per request, the board change stamp is compared with the one the
+   snapshot was last checked at (see forum.stamps);
+ * when it changed, the stamps of all forums are fetched from the cache
+   in one go, and only the forums whose stamp changed are read again;
+ * when the forum tree changed (a forum was added, edited, moved or
+   deleted, see forum.forumtree), the snapshot is built from scratch;
+ * so is a snapshot older than FORUM_SNAPSHOT_MAX_AGE seconds, which
+   bounds how long a change made without touching the stamps (or a lost
+   stamp) can go unseen.
+
+So the index normally renders its forum list without any query.
+
+    >>> from forum.snapshot import snapshot
+    >>> snapshot.roots(Forum.objects.accessible_ids(user))
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+
+from forum import stamps
+from forum.forumtree import VERSION_KEY as TREE_VERSION_KEY, tree as forumtree
+
+FORUM_SNAPSHOT_MAX_AGE = getattr(settings, 'FORUM_SNAPSHOT_MAX_AGE', 10 * 60)
+
+FIELDS = ('pk', 'parent', 'slug', 'title', 'description', 'threads', 'posts', 'ordering', 'depth',
+          'last_post', 'last_post__time', 'last_poster__username')
+
+class LatestPost(object):
+    def __init__(self, pk, time):
+        self.pk = self.id = pk
+        self.time = time
+
+    def get_absolute_url(self):
+        return reverse('forum_view_post', args=[self.pk])
+
+class ForumSummary(object):
+    """A forum as the index shows it, standing in for a Forum in templates."""
+    def __init__(self, row):
+        (self.pk, self.parent_id, self.slug, self.title, self.description, self.threads, self.posts,
+         self.ordering, self.depth, last_post_id, last_post_time, self.last_poster) = row
+        self.id = self.pk
+        self.last_post_id = last_post_id
+        self.last_post = last_post_id and LatestPost(last_post_id, last_post_time) or None
+        self.child_ids = []
+
+    forum_latest_post = property(lambda self: self.last_post)
+
+    def get_absolute_url(self):
+        return forumtree.get(self)[2][-1]
+
+    def get_url_name(self):
+        slugs, titles, urls = forumtree.get(self)
+        return zip(titles, urls)
+
+    def __unicode__(self):
+        return u'%s' % self.title
+
+def _sort_key(forum):
+    # Forum.Meta.ordering
+    return (forum.ordering, forum.title)
+
+class ForumIndexSnapshot(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = False
+        self._built = False
+        self._built_at = 0
+        self._tree_version = None
+        self._board_token = None
+        # forum pk -> ForumSummary, and forum pk -> stamp token
+        self._forums = {}
+        self._tokens = {}
+        self._roots = []
+
+    def _rows(self, **filters):
+        from forum.models import Forum
+        return Forum.objects.filter(**filters)
+
+    def _link(self, forums):
+        roots = []
+        for forum in forums.values():
+            parent = forums.get(forum.parent_id)
+            if parent is not None:
+                parent.child_ids.append(forum.pk)
+            else:
+                roots.append(forum)
+        for forum in forums.values():
+            forum.child_ids.sort(key=lambda pk: _sort_key(forums[pk]))
+        roots.sort(key=_sort_key)
+        return [forum.pk for forum in roots]
+
+    def _tokens_of(self, forums):
+        """
+        The current stamp token of each forum. A missing stamp counts as a
+        token of its own: it was evicted, and the next change sets it.
+        """
+        keys = dict((stamps.KEY % ('forum', pk), pk) for pk in forums)
+        found = cache.get_many(keys.keys())
+        return dict((pk, found.get(key, (None, None))[1]) for key, pk in keys.items())
+
+    def _build(self, tree_version, board_token):
+        # Stamps first: rows read afterwards are at least as recent.
+        tokens = self._tokens_of(self._rows().values_list('pk', flat=True))
+        forums = dict((row[0], ForumSummary(row)) for row in self._rows().values_list(*FIELDS))
+        roots = self._link(forums)
+        with self._lock:
+            self._forums, self._roots, self._tokens = forums, roots, tokens
+            self._tree_version, self._board_token = tree_version, board_token
+            self._built = True
+            self._built_at = time.time()
+
+    def _update(self, board_token):
+        """Reads the forums whose stamp changed since the last check again."""
+        forums = self._forums
+        tokens = self._tokens_of(forums)
+        changed = [pk for pk, token in tokens.items() if token != self._tokens.get(pk)]
+        if changed:
+            forums = dict(forums)
+            for row in self._rows(pk__in=changed).values_list(*FIELDS):
+                forum = ForumSummary(row)
+                if forum.pk in forums:
+                    forum.child_ids = forums[forum.pk].child_ids
+                    forums[forum.pk] = forum
+        with self._lock:
+            self._forums, self._tokens, self._board_token = forums, tokens, board_token
+
+    def _check(self):
+        if self._checked:
+            return
+        found = cache.get_many([TREE_VERSION_KEY, stamps.KEY % ('board', 0)])
+        tree_version = found.get(TREE_VERSION_KEY)
+        board_token = found.get(stamps.KEY % ('board', 0), (None, None))[1]
+        if (not self._built or tree_version != self._tree_version or
+                time.time() - self._built_at > FORUM_SNAPSHOT_MAX_AGE):
+            self._build(tree_version, board_token)
+        elif board_token != self._board_token:
+            self._update(board_token)
+        self._checked = True
+
+    def expire(self, **kwargs):
+        """Makes the next lookup compare against the shared stamps."""
+        self._checked = False
+
+    def roots(self, forum_ids):
+        """The top level forums among ``forum_ids``, in display order."""
+        self._check()
+        forums = self._forums
+        return [forums[pk] for pk in self._roots if pk in forum_ids]
+
+    def children(self, forum, forum_ids):
+        """The direct sub-forums (of a forum or pk) among ``forum_ids``."""
+        self._check()
+        forums = self._forums
+        parent = forums.get(getattr(forum, 'pk', forum))
+        if parent is None:
+            return []
+        return [forums[pk] for pk in parent.child_ids if pk in forum_ids]
+
+    def get(self, pk):
+        """The summary of a forum, or None."""
+        self._check()
+        return self._forums.get(pk)
+
+snapshot = ForumIndexSnapshot()
+
+request_started.connect(snapshot.expire, dispatch_uid='forum.snapshot.expire')
@@ -0,0 +1,50 @@
+"""
+Change stamps of threads, forums and the whole board.
+
+A stamp is a (last modified, token) pair kept in the cache backend: the
+time of the last change as seconds since the epoch, and a random token
+that is replaced on every change. Thread and Post save()/delete() touch
+the stamps of the thread, of its forum and the forum's parents, and of
+the board, so anything rendered from them (feeds, cached pages) can be
+validated with one cache lookup and keyed on the token.
+"""
+
+import calendar
+import time
+import uuid
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from forum.utils import CACHE_FOREVER
+
+KEY = 'forum:stamp:%s:%s'
+
+def epoch(when):
+    """Seconds since the epoch of a datetime, aware or naive (local)."""
+    if when is None:
+        return 0
+    if timezone.is_aware(when):
+        return calendar.timegm(when.utctimetuple())
+    return int(time.mktime(when.timetuple()))
+
+def get(kind, pk, compute):
+    """
+    Returns the stamp of a 'thread', 'forum' or the 'board' (pk 0). When
+    it is not cached, compute() must return the time of the last change
+    as known from the database.
+    """
+    key = KEY % (kind, pk)
+    stamp = cache.get(key)
+    if stamp is None:
+        cache.add(key, (epoch(compute()), uuid.uuid4().hex), CACHE_FOREVER)
+        stamp = cache.get(key)
+    return stamp
+
+def touch(thread_id=None, forum_ids=(), when=None):
+    """Marks a thread, some forums and the board as changed at ``when`` (now)."""
+    stamp = (epoch(when or timezone.now()), uuid.uuid4().hex)
+    keys = [KEY % ('board', 0)] + [KEY % ('forum', pk) for pk in forum_ids]
+    if thread_id:
+        keys.append(KEY % ('thread', thread_id))
+    cache.set_many(dict((key, stamp) for key in keys), CACHE_FOREVER)
@@ -0,0 +1,97 @@
+"""
+Activity statistics read from the hourly ForumActivity buckets.
+
+Every function takes an optional forum; activity in its sub-forums is
+included, like the posts/threads counters of a Forum. Without a forum the
+figures are for the whole site. Pass ``forum_ids`` (eg.
+Forum.objects.accessible_ids(user)) to count only the forums a user may
+see. Counters come back as dicts with 'posts',
+'threads' and 'views' keys.
+
+    >>> from forum import stats
+    >>> stats.today(forum)['posts']
+    >>> stats.last_days(forum, 7)
+    >>> stats.daily(forum, 30)     # [(date, counters), ...] oldest first
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from forum.models import ForumActivity
+
+FIELDS = ('posts', 'threads', 'views')
+
+def _start_of_day(when):
+    if getattr(settings, 'USE_TZ', False):
+        when = timezone.localtime(when)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _local_date(when):
+    if getattr(settings, 'USE_TZ', False):
+        when = timezone.localtime(when)
+    return when.date()
+
+def _buckets(forum, since, forum_ids=None):
+    qs = ForumActivity.objects.filter(hour__gte=since)
+    if forum is not None:
+        qs = qs.filter(forum__path__startswith=forum.get_path())
+    if forum_ids is not None:
+        qs = qs.filter(forum__in=forum_ids)
+    return qs
+
+def _totals(qs):
+    totals = qs.aggregate(**dict((name, Sum(name)) for name in FIELDS))
+    return dict((name, totals[name] or 0) for name in FIELDS)
+
+def today(forum=None, forum_ids=None):
+    """Activity since midnight."""
+    return _totals(_buckets(forum, _start_of_day(timezone.now()), forum_ids))
+
+def last_hours(forum=None, hours=24, forum_ids=None):
+    """Activity during the last ``hours`` hours, the current one included."""
+    since = timezone.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=hours - 1)
+    return _totals(_buckets(forum, since, forum_ids))
+
+def last_days(forum=None, days=7, forum_ids=None):
+    """Activity during the last ``days`` days, today included."""
+    since = _start_of_day(timezone.now()) - datetime.timedelta(days=days - 1)
+    return _totals(_buckets(forum, since, forum_ids))
+
+def hourly(forum=None, hours=24, forum_ids=None):
+    """
+    Activity per hour for the last ``hours`` hours, oldest first, with
+    empty hours included.
+    """
+    current = timezone.now().replace(minute=0, second=0, microsecond=0)
+    since = current - datetime.timedelta(hours=hours - 1)
+    rows = _buckets(forum, since, forum_ids).values('hour').annotate(**dict((name, Sum(name)) for name in FIELDS))
+    by_hour = dict((row['hour'], row) for row in rows)
+
+    series = []
+    for n in range(hours):
+        hour = since + datetime.timedelta(hours=n)
+        row = by_hour.get(hour, {})
+        series.append((hour, dict((name, row.get(name) or 0) for name in FIELDS)))
+    return series
+
+def daily(forum=None, days=30, forum_ids=None):
+    """
+    Activity per day for the last ``days`` days, oldest first, with empty
+    days included. Meant for trend graphs.
+    """
+    first_day = _start_of_day(timezone.now()) - datetime.timedelta(days=days - 1)
+    rows = _buckets(forum, first_day, forum_ids).values('hour').annotate(**dict((name, Sum(name)) for name in FIELDS))
+
+    by_day = {}
+    for row in rows:
+        day = by_day.setdefault(_local_date(row['hour']), dict.fromkeys(FIELDS, 0))
+        for name in FIELDS:
+            day[name] += row[name] or 0
+
+    start = first_day.date()
+    return [(start + datetime.timedelta(days=n),
+             by_day.get(start + datetime.timedelta(days=n), dict.fromkeys(FIELDS, 0)))
+            for n in range(days)]
@@ -1,33 +1,48 @@
-from forum.models import Thread, Post
+from forum.models import Forum
+from forum import activity
 from django.utils.translation import ugettext as _
 from django.template import Library, Node, TemplateSyntaxError, Variable, resolve_variable
-from django.utils.safestring import mark_safe
-import re
+from django.utils.encoding import force_text
+from forum.search.highlight import get_highlighter
 
 register = Library()
 
+def _latest_tag_args(bits, default_var, leading=0):
+    """
+    Parses the optional '[number] as [context_var]' ending of the latest
+    activity tags, after ``leading`` positional arguments.
+    """
+    args = bits[1 + leading:]
+    number, context_var = 5, default_var
+    if args and args[0] != 'as':
+        number = args.pop(0)
+    if args:
+        if len(args) != 2 or args[0] != 'as':
+            raise TemplateSyntaxError("%s tag must end with 'as [context_var]'" % bits[0])
+        context_var = args[1]
+    try:
+        return int(number), context_var
+    except ValueError:
+        raise TemplateSyntaxError('%s tag requires a number of items' % bits[0])
+
+def _visible_forum_ids(context):
+    return Forum.objects.accessible_ids(context.get('user'))
+
 def forum_latest_thread_activity(parser, token):
     """
     {% forum_latest_thread_activity [number] as [context_var] %}
     """
     bits = token.contents.split()
-    if len(bits) not in (1, 2, 4):
-        raise TemplateSyntaxError('%s tag requires none, one or three arguments' % bits[0])
-    if bits[2] != 'as':
-        raise TemplateSyntaxError("Second argument to %s tag must be 'as'" % bits[0])
-    if not bits[1]:
-        bits[1] = 5 # Default number of items
-    if not bits[3]:
-        bits[3] = 'latest_thread_activity'
-    return ForumLatestThreadsNode(bits[1], bits[3])
+    number, context_var = _latest_tag_args(bits, 'latest_thread_activity')
+    return ForumLatestThreadsNode(number, context_var)
 
 class ForumLatestThreadsNode(Node):
     def __init__(self, number, context_var):
-        self.number = int(number) - 1
+        self.number = number
         self.context_var = context_var
 
     def render(self, context):
-        context[self.context_var] = Thread.objects.select_related().order_by('-latest_post_time')[:self.number]
+        context[self.context_var] = activity.latest_threads(self.number, _visible_forum_ids(context))
         return ''
 
 def forum_latest_posts(parser, token):
@@ -35,23 +50,16 @@ def forum_latest_posts(parser, token):
     {% forum_latest_posts [number] as [context_var] %}
     """
     bits = token.contents.split()
-    if len(bits) not in (1, 2, 4):
-        raise TemplateSyntaxError('%s tag requires none, one or three arguments' % bits[0])
-    if bits[2] != 'as':
-        raise TemplateSyntaxError("Second argument to %s tag must be 'as'" % bits[0])
-    if not bits[1]:
-        bits[1] = 5 # Default number of items
-    if not bits[3]:
-        bits[3] = 'latest_posts'
-    return ForumLatestPostsNode(bits[1], bits[3])
+    number, context_var = _latest_tag_args(bits, 'latest_posts')
+    return ForumLatestPostsNode(number, context_var)
 
 class ForumLatestPostsNode(Node):
     def __init__(self, number, context_var):
-        self.number = int(number) - 1
+        self.number = number
         self.context_var = context_var
 
     def render(self, context):
-        context[self.context_var] = Post.objects.select_related().order_by('-time')[:self.number]
+        context[self.context_var] = activity.latest_posts(self.number, _visible_forum_ids(context))
         return ''
 
 
@@ -60,25 +68,20 @@ def forum_latest_user_posts(parser, token):
     {% forum_latest_user_posts user [number] as [context_var] %}
     """
     bits = token.contents.split()
-    if len(bits) not in (2, 3, 5):
-        raise TemplateSyntaxError('%s tag requires one, two or four arguments' % bits[0])
-    if bits[3] != 'as':
-        raise TemplateSyntaxError("Second argument to %s tag must be 'as'" % bits[0])
-    if not bits[2]:
-        bits[2] = 5 # Default number of items
-    if not bits[3]:
-        bits[4] = 'latest_user_posts'
-    return ForumLatestUserPostsNode(bits[1], bits[2], bits[4])
+    if len(bits) < 2:
+        raise TemplateSyntaxError('%s tag requires a user argument' % bits[0])
+    number, context_var = _latest_tag_args(bits, 'latest_user_posts', leading=1)
+    return ForumLatestUserPostsNode(bits[1], number, context_var)
 
 class ForumLatestUserPostsNode(Node):
     def __init__(self, user, number, context_var):
         self.user = Variable(user)
-        self.number = int(number) - 1
+        self.number = number
         self.context_var = context_var
 
     def render(self, context):
         user = self.user.resolve(context)
-        context[self.context_var] = Post.objects.select_related().filter(author=user).order_by('-time')[:self.number]
+        context[self.context_var] = activity.latest_user_posts(user, self.number, _visible_forum_ids(context))
         return ''
 
 
@@ -130,8 +133,17 @@ register.tag('forum_latest_user_posts', forum_latest_user_posts)
 register.tag('get_display_page_range', get_display_page_range)
 
 @register.filter(name='highlight')
-def highlight(text, filter):
-    '''useage: {{text_block|highlight:"helloworld"}}.'''
-    pattern = re.compile(r"(?P<filter>%s)" % filter, re.IGNORECASE)
-    return mark_safe(re.sub(pattern, r"<span class='highlight org fn'>\g<filter></span>", text))
+def highlight(text, query):
+    '''useage: {{text_block|highlight:keyword}}, marks every word of the search query; the text is escaped.'''
+    return get_highlighter(query or u'').highlight(force_text(text or u''))
+
+@register.filter(name='snippet')
+def snippet(text, query):
+    '''useage: {{hit.post.body|snippet:keyword}}, the highlighted passage that matches the query best.'''
+    return get_highlighter(query or u'').snippet(force_text(text or u''))
+
+@register.filter(name='html_snippet')
+def html_snippet(html, query):
+    '''useage: {{hit.post.body_html|html_snippet:keyword}}, the same from rendered HTML.'''
+    return get_highlighter(query or u'').snippet(force_text(html or u''), html=True)
 
@@ -0,0 +1,278 @@
+import datetime
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from forum import notifications
+from forum.bulkload import BulkLoader, BulkLoadError
+from forum.models import Forum, Thread, Post, Subscription, Notification, ForumActivity
+from forum.pagination import KeysetPaginator, InvalidCursor
+from forum.search.highlight import Highlighter
+
+def make_thread(forum, title=u'A thread', **fields):
+    thread = Thread(forum=forum, title=title, **fields)
+    thread.save()
+    return thread
+
+def make_post(thread, author, body=u'Some text'):
+    post = Post(thread=thread, author=author, body=body)
+    post.save()
+    return post
+
+class HighlighterTest(SimpleTestCase):
+    def test_best_window(self):
+        h = Highlighter(u'nginx proxy')
+        matches = [(0, 5, u'nginx'), (100, 105, u'proxy'), (110, 115, u'nginx')]
+        self.assertEqual(h._best_window(matches, 20), (1, 2))
+
+    def test_match_longer_than_window(self):
+        h = Highlighter(u'a')
+        self.assertEqual(h._best_window([(0, 30, u'a')], 10), (0, 0))
+        self.assertEqual(h._best_window([(0, 3, u'a'), (5, 40, u'b'), (50, 53, u'a')], 10), (0, 0))
+
+    def test_snippet_with_long_match(self):
+        word = u'x' * 30
+        h = Highlighter(word)
+        snippet = h.snippet(u'some text %s and more text' % word, length=10)
+        self.assertEqual(snippet, u'\u2026<span class="highlight">%s</span>\u2026' % word)
+
+    def test_snippet_escapes(self):
+        h = Highlighter(u'nginx')
+        self.assertEqual(h.snippet(u'a <b> & nginx', length=100),
+                         u'a &lt;b&gt; &amp; <span class="highlight">nginx</span>')
+        self.assertEqual(h.snippet(u'we put nginx in front of apache and it works well', length=30),
+                         u'we put <span class="highlight">nginx</span> in front of\u2026')
+
+class CounterTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'secret')
+        self.parent = Forum.objects.create(title=u'Parent', slug='parent')
+        self.forum = Forum.objects.create(title=u'Child', slug='child', parent=self.parent)
+        self.thread = make_thread(self.forum)
+
+    def test_posts_shift_the_counters(self):
+        first = make_post(self.thread, self.user)
+        last = make_post(self.thread, self.user)
+
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertEqual(thread.posts, 2)
+        self.assertEqual(thread.first_post_id, first.pk)
+        self.assertEqual(thread.last_post_id, last.pk)
+        for forum in Forum.objects.filter(pk__in=[self.parent.pk, self.forum.pk]):
+            self.assertEqual((forum.threads, forum.posts, forum.last_post_id), (1, 2, last.pk))
+
+        last.delete()
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertEqual((thread.posts, thread.last_post_id), (1, first.pk))
+        self.assertEqual(Forum.objects.get(pk=self.parent.pk).posts, 1)
+
+    def test_stale_instances_keep_the_counters(self):
+        stale_thread = Thread.objects.get(pk=self.thread.pk)
+        stale_forum = Forum.objects.get(pk=self.forum.pk)
+        post = make_post(self.thread, self.user)
+
+        stale_thread.title = u'Renamed'
+        stale_thread.save()
+        stale_forum.description = u'Changed'
+        stale_forum.save()
+
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertEqual((thread.title, thread.posts, thread.last_post_id), (u'Renamed', 1, post.pk))
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.description, forum.threads, forum.posts), (u'Changed', 1, 1))
+
+    def test_moving_a_thread_moves_its_counters(self):
+        other = Forum.objects.create(title=u'Other', slug='other')
+        make_post(self.thread, self.user)
+        thread = Thread.objects.get(pk=self.thread.pk)
+        thread.forum = other
+        thread.save()
+
+        counters = dict((f.pk, (f.threads, f.posts)) for f in Forum.objects.all())
+        self.assertEqual(counters, {self.parent.pk: (0, 0), self.forum.pk: (0, 0), other.pk: (1, 1)})
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        forum = Forum.objects.create(title=u'Forum', slug='forum')
+        start = timezone.now()
+        # Two threads share a time, so the pk has to break the tie.
+        times = [start, start, start + datetime.timedelta(minutes=1),
+                 start + datetime.timedelta(minutes=2), start + datetime.timedelta(minutes=3)]
+        self.threads = [make_thread(forum, latest_post_time=when, hotness=i / 3.0)
+                        for i, when in enumerate(times)]
+        self.paginator = KeysetPaginator(Thread.objects.all(), (('latest_post_time', True), ('id', True)), 2)
+        self.newest_first = [t.pk for t in reversed(self.threads)]
+
+    def pks(self, page):
+        return [t.pk for t in page]
+
+    def test_pages_follow_each_other(self):
+        page = self.paginator.page()
+        self.assertEqual(self.pks(page), self.newest_first[:2])
+        self.assertEqual((page.has_previous, page.has_next), (False, True))
+
+        page = self.paginator.page(after=self.paginator.encode_cursor(page.object_list[-1]))
+        self.assertEqual(self.pks(page), self.newest_first[2:4])
+        self.assertEqual((page.has_previous, page.has_next), (True, True))
+
+        page = self.paginator.page(after=self.paginator.encode_cursor(page.object_list[-1]))
+        self.assertEqual(self.pks(page), self.newest_first[4:])
+        self.assertFalse(page.has_next)
+
+        page = self.paginator.page(before=self.paginator.encode_cursor(page.object_list[0]))
+        self.assertEqual(self.pks(page), self.newest_first[2:4])
+
+    def test_last_page(self):
+        page = self.paginator.page(last=True)
+        self.assertEqual(self.pks(page), self.newest_first[-2:])
+        self.assertEqual((page.has_previous, page.has_next), (True, False))
+
+    def test_float_cursor(self):
+        # The cursor of the first page is at 2/3, which str() would round.
+        paginator = KeysetPaginator(Thread.objects.all(), (('hotness', True), ('id', True)), 3)
+        page = paginator.page()
+        page = paginator.page(after=paginator.encode_cursor(page.object_list[-1]))
+        self.assertEqual(self.pks(page), self.newest_first[3:])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(InvalidCursor, self.paginator.page, after='garbage')
+
+class ReconcileCommandTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('alice', 'alice@example.com', 'secret')
+        self.forum = Forum.objects.create(title=u'Forum', slug='forum')
+        self.thread = make_thread(self.forum)
+        make_post(self.thread, user)
+        Thread.objects.filter(pk=self.thread.pk).update(posts=7)
+        Forum.objects.filter(pk=self.forum.pk).update(posts=0)
+
+    def reconcile(self, *args, **options):
+        out = StringIO()
+        call_command('forum_reconcile', *args, stdout=out, **options)
+        return out.getvalue()
+
+    def test_dry_run_reports_without_writing(self):
+        output = self.reconcile(dry_run=True)
+        self.assertIn('thread.posts: 1 rows differ', output)
+        self.assertIn('forum.posts: 1 rows differ', output)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).posts, 7)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).posts, 0)
+
+    def test_fixes_the_drift(self):
+        output = self.reconcile()
+        self.assertIn('thread.posts: 1 rows fixed', output)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).posts, 1)
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).posts, 1)
+        self.assertEqual(self.reconcile(), 'All counters are up to date.\n')
+
+    def test_only_the_given_forums(self):
+        Forum.objects.create(title=u'Other', slug='other')
+        self.assertIn('thread.posts: 1 rows fixed', self.reconcile('other', 'forum'))
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).posts, 1)
+
+class BulkLoadTest(TransactionTestCase):
+    def setUp(self):
+        User.objects.create_user('alice', 'alice@example.com', 'secret')
+        User.objects.create_user('bob', 'bob@example.com', 'secret')
+        self.forum = Forum.objects.create(title=u'Forum', slug='forum')
+
+    def rows(self):
+        return [
+            {'thread': 'a', 'forum': 'forum', 'title': u'First', 'author': 'alice',
+             'body': u'Hello', 'time': '2013-01-01T10:00:00'},
+            {'thread': 'a', 'author': 'bob', 'body': u'Hi', 'time': '2013-01-01T10:30:00'},
+            {'thread': 'b', 'forum': 'forum', 'title': u'Second', 'author': 'bob',
+             'body': u'Another', 'time': '2013-01-01T12:00:00', 'sticky': 'yes'},
+        ]
+
+    def test_load(self):
+        summary = BulkLoader(batch_size=2, processes=1).load(self.rows())
+        self.assertEqual((summary['rows'], summary['threads']), (3, 2))
+
+        first = Thread.objects.get(title=u'First')
+        posts = list(first.post_set.order_by('time'))
+        self.assertEqual([p.body for p in posts], [u'Hello', u'Hi'])
+        self.assertEqual((first.posts, first.first_post_id, first.last_post_id), (2, posts[0].pk, posts[1].pk))
+        self.assertEqual(first.last_poster.username, 'bob')
+        self.assertEqual(first.create_at, posts[0].time)
+        self.assertTrue(Thread.objects.get(title=u'Second').sticky)
+
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.threads, forum.posts), (2, 3))
+        totals = ForumActivity.objects.filter(forum=forum).aggregate(posts=Sum('posts'), threads=Sum('threads'))
+        self.assertEqual(totals, {'posts': 3, 'threads': 2})
+
+    def test_failed_load_recounts_what_was_committed(self):
+        rows = self.rows()
+        rows[2]['author'] = 'nobody'
+        self.assertRaises(BulkLoadError, BulkLoader(batch_size=2, processes=1).load, rows)
+
+        self.assertEqual(list(Thread.objects.values_list('title', 'posts')), [(u'First', 2)])
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.threads, forum.posts), (1, 2))
+
+    def test_rows_need_a_forum_to_start_a_thread(self):
+        rows = self.rows()
+        del rows[0]['forum']
+        self.assertRaises(BulkLoadError, BulkLoader(processes=1).load, rows)
+        self.assertFalse(Post.objects.exists())
+
+class NotificationQueueTest(TestCase):
+    def setUp(self):
+        author = User.objects.create_user('alice', 'alice@example.com', 'secret')
+        subscriber = User.objects.create_user('bob', 'bob@example.com', 'secret')
+        thread = make_thread(Forum.objects.create(title=u'Forum', slug='forum'))
+        Subscription.objects.create(author=subscriber, thread=thread)
+        self.post = make_post(thread, author)
+        self.notification = notifications.enqueue(self.post)
+
+    def get(self):
+        return Notification.objects.get(pk=self.notification.pk)
+
+    def test_claim_takes_a_lease(self):
+        before = timezone.now()
+        claimed = notifications.claim(10)
+        self.assertEqual([n.pk for n in claimed], [self.notification.pk])
+        notification = self.get()
+        self.assertEqual((notification.status, notification.attempts), (Notification.SENDING, 1))
+        self.assertTrue(notification.next_attempt >= before + datetime.timedelta(seconds=notifications.FORUM_NOTIFY_LEASE))
+
+        # Held by the first claim.
+        self.assertEqual(notifications.claim(10), [])
+
+        # The worker died and the lease ran out.
+        Notification.objects.filter(pk=notification.pk).update(next_attempt=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual([n.pk for n in notifications.claim(10)], [notification.pk])
+        self.assertEqual(self.get().attempts, 2)
+
+    def test_failures_back_off(self):
+        mailer = notifications.Mailer(workers=1)
+        try:
+            notification = notifications.claim(10)[0]
+            before = timezone.now()
+            mailer._finish(notification, None, 0, Exception('Connection refused'), dict.fromkeys(notifications.METRICS, 0))
+            notification = self.get()
+            self.assertEqual((notification.status, notification.last_error), (Notification.PENDING, u'Connection refused'))
+            delay = (notification.next_attempt - before).total_seconds()
+            self.assertTrue(notifications.FORUM_NOTIFY_RETRY_DELAY <= delay <= notifications.FORUM_NOTIFY_RETRY_DELAY * 1.5 + 1)
+
+            Notification.objects.filter(pk=notification.pk).update(attempts=notifications.FORUM_NOTIFY_MAX_ATTEMPTS)
+            mailer._finish(self.get(), None, 0, Exception('Still refused'), dict.fromkeys(notifications.METRICS, 0))
+            self.assertEqual(self.get().status, Notification.FAILED)
+        finally:
+            mailer.close()
+
+    def test_process_mails_the_subscribers(self):
+        stats = notifications.process(workers=1)
+        self.assertEqual((stats['notifications'], stats['messages'], stats['recipients']), (1, 1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].bcc, ['bob@example.com'])
+        notification = self.get()
+        self.assertEqual((notification.status, notification.recipients), (Notification.SENT, 1))
+        # Nothing is left to send.
+        self.assertEqual(notifications.claim(10), [])
@@ -11,8 +11,8 @@ Usage in your base urls.py:
 
 from django.conf.urls.defaults import *
 from forum.models import Forum
-from forum.feeds import RssForumFeed, AtomForumFeed
-from forum.sitemap import ForumSitemap, ThreadSitemap, PostSitemap
+from forum.feeds import RssForumFeed, AtomForumFeed, RssThreadFeed, AtomThreadFeed
+from forum.sitemap import sitemaps as sitemap_dict
 from forum.views import ForumIndexView, \
                         ForumView, \
                         ThreadCreateView, \
@@ -20,37 +20,46 @@ from forum.views import ForumIndexView, \
                         PostCreateView, \
                         SubscriptionUpdateView, \
                         ForumSearchView, \
+                        HotThreadsView, \
                         ForumTagsView
 
-sitemap_dict = {
-    'forums': ForumSitemap,
-    'threads': ThreadSitemap,
-    'posts': PostSitemap,
-}
-
 urlpatterns = patterns('',
     url(r'^$',            ForumIndexView.as_view(), name='forum_index'),
     url(r'^forumlist/$',  ForumIndexView.as_view(template_name='forum/forum_list.html'), name='forum_list'),
-    #(r'^(?P<url>(rss).*)/$', RssForumFeed()),
-    (r'^(?P<url>(atom).*)/$', AtomForumFeed()),
+    # Not a possible forum slug, unlike rss/ and atom/.
+    url(r'^rss\.xml$', RssForumFeed(), name='forum_index_rss'),
+    url(r'^atom\.xml$', AtomForumFeed(), name='forum_index_atom'),
 
     url(r'^thread/(?P<thread>[0-9]+)/$',           ThreadView.as_view(), name='forum_view_thread'),
     url(r'^thread/(?P<thread>[0-9]+)/reply/$', PostCreateView.as_view(), name='forum_reply_thread'),
+    url(r'^thread/(?P<thread>[0-9]+)/rss/$', RssThreadFeed(), name='forum_thread_rss'),
+    url(r'^thread/(?P<thread>[0-9]+)/atom/$', AtomThreadFeed(), name='forum_thread_atom'),
+    url(r'^thread/(?P<thread>[0-9]+)/unread/$', 'forum.views.thread_unread', name='forum_thread_unread'),
+    url(r'^post/(?P<post>[0-9]+)/$', 'forum.views.view_post', name='forum_view_post'),
     
     url(r'^search/$', ForumSearchView.as_view(), name='forum_search'),
     url(r'^search/(?P<keyword>[-\w]+)/$', ForumSearchView.as_view(), name='forum_search_keyword'),
+    url(r'^suggest/$', 'forum.views.forum_suggest', name='forum_suggest'),
     
+    url(r'^hot/$', HotThreadsView.as_view(), name='forum_hot'),
     url(r'^tags/$', ForumTagsView.as_view(), name='forum_tags'),
+
+    url(r'^stats/$', 'forum.views.forum_stats', name='forum_stats'),
+    url(r'^stats/(?P<forum>[-\w]+)/$', 'forum.views.forum_stats', name='forum_forum_stats'),
     
     url(r'^subscriptions/$',   SubscriptionUpdateView.as_view(), name='forum_subscriptions'),
     url(r'^like/$',   SubscriptionUpdateView.as_view(), name='forum_like'),
+    url(r'^mark-read/$', 'forum.views.mark_read', name='forum_mark_read'),
+    url(r'^mark-read/(?P<forum>[-\w]+)/$', 'forum.views.mark_read', name='forum_mark_forum_read'),
     
     
     url(r'^(?P<forum>[-\w]+)/$',            ForumView.as_view(), name='forum_thread_list'),
     url(r'^(?P<forum>[-\w]+)/new/$', ThreadCreateView.as_view(), name='forum_new_thread'),
     url(r'^(?P<forum>[-\w]+)/rss/$', RssForumFeed(), name='forum_rss'),
+    url(r'^(?P<forum>[-\w]+)/atom/$', AtomForumFeed(), name='forum_atom'),
 
     url(r'^([-\w/]+/)(?P<forum>[-\w]+)/rss/$', RssForumFeed()), # must before forum_subforum_thread_list
+    url(r'^([-\w/]+/)(?P<forum>[-\w]+)/atom/$', AtomForumFeed()), # must before forum_subforum_thread_list
     url(r'^([-\w/]+/)(?P<forum>[-\w]+)/new/$', ThreadCreateView.as_view()), # must before forum_subforum_thread_list
     url(r'^([-\w/]+/)(?P<forum>[-\w]+)/$', ForumView.as_view(), name='forum_subforum_thread_list'),
 
@@ -0,0 +1,147 @@
+"""
+Small helpers shared by the forum models, views and management commands.
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from importlib import import_module
+
+import django
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+# Timeout for cache entries meant to stay until replaced. A None timeout
+# only means "forever" from Django 1.6 on; before, it means the default
+# timeout of the backend, usually five minutes.
+if django.VERSION >= (1, 6):
+    CACHE_FOREVER = None
+else:
+    CACHE_FOREVER = 365 * 24 * 60 * 60
+
+# Django 1.6 introduced atomic(). Older releases only offer
+# commit_on_success, which does not nest: an inner block would commit or
+# roll back the whole outer transaction. So within a transaction the
+# fallback uses a savepoint, which lets callers recover from an
+# IntegrityError without losing the work done before.
+try:
+    _atomic = transaction.atomic
+except AttributeError:
+    @contextmanager
+    def _atomic(using=None):
+        if not transaction.is_managed(using=using):
+            with transaction.commit_on_success(using=using):
+                yield
+            return
+        sid = transaction.savepoint(using=using)
+        try:
+            yield
+        except:
+            transaction.savepoint_rollback(sid, using=using)
+            raise
+        else:
+            transaction.savepoint_commit(sid, using=using)
+
+# Django 1.9 introduced on_commit(). Before, atomic() below keeps the
+# callbacks per thread and connection and calls them when the outermost
+# block commits; those of a block rolled back are dropped. Transactions
+# opened elsewhere (TransactionMiddleware, ATOMIC_REQUESTS) have no such
+# hook, so what they leave pending is called once the request finished.
+# The callbacks are meant for invalidations and announcements, which
+# must not be seen before the data they are about.
+try:
+    on_commit = transaction.on_commit
+    atomic = _atomic
+except AttributeError:
+    _hooks = threading.local()
+
+    def _in_transaction(using):
+        if django.VERSION >= (1, 6):
+            return transaction.get_connection(using).in_atomic_block
+        return transaction.is_managed(using=using)
+
+    def _callbacks(using):
+        if not hasattr(_hooks, 'callbacks'):
+            _hooks.callbacks = {}
+        return _hooks.callbacks.setdefault(using or DEFAULT_DB_ALIAS, [])
+
+    def _run_callbacks(using):
+        callbacks = _callbacks(using)
+        while callbacks:
+            callbacks.pop(0)()
+
+    def on_commit(func, using=None):
+        """Calls func() once the current transaction commits, or now outside of one."""
+        if _in_transaction(using):
+            _callbacks(using).append(func)
+        else:
+            func()
+
+    @contextmanager
+    def atomic(using=None):
+        callbacks = _callbacks(using)
+        registered = len(callbacks)
+        try:
+            with _atomic(using=using):
+                yield
+        except:
+            del callbacks[registered:]
+            raise
+        if not _in_transaction(using):
+            _run_callbacks(using)
+
+    def _run_pending_callbacks(**kwargs):
+        for using in list(getattr(_hooks, 'callbacks', {})):
+            if not _in_transaction(using):
+                _run_callbacks(using)
+
+    request_finished.connect(_run_pending_callbacks, dispatch_uid='forum.utils.on_commit')
+
+def load_class(path):
+    """
+    Imports a class (or any module attribute) from a dotted path such as
+    'forum.viewcounter.LocalBuffer'.
+    """
+    module_name, attr = path.rsplit('.', 1)
+    return getattr(import_module(module_name), attr)
+
+_state = threading.local()
+
+@contextmanager
+def deferred_updates():
+    """
+    Within this block, saving threads and posts skips the incremental
+    counter, statistics and cache maintenance. Used by bulk operations,
+    which recompute everything in one pass when they are done.
+    """
+    previous = updates_deferred()
+    _state.deferred = True
+    try:
+        yield
+    finally:
+        _state.deferred = previous
+
+def updates_deferred():
+    return getattr(_state, 'deferred', False)
+
+class LRUCache(object):
+    """A thread safe, size bounded mapping that forgets the least used keys."""
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
@@ -0,0 +1,192 @@
+"""
+Write-behind view counting for threads.
+
+Page hits only bump a counter in a buffer; the buffered increments are
+written to the Thread table later, in a few batched UPDATE statements,
+either when FORUM_VIEW_COUNTER_INTERVAL seconds have passed or when
+FORUM_VIEW_COUNTER_THRESHOLD hits are pending in this process.
+
+Two buffers are available through FORUM_VIEW_COUNTER_BACKEND:
+
+ * forum.viewcounter.LocalBuffer (default) keeps the counts in process
+   memory. They are flushed at interpreter exit as well.
+ * forum.viewcounter.CacheBuffer keeps the counts in the cache backend,
+   so they are shared between workers and can be flushed from anywhere,
+   eg. by `./manage.py forum_flush_views` from cron.
+"""
+
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from forum import hotness
+from forum.utils import CACHE_FOREVER, atomic, load_class
+
+FORUM_VIEW_COUNTER_BACKEND = getattr(settings, 'FORUM_VIEW_COUNTER_BACKEND', 'forum.viewcounter.LocalBuffer')
+FORUM_VIEW_COUNTER_INTERVAL = getattr(settings, 'FORUM_VIEW_COUNTER_INTERVAL', 30)
+FORUM_VIEW_COUNTER_THRESHOLD = getattr(settings, 'FORUM_VIEW_COUNTER_THRESHOLD', 100)
+
+# Number of thread ids per UPDATE ... WHERE id IN (...) statement.
+FLUSH_BATCH_SIZE = 500
+
+class LocalBuffer(object):
+    """
+    Accumulates view increments in a dict guarded by a lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def add(self, thread_id, count=1):
+        with self._lock:
+            self._counts[thread_id] = self._counts.get(thread_id, 0) + count
+
+    def drain(self):
+        """Returns the pending {thread_id: count} and empties the buffer."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+class CacheBuffer(object):
+    """
+    Accumulates view increments in the cache backend with atomic incr().
+
+    Every thread with pending views owns one counter key. The first
+    increment of a counter also appends the thread id to a numbered
+    slot list, which is how drain() finds the threads to flush. A slot
+    number is taken before the slot is written, so drain() looks again
+    for the slots it found empty, up to ``missing_drains`` times: after
+    that, their writer is assumed to have died in between.
+    """
+    prefix = 'forum:views:'
+    lock_timeout = 60
+    missing_drains = 3
+
+    def _incr(self, key, delta=1):
+        cache.add(key, 0, CACHE_FOREVER)
+        return cache.incr(key, delta)
+
+    def _register(self, thread_id):
+        slot = self._incr(self.prefix + 'slots')
+        cache.set('%sslot:%d' % (self.prefix, slot), thread_id, CACHE_FOREVER)
+
+    def add(self, thread_id, count=1):
+        if self._incr('%st:%d' % (self.prefix, thread_id), count) == count:
+            self._register(thread_id)
+
+    def drain(self):
+        if not cache.add(self.prefix + 'lock', 1, self.lock_timeout):
+            # Somebody else is flushing right now.
+            return {}
+        try:
+            first = cache.get(self.prefix + 'flushed', 0) + 1
+            last = cache.get(self.prefix + 'slots', 0)
+            # {slot number: drains that found it empty}
+            missing = cache.get(self.prefix + 'missing', {})
+            slots = dict(('%sslot:%d' % (self.prefix, n), n) for n in list(missing) + list(range(first, last + 1)))
+            found = cache.get_many(list(slots))
+            thread_ids = set(found.values())
+            missing = dict((n, missing.get(n, 0) + 1) for key, n in slots.items()
+                           if key not in found and missing.get(n, 0) + 1 < self.missing_drains)
+
+            counts = {}
+            for thread_id in thread_ids:
+                key = '%st:%d' % (self.prefix, thread_id)
+                count = cache.get(key)
+                if not count:
+                    continue
+                counts[thread_id] = count
+                # Views that came in meanwhile stay in the counter; make
+                # sure they get picked up by the next drain.
+                if cache.decr(key, count) > 0:
+                    self._register(thread_id)
+
+            cache.set_many({self.prefix + 'flushed': last, self.prefix + 'missing': missing}, CACHE_FOREVER)
+            cache.delete_many(list(found))
+            return counts
+        finally:
+            cache.delete(self.prefix + 'lock')
+
+buffer = load_class(FORUM_VIEW_COUNTER_BACKEND)()
+
+_state_lock = threading.Lock()
+_pending = 0
+_last_flush = time.time()
+
+def write_counts(counts):
+    """
+    Adds {thread_id: count} to Thread.views, grouping the threads that
+    share the same increment into one UPDATE per batch, and adds the
+    views to the hourly activity of their forums and to the hotness of
+    the threads.
+    """
+    from forum.models import Thread, ForumActivity
+
+    # First, as it locks the rows in pk order: the UPDATEs below then
+    # find them locked already, whatever order they go in.
+    now = timezone.now()
+    hotness.record_views(counts, now)
+
+    by_count = {}
+    for thread_id, count in counts.items():
+        by_count.setdefault(count, []).append(thread_id)
+
+    for count, thread_ids in by_count.items():
+        for i in range(0, len(thread_ids), FLUSH_BATCH_SIZE):
+            Thread.objects.filter(pk__in=thread_ids[i:i + FLUSH_BATCH_SIZE]).update(views=F('views') + count)
+
+    forum_views = {}
+    thread_ids = list(counts)
+    for i in range(0, len(thread_ids), FLUSH_BATCH_SIZE):
+        for thread_id, forum_id in Thread.objects.filter(pk__in=thread_ids[i:i + FLUSH_BATCH_SIZE]).values_list('pk', 'forum_id'):
+            forum_views[forum_id] = forum_views.get(forum_id, 0) + counts[thread_id]
+    for forum_id, views in forum_views.items():
+        ForumActivity.objects.record(forum_id, now, views=views)
+
+def flush():
+    """
+    Writes every buffered increment to the database and returns the
+    {thread_id: count} that was written.
+    """
+    global _pending, _last_flush
+    with _state_lock:
+        _pending = 0
+        _last_flush = time.time()
+
+    counts = buffer.drain()
+    if counts:
+        try:
+            with atomic():
+                write_counts(counts)
+        except Exception:
+            # Put the views back so the next flush can retry them.
+            for thread_id, count in counts.items():
+                buffer.add(thread_id, count)
+            raise
+    return counts
+
+def record_view(thread):
+    """
+    Counts one view of a thread (or thread pk), flushing the buffer when due.
+    """
+    global _pending
+    buffer.add(getattr(thread, 'pk', thread))
+
+    with _state_lock:
+        _pending += 1
+        due = (_pending >= FORUM_VIEW_COUNTER_THRESHOLD or
+               time.time() - _last_flush >= FORUM_VIEW_COUNTER_INTERVAL)
+    if due:
+        flush()
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        pass
@@ -3,16 +3,13 @@ All forum logic is kept here - displaying lists of forums, threads
 and posts, adding new threads, and adding replies.
 """
 
-from datetime import datetime, timedelta
+import hashlib
 from functools import reduce
 from django.shortcuts import get_object_or_404, render_to_response,render
 from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseServerError, HttpResponseForbidden, HttpResponseNotAllowed
 from django.template import RequestContext, Context, loader
 from django import forms
-from django.core.mail import EmailMessage
 from django.conf import settings
-from django.template.defaultfilters import striptags, wordwrap
-from django.contrib.sites.models import Site
 from django.contrib import comments
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
@@ -20,6 +17,7 @@ from django.utils.translation import ugettext as _
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import permission_required
 from django.utils import timezone
+from django.utils.http import urlencode
 
 from django.views.generic import ListView
 from django.views.generic import CreateView, UpdateView
@@ -33,6 +31,10 @@ from django.db.models import Q
 from forum.models import Forum,Thread,Post,Subscription
 from forum.forms import CreateThreadForm, ReplyForm,ThreadForm,PostForm, SearchForm
 from forum.signals import thread_created
+from forum import notifications, pagecache, readmarks, stamps, stats, viewcounter
+from forum import search as forum_search
+from forum.pagination import KeysetPaginationMixin
+from forum.snapshot import snapshot
 
 FORUM_PAGINATION = getattr(settings, 'FORUM_PAGINATION', 10)
 LOGIN_URL = getattr(settings, 'LOGIN_URL', '/accounts/login/')
@@ -60,23 +62,24 @@ class ForumIndexView(ListView):
     template_name = 'forum/forum_index.html'
 
     def get_queryset(self):
-        return Thread.objects.all().order_by('-latest_post_time')
+        return Thread.objects.with_posts().order_by('-latest_post_time')
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super(ForumIndexView, self).get_context_data(**kwargs)
 
         extra_context={
-            'forum_list':Forum.objects.for_user(self.request.user).filter(parent__isnull=True)
+            'forum_list': snapshot.roots(Forum.objects.accessible_ids(self.request.user)),
         }
         context.update(extra_context)
         #print context
 
         return context
 
-class ForumView(FormMixin, ListView):
+class ForumView(FormMixin, KeysetPaginationMixin, ListView):
     model       = Thread
     paginate_by = FORUM_PAGINATION
+    keyset = (('sticky', True), ('latest_post_time', True), ('id', True))
     template_object_name='thread'
 
     #@method_decorator(login_required)
@@ -87,11 +90,9 @@ class ForumView(FormMixin, ListView):
         except Forum.DoesNotExist:
             raise Http404
 
-        self.child_forums = self.forum.child.for_user(request.user)
-        self.recent_threads = self.forum.thread_set.filter(posts__gt=0).select_related().order_by('-id')[:10]
-        self.active_threads = self.forum.thread_set.select_related().filter(
-                                                latest_post_time__gt=timezone.now() - timedelta(hours=36)
-                              ).order_by('-posts')[:10]
+        self.child_forums = snapshot.children(self.forum, Forum.objects.accessible_ids(request.user))
+        self.recent_threads = Thread.objects.with_posts(self.forum.thread_set.filter(posts__gt=0)).order_by('-id')[:10]
+        self.active_threads = Thread.objects.with_posts(Thread.objects.hot(self.forum))[:10]
 
         return super(ForumView, self).dispatch(request, *args, **kwargs)
 
@@ -100,16 +101,25 @@ class ForumView(FormMixin, ListView):
         # but it cant get in the func get_context_data, in which the url kwargs had been cleared
         #return super(ForumView, self).get_queryset().select_related('forum').filter(forum=self.forum).order_by('-latest_post_time')
         #return self.forum.thread_set.select_related('forum').order_by('-latest_post_time')
-        ids = [self.forum.pk,]
-        ids.extend([x.pk for x in self.forum.get_all_children()])
-        return Thread.objects.filter(forum__pk__in=ids).select_related('forum').order_by('-latest_post_time').all()
+        # Threads without a post have no place in the keyset ordering.
+        return Thread.objects.with_posts().filter(forum__path__startswith=self.forum.get_path(),
+                                                  latest_post_time__isnull=False)
 
+    def get_object_count(self):
+        # The counter includes threads without posts, which are not listed.
+        empty = Thread.objects.filter(forum__path__startswith=self.forum.get_path(),
+                                      latest_post_time__isnull=True).count()
+        return max(0, self.forum.threads - empty)
 
     def get_context_data(self, **kwargs):
         context = super(ForumView, self).get_context_data(**kwargs)
 
         form = CreateThreadForm()
 
+        # Sets thread.unread for the "new" markers.
+        threads = readmarks.annotate(self.request.user, context['object_list'])
+        context['object_list'] = context['thread_list'] = threads
+
         extra_context = {
             'forum': self.forum,
             'child_forums':   self.child_forums,
@@ -142,13 +152,54 @@ class ForumView(FormMixin, ListView):
 
 
 
-class ThreadView(ListView):
+class HotThreadsView(KeysetPaginationMixin, ListView):
+    """
+    The hottest threads of all the forums the user may see, see
+    forum.hotness. Every page is one read of the hotness index, without
+    counting the threads.
+    """
+    paginate_by = FORUM_PAGINATION
+    keyset = (('hotness', True), ('id', True))
+    offset_pages = False
+    template_name = 'forum/hot_threads.html'
+    context_object_name = 'thread_list'
+
+    def get_queryset(self):
+        forum_ids = Forum.objects.accessible_ids(self.request.user)
+        # One select_related() call: Django < 1.7 does not chain them.
+        return Thread.objects.hot(forum_ids=forum_ids).select_related('forum', 'last_post', 'last_poster')
+
+class ThreadView(KeysetPaginationMixin, ListView):
     model = Post
     paginate_by = FORUM_PAGINATION
+    keyset = (('time', False), ('id', False))
     template_object_name='post'
     template_name = 'forum/thread.html'
     #page_kwarg ='page'
 
+    def get(self, request, *args, **kwargs):
+        """Anonymous readers are served from forum.pagecache."""
+        params = set(request.GET.keys())
+        if request.user.is_authenticated() or params - set(['page', 'after', 'before']):
+            return super(ThreadView, self).get(request, *args, **kwargs)
+
+        thread_id = int(kwargs['thread'])
+        epoch, token = stamps.get('thread', thread_id, lambda: (
+            Thread.objects.filter(pk=thread_id).values_list('latest_post_time', flat=True) or [None])[0])
+        variant = hashlib.md5(urlencode(sorted((name, request.GET[name]) for name in params))).hexdigest()
+
+        rendered = []
+        def render():
+            rendered.append(True)
+            return super(ThreadView, self).get(request, *args, **kwargs)
+        # Changes of forum permissions make the pages stale too, and the
+        # old copies unfit to serve meanwhile.
+        response = pagecache.cached_page('thread', thread_id, variant, token, render,
+                                         access=Forum.objects.acl_version())
+        if not rendered:
+            viewcounter.record_view(thread_id)
+        return response
+
     def get_queryset(self):
         # get the url pattern <forum> from kwargs in func get_queryset,
         # but it cant get in the func get_context_data, in which the url kwargs had been cleared
@@ -166,11 +217,14 @@ class ThreadView(ListView):
         except Thread.DoesNotExist:
             raise Http404
 
+        # The view is written later in a batch, see forum.viewcounter.
+        viewcounter.record_view(self.thread)
         self.thread.views +=1
-        self.thread.save()
 
-        return super(ThreadView, self).get_queryset().filter(thread=self.thread).order_by('time')
+        return super(ThreadView, self).get_queryset().filter(thread=self.thread)
 
+    def get_object_count(self):
+        return self.thread.posts
 
     def get_context_data(self, **kwargs):
         context = super(ThreadView, self).get_context_data(**kwargs)
@@ -186,6 +240,10 @@ class ThreadView(ListView):
 
         form = ReplyForm(initial=initial)
 
+        # The newest post on this page is read now.
+        times = [post.time for post in context['object_list'] if post.time]
+        readmarks.record(self.request.user, self.thread, times and max(times) or None)
+
         extra_context = {
             'forum':  self.forum,
             'thread': self.thread,
@@ -264,16 +322,14 @@ class ThreadCreateView(CreateView):
                         body = form.cleaned_data['body'],
                         time=timezone.now()
                         )
+            # Post.save() maintains posts/latest_post_time on the thread.
             post.save()
 
-            self.object.latest_post_time=post.time
-            #self.object.posts +=1 #wrong, 1 more
-            self.object.save()
-
             if form.cleaned_data.get('subscribe', False):
                 s = Subscription(
                     author=request.user,
                     thread=self.object,
+                    delivery=Subscription.preferred_delivery(request.user),
                     )
                 s.save()
             return self.form_valid(form)
@@ -347,41 +403,16 @@ class PostCreateView(CreateView):
                 if not sub:
                     s = Subscription(
                         author=request.user,
-                        thread=self.thread
+                        thread=self.thread,
+                        delivery=Subscription.preferred_delivery(request.user),
                         )
                     s.save()
             else:
                 if sub:
                     sub.delete()
 
-            if self.thread.subscription_set.count() > 0:
-                # Subscriptions are updated now send mail to all the authors subscribed in
-                # this thread.
-                mail_subject = ''
-                try:
-                    mail_subject = settings.FORUM_MAIL_PREFIX
-                except AttributeError:
-                    mail_subject = '[Forum]'
-
-                mail_from = ''
-                try:
-                    mail_from = settings.FORUM_MAIL_FROM
-                except AttributeError:
-                    mail_from = settings.DEFAULT_FROM_EMAIL
-
-                mail_tpl = loader.get_template('forum/notify.txt')
-                c = Context({
-                    'body': wordwrap(striptags(body), 72),
-                    'site' : Site.objects.get_current(),
-                    'thread': self.thread,
-                    })
-
-                email = EmailMessage(
-                        subject=mail_subject+' '+striptags(self.thread.title),
-                        body= mail_tpl.render(c),
-                        from_email=mail_from,
-                        bcc=[s.author.email for s in self.thread.subscription_set.all()],)
-                email.send(fail_silently=True)
+            # Subscribers are mailed by forum_send_notifications.
+            notifications.enqueue(self.object)
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
@@ -393,38 +424,6 @@ class PostCreateView(CreateView):
         form.instance.thread = self.thread
         return super(PostCreateView, self).form_valid(form)
 
-class SearchUnavailable(Exception):
-        pass
-
-class SphinxObjectList(object):
-    def __init__(self, sphinx, term):
-        self.sphinx = sphinx
-        self.term = term
-
-    def _get_results(self):
-        results = self.sphinx.Query(self.term)
-        if results == {}:
-            raise SearchUnavailable()
-        if results is None:
-            results = {'total_found': 0, 'matches': []}
-        return results
-
-    def count(self):
-        if not hasattr(self, 'results'):
-            return self._get_results()['total_found']
-        return self.results['total_found']
-
-    def __len__(self):
-        return self.count()
-
-    def __getitem__(self, k):
-        if hasattr(self, 'result'):
-            raise Exception('Search result already available')
-        self.sphinx.SetLimits(k.start, (k.stop - k.start) or 1)
-        self.results = self._get_results()
-        ids = [m['id'] for m in self.results['matches']]
-        return Topic.objects.filter(id__in=ids)
-
 class ForumSearchView(FormMixin, ListView):
     model = Thread
     paginate_by = FORUM_PAGINATION
@@ -433,39 +432,31 @@ class ForumSearchView(FormMixin, ListView):
     keyword_kwarg = 'keyword'
     q = None
 
-    def dispatch(self, *args, **kwargs):
-        """ Decorate the view dispatcher with permission_required
-            Ensure the forum exists before creating a new Thread."""
-
-        print 'dispatch--------------------------------------------------------'
+    def dispatch(self, request, *args, **kwargs):
         self.keyword = kwargs.get(self.keyword_kwarg, None)
-        print kwargs
-        return super(ForumSearchView, self).dispatch(*args, **kwargs)
-
-    def search(self, keywords, search_type = 'or'):
-        if type(keywords) in [unicode,str]:
-            keywords = keywords.strip().split()
-
-        Q_list = [Q(title__icontains=keyword) for keyword in keywords]
-
-        Q_filters = reduce(lambda x,y:x or y, Q_list)
+        # ?forum=<slug> narrows the search to a forum and its sub-forums.
+        self.forum = None
+        if request.GET.get('forum'):
+            try:
+                self.forum = Forum.objects.for_user(request.user).get(slug=request.GET['forum'])
+            except Forum.DoesNotExist:
+                raise Http404
+        return super(ForumSearchView, self).dispatch(request, *args, **kwargs)
 
-        if len(keywords) > 0:
-            qs=Thread.objects.filter(Q_filters)
-        else:
-            qs=EmptyQuerySet()
-        return qs
+    def search(self, keywords):
+        """
+        Ranked hits for the keywords: words must all match, OR separates
+        alternatives and "quoted words" are phrases (see forum.search).
+        """
+        return forum_search.search(keywords, user=self.request.user, forum=self.forum)
 
     def get_queryset(self):
-        print 'get_queryset---------------------------------------------------------'
         if self.keyword:
             return self.search(self.keyword)
         else:
-            return EmptyQuerySet()
+            return forum_search.HitList([])
 
     def get(self, request, *args, **kwargs):
-        print 'get---------------------------------------------------------'
-        print request.GET
         q=self.q
 
         if not q:
@@ -479,8 +470,6 @@ class ForumSearchView(FormMixin, ListView):
     def post(self,request, *args, **kwargs):
         #if not request.user.is_authenticated():
         #    return HttpResponseForbidden()
-        print 'post---------------------------------------------------------'
-        print request.POST
         q=self.q
 
         if not q:
@@ -506,6 +495,7 @@ class ForumSearchView(FormMixin, ListView):
 
         extra_context = {
             'keyword':  self.keyword,
+            'forum': self.forum,
             'form': form,
         }
         context.update(extra_context)
@@ -513,40 +503,88 @@ class ForumSearchView(FormMixin, ListView):
 
         return context
 
-def search(request, slug):
-    forum = get_object_or_404(Forum, slug=slug)
+def forum_suggest(request):
+    """
+    Titles of the threads matching what is being typed in ?q=, best
+    first, as JSON for search-as-you-type.
+    """
     try:
+        limit = max(1, min(int(request.GET.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
+    query = request.GET.get('q', '')
+    return JSONResponse({
+        'query': query,
+        'results': [{'id': pk, 'title': title, 'url': reverse('forum_view_thread', args=[pk])}
+                    for pk, title in forum_search.suggest(query, user=request.user, limit=limit)],
+    })
+
+def view_post(request, post):
+    """
+    Redirects to the page of the thread that shows the given post, so
+    links to a post stay right however long its thread grows.
+    """
+    try:
+        post = Post.objects.select_related('thread__forum').get(pk=post)
+    except Post.DoesNotExist:
+        raise Http404
+    if not Forum.objects.has_access(post.thread.forum, request.user):
+        raise Http404
+    return HttpResponseRedirect(post.get_thread_url(FORUM_PAGINATION))
+
+def thread_unread(request, thread):
+    """Redirects to the first post of a thread the user has not read yet."""
+    try:
+        thread = Thread.objects.select_related('forum').get(pk=thread)
+    except Thread.DoesNotExist:
+        raise Http404
+    if not Forum.objects.has_access(thread.forum, request.user):
+        raise Http404
+    posts = Post.objects.filter(thread=thread)
+    since = readmarks.read_up_to(request.user, thread)
+    if since is not None:
+        posts = posts.filter(time__gt=since)
+    first = list(posts.order_by('time', 'id')[:1])
+    if not first:
+        return HttpResponseRedirect('%s?page=last' % thread.get_absolute_url())
+    return HttpResponseRedirect(first[0].get_thread_url(FORUM_PAGINATION))
+
+def mark_read(request, forum=None):
+    """Marks a forum and its sub-forums, or everything, as read."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not request.user.is_authenticated():
+        return HttpResponseRedirect('%s?next=%s' % (LOGIN_URL, request.path))
+    if forum:
         try:
-            from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED, SPH_SORT_RELEVANCE
-        except ImportError:
-            raise SearchUnavailable()
-        term = request.GET.get('term', '').encode('utf-8')
-        if term:
-            sphinx = SphinxClient()
-            sphinx.SetServer(settings.CICERO_SPHINX_SERVER, settings.CICERO_SPHINX_PORT)
-            sphinx.SetMatchMode(SPH_MATCH_EXTENDED)
-            sphinx.SetSortMode(SPH_SORT_RELEVANCE)
-            sphinx.SetFilter('gid', [forum.id])
-            paginator = Paginator(SphinxObjectList(sphinx, term), settings.CICERO_PAGINATE_BY)
-            try:
-                page = paginator.page(request.GET.get('page', '1'))
-            except InvalidPage:
-                raise Http404
-        else:
-            paginator = Paginator([], 1)
-            page = paginator.page(1)
-        return response(request, 'cicero/search.html', {
-            'page_id': 'search',
-            'forum': forum,
-            'term': term,
-            'paginator': paginator,
-            'page_obj': page,
-            'query_dict': request.GET,
-        })
-    except SearchUnavailable:
-        raise
-        return response(request, 'cicero/search_unavailable.html', {})
+            forum = Forum.objects.for_user(request.user).get(slug=forum)
+        except Forum.DoesNotExist:
+            raise Http404
+    readmarks.mark_read(request.user, forum or None)
+    return HttpResponseRedirect(forum and forum.get_absolute_url() or reverse('forum_index'))
 
+def forum_stats(request, forum=None):
+    """
+    Activity figures of the whole site, or of one forum and its
+    sub-forums, as JSON for dashboards.
+    """
+    if forum:
+        try:
+            forum = Forum.objects.for_user(request.user).get(slug=forum)
+        except Forum.DoesNotExist:
+            raise Http404
+
+    try:
+        days = max(1, min(int(request.GET.get('days', 30)), 366))
+    except ValueError:
+        days = 30
+    forum_ids = Forum.objects.accessible_ids(request.user)
+    return JSONResponse({
+        'today': stats.today(forum, forum_ids=forum_ids),
+        'last_7_days': stats.last_days(forum, 7, forum_ids=forum_ids),
+        'daily': [dict(date=day.isoformat(), **counters)
+                  for day, counters in stats.daily(forum, days, forum_ids=forum_ids)],
+    })
 
 class SubscriptionUpdateView(ListView):
     """
@@ -563,17 +601,25 @@ class SubscriptionUpdateView(ListView):
         return Subscription.objects.select_related().filter(author=self.request.user)
 
     def post(self, request, *args, **kwargs):
-        post_keys = [k for k in request.POST.keys()]
-        for s in self.queryset:
-            if not str(s.thread.pk) in post_keys:
+        modes = [str(value) for value, label in Subscription.DELIVERY_CHOICES]
+        for s in self.get_queryset():
+            if not str(s.thread.pk) in request.POST:
                 s.delete()
+                continue
+            delivery = request.POST.get('delivery_%s' % s.thread.pk)
+            if delivery in modes and int(delivery) != s.delivery:
+                Subscription.objects.filter(pk=s.pk).update(delivery=int(delivery))
+        # One mode for all the threads at once.
+        if request.POST.get('delivery') in modes:
+            Subscription.objects.filter(author=request.user).update(delivery=int(request.POST['delivery']))
         return HttpResponseRedirect(reverse('forum_subscriptions'))
 
     def get_context_data(self, **kwargs):
         context = super(SubscriptionUpdateView,self).get_context_data(**kwargs)
 
         extra_context={
-            'subs': self.queryset,
+            'subs': self.object_list,
+            'delivery_choices': Subscription.DELIVERY_CHOICES,
             'next': self.request.GET.get('next')
         }
         context.update(extra_context)